@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+"""
+Stand-in of the CodeChecker analyzer workers for the throughput tests. It
+pops the parts from ANALYSES_QUEUE, sleeps instead of analyzing them and
+writes a report of a given size, following the protocol of the real workers.
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+import redis
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT_DIR, "server"))
+
+from analysis_status import completion_target, mark_queued
+from part_results import PartResults
+from report_index import request_index
+from result_cache import PART_OUTPUT_DIR, build_results
+
+LOG = logging.getLogger("ANALYZER")
+
+QUEUE_KEY = "ANALYSES_QUEUE"
+
+# Seconds a worker blocks on the empty queue before checking whether it is
+# stopped.
+POP_TIMEOUT = 1
+
+
+class FakeAnalyzer:
+    """
+    Analyzes the dispatched parts with a given number of worker threads.
+    Every part takes analysis_time seconds, give or take jitter seconds.
+
+    Like the real workers, the reports of part N are written to output_N of
+    the analysis, the part is counted and logged as completed in one step,
+    and the worker which completes the last part builds output.zip from them
+    and queues it for the indexing of its reports. The last part is the one
+    which completes the number of the parts announced by the client in
+    expected_parts, or the number of the parts received so far if it was not
+    announced.
+    """
+
+    def __init__(self, database, workspace, analysis_time=0.1, jitter=0.0,
+                 report_size=4096, seed=0):
+        self.database = database
+        self.workspace = workspace
+        self.analysis_time = analysis_time
+        self.jitter = jitter
+        self.report_size = report_size
+        self.part_results = PartResults(database, workspace)
+
+        self.analyzed_parts = 0
+        self.completed_analyses = 0
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def analyze_next(self, timeout=POP_TIMEOUT):
+        """
+        Analyzes the next part of the queue. Returns False if the queue was
+        empty for timeout seconds.
+        """
+
+        popped = self.database.blpop(QUEUE_KEY, timeout=timeout)
+        if popped is None:
+            return False
+
+        analysis_id, part_number = popped[1].decode("utf-8").rsplit("_", 1)
+        part_number = int(part_number)
+        analysis_dir = os.path.join(self.workspace, analysis_id)
+
+        self.database.hset(analysis_id, "state", "ANALYZE_IN_PROGRESS")
+
+        with self._lock:
+            deviation = self._random.uniform(-self.jitter, self.jitter)
+        time.sleep(max(0.0, self.analysis_time + deviation))
+
+        self._write_report(analysis_dir, part_number)
+
+        completed_parts = self.part_results.complete(analysis_id,
+                                                     part_number)
+        parts, expected_parts = self.database.hmget(
+            analysis_id, "parts", "expected_parts")
+
+        with self._lock:
+            self.analyzed_parts += 1
+
+        if completed_parts < completion_target(parts, expected_parts):
+            mark_queued(self.database, analysis_id)
+            return True
+
+        if expected_parts is not None and \
+                not self.database.hsetnx(analysis_id, "results_built", 1):
+            return True
+
+        build_results(analysis_dir, os.path.join(analysis_dir, "output.zip"))
+        self.database.hset(analysis_id, "state", "ANALYZE_COMPLETED")
+        request_index(self.database, analysis_id)
+
+        with self._lock:
+            self.completed_analyses += 1
+
+        return True
+
+    def _write_report(self, analysis_dir, part_number):
+        """
+        Writes a report named after the source file of the part.
+        """
+
+        part_dir = os.path.join(analysis_dir, "source_%d" % part_number)
+        source_name = "part_%d" % part_number
+
+        try:
+            with open(os.path.join(part_dir, "sources-root",
+                                   "compile_command.json")) as command_file:
+                source_name = os.path.basename(
+                    json.load(command_file)[0]["file"])
+        except (OSError, ValueError, KeyError, IndexError):
+            pass
+
+        output_dir = os.path.join(analysis_dir, PART_OUTPUT_DIR % part_number)
+        os.makedirs(output_dir, exist_ok=True)
+
+        with open(os.path.join(output_dir, "%s_%d.plist" % (
+                source_name, part_number)), "wb") as report:
+            report.write(b"x" * self.report_size)
+
+    def start(self, workers):
+        """
+        Starts the given number of worker threads.
+        """
+
+        for index in range(workers):
+            thread = threading.Thread(target=self._work, daemon=True,
+                                      name="fake-analyzer-%d" % index)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self):
+        while not self._stopped.is_set():
+            try:
+                self.analyze_next()
+            except Exception:
+                LOG.exception("Failed to analyze a part.")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Analyze the queued parts with fake workers which sleep "
+                    "instead of running CodeChecker.")
+    parser.add_argument(
+        "-w", "--workspace", type=str, dest="workspace", default="workspace",
+        help="Workspace of the controller.")
+    parser.add_argument(
+        "--redis-host", type=str, dest="redis_host", default="redis",
+        help="Host of the Redis database of the controller.")
+    parser.add_argument(
+        "--redis-port", type=int, dest="redis_port", default=6379,
+        help="Port of the Redis database of the controller.")
+    parser.add_argument(
+        "--workers", type=int, dest="workers", default=4,
+        help="Number of parts analyzed at once.")
+    parser.add_argument(
+        "--analysis-time", type=float, dest="analysis_time", default=0.1,
+        help="Seconds of the analysis of a part.")
+    parser.add_argument(
+        "--jitter", type=float, dest="jitter", default=0.0,
+        help="Maximum random deviation of the analysis time in seconds.")
+    parser.add_argument(
+        "--report-size", type=int, dest="report_size", default=4096,
+        help="Size of the report of a part in bytes.")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    analyzer = FakeAnalyzer(
+        redis.Redis(host=args.redis_host, port=args.redis_port, db=0),
+        args.workspace, args.analysis_time, args.jitter, args.report_size)
+    analyzer.start(args.workers)
+
+    try:
+        while True:
+            time.sleep(10)
+            LOG.info("%d parts and %d analyses completed.",
+                     analyzer.analyzed_parts, analyzer.completed_analyses)
+    except KeyboardInterrupt:
+        analyzer.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+"""
+Generator of synthetic source trees with a compilation database for the
+benchmarks.
+"""
+
+import argparse
+import json
+import os
+import random
+
+LINE = "int filler_%d_%d(int value) { return value * %d + %d; }\n"
+
+
+def write_file(path, header, size, prefix):
+    """
+    Writes a source file of about the given size after the header lines.
+    """
+
+    with open(path, "w") as source:
+        source.write(header)
+
+        written = len(header)
+        line_number = 0
+        while written < size:
+            line = LINE % (prefix, line_number, line_number, prefix)
+            source.write(line)
+            written += len(line)
+            line_number += 1
+
+
+def generate(output_dir, tus=100, headers_per_tu=50, shared_ratio=0.8,
+             header_size=4096, source_size=8192, seed=0):
+    """
+    Generates a source tree of the given number of translation units and
+    returns the path of its compilation database.
+
+    Every translation unit includes headers_per_tu headers, shared_ratio of
+    them from a pool of headers shared by all translation units and the rest
+    of its own.
+    """
+
+    rng = random.Random(seed)
+
+    output_dir = os.path.abspath(output_dir)
+    src_dir = os.path.join(output_dir, "src")
+    shared_dir = os.path.join(output_dir, "include", "shared")
+    private_dir = os.path.join(output_dir, "include", "private")
+    for directory in (src_dir, shared_dir, private_dir):
+        os.makedirs(directory, exist_ok=True)
+
+    shared_per_tu = int(round(headers_per_tu * shared_ratio))
+    private_per_tu = headers_per_tu - shared_per_tu
+    shared_count = max(shared_per_tu * 2, 1)
+
+    for index in range(shared_count):
+        write_file(os.path.join(shared_dir, "shared_%d.h" % index),
+                   "#pragma once\n", header_size, index)
+
+    compilation_database = []
+
+    for tu in range(tus):
+        includes = ["shared/shared_%d.h" % index for index in
+                    rng.sample(range(shared_count), shared_per_tu)]
+
+        for index in range(private_per_tu):
+            name = "tu_%d_%d.h" % (tu, index)
+            write_file(os.path.join(private_dir, name), "#pragma once\n",
+                       header_size, tu * 1000 + index)
+            includes.append("private/" + name)
+
+        source_path = os.path.join(src_dir, "tu_%d.cpp" % tu)
+        write_file(source_path,
+                   "".join("#include \"%s\"\n" % include
+                           for include in includes),
+                   source_size, tu)
+
+        compilation_database.append({
+            "directory": output_dir,
+            "file": source_path,
+            "command": "g++ -c -I%s %s -o %s" % (
+                os.path.join(output_dir, "include"), source_path,
+                os.path.join(output_dir, "tu_%d.o" % tu))})
+
+    database_path = os.path.join(output_dir, "compile_commands.json")
+    with open(database_path, "w") as database_file:
+        json.dump(compilation_database, database_file, indent=2)
+
+    return database_path
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "--tus", type=int, dest="tus", default=100,
+        help="Number of translation units.")
+    parser.add_argument(
+        "--headers-per-tu", type=int, dest="headers_per_tu", default=50,
+        help="Number of headers included by every translation unit.")
+    parser.add_argument(
+        "--shared-ratio", type=float, dest="shared_ratio", default=0.8,
+        help="Ratio of the included headers which are shared between the "
+             "translation units.")
+    parser.add_argument(
+        "--header-size", type=int, dest="header_size", default=4096,
+        help="Size of a header in bytes.")
+    parser.add_argument(
+        "--source-size", type=int, dest="source_size", default=8192,
+        help="Size of a source file in bytes.")
+    parser.add_argument(
+        "--seed", type=int, dest="seed", default=0,
+        help="Seed of the random choice of the shared headers.")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic source tree with a compilation "
+                    "database.")
+    parser.add_argument(
+        "-o", "--output", type=str, dest="output", required=True,
+        help="Directory of the generated tree.")
+    add_arguments(parser)
+
+    args = parser.parse_args()
+
+    print(generate(args.output, args.tus, args.headers_per_tu,
+                   args.shared_ratio, args.header_size, args.source_size,
+                   args.seed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+
+"""
+Load generator which drives concurrent simulated clients through a whole
+analysis and reports the throughput and the latency of the requests.
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+import zipfile
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.extend([os.path.join(ROOT_DIR, "client"),
+                 os.path.join(ROOT_DIR, "server"),
+                 os.path.join(ROOT_DIR, "gen-py")])
+
+from fake_analyzer import FakeAnalyzer
+from connection_pool import PROTOCOLS
+from phase_stats import percentile
+from remote_analyze import RemoteAnalayzerClient
+from remote_analyze_api.ttypes import AnalysisOptions
+from run import free_port, start_controller
+
+
+def synthetic_file(name, size):
+    """
+    Returns the content of a header of about the given size which is unique
+    to the name.
+    """
+
+    line = "int %s_filler(int value);\n" % name
+    return (line * max(size // len(line), 1)).encode("utf-8")
+
+
+def part_zip(part_number, salt, files):
+    """
+    Returns a part ZIP file which refers all of its files by their hashes.
+    files is a dict of the hashes and paths of the files.
+    """
+
+    source = "/load/src/part_%d.cpp" % part_number
+    command = {"directory": "/load", "file": source,
+               "command": "g++ -c -DLOAD_SALT=%s %s" % (salt, source)}
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        archive.writestr(
+            "sources-root/paths_of_dependencies.json",
+            json.dumps(sorted({os.path.dirname(path)
+                               for path in files.values()})))
+        archive.writestr("sources-root/compile_command.json",
+                         json.dumps([command]))
+        archive.writestr("sources-root/cached_files", json.dumps(files))
+
+    return buffer.getvalue()
+
+
+def run_client(args, client_index):
+    """
+    Submits analyses one after the other from a single connection and
+    returns the latencies of the requests by method and the turnaround
+    times of the analyses.
+    """
+
+    rng = random.Random(args.seed * 1000 + client_index)
+    latencies = defaultdict(list)
+    turnarounds = []
+    deadline = time.monotonic() + args.duration
+
+    with RemoteAnalayzerClient(args.host, args.port, args.framed,
+                               args.protocol) as client:
+        def call(method, *arguments):
+            started = time.perf_counter()
+            try:
+                return getattr(client, method)(*arguments)
+            finally:
+                latencies[method].append(time.perf_counter() - started)
+
+        while len(turnarounds) < args.analyses and \
+                time.monotonic() < deadline:
+            analysis_id = call("getId", AnalysisOptions(
+                submitter="load-client-%d" % client_index))
+
+            contents = {}
+            parts = []
+            for part_number in range(args.parts):
+                files = {}
+                for index in range(args.files_per_part):
+                    if rng.random() < args.shared_ratio:
+                        name = "shared_%d" % rng.randrange(args.shared_files)
+                    else:
+                        name = "unique_%s_%d_%d" % (
+                            analysis_id.replace("-", "_"), part_number, index)
+
+                    content = synthetic_file(name, args.file_size)
+                    hash_value = hashlib.md5(content).hexdigest()
+                    contents[hash_value] = content
+                    files[hash_value] = "/load/include/%s.h" % name
+
+                salt = analysis_id if args.unique_parts else "0"
+                parts.append(part_zip(part_number, salt.replace("-", ""),
+                                      files))
+
+            missing_files = call("checkUploadedFiles", list(contents))
+            if missing_files:
+                buffer = io.BytesIO()
+                with zipfile.ZipFile(buffer, "w") as archive:
+                    for hash_value in missing_files:
+                        archive.writestr(hash_value, contents[hash_value])
+                call("uploadFiles", buffer.getvalue())
+
+            started = time.monotonic()
+            for zip_content in parts:
+                call("analyze", analysis_id, zip_content)
+
+            # The analysis counts as completed when the parts received so
+            # far are done, so the part statistics are checked too.
+            while call("getStatus", analysis_id) != "ANALYZE_COMPLETED" or \
+                    call("getPartStats", analysis_id).completedParts < \
+                    args.parts:
+                time.sleep(args.poll_interval)
+
+            turnarounds.append(time.monotonic() - started)
+            call("getResults", analysis_id)
+
+    return dict(latencies), turnarounds
+
+
+def summarize(values, duration=None):
+    values = sorted(values)
+    summary = {"count": len(values),
+               "p50_ms": percentile(values, 0.5) * 1000,
+               "p99_ms": percentile(values, 0.99) * 1000,
+               "max_ms": values[-1] * 1000 if values else 0.0}
+    if duration:
+        summary["per_second"] = len(values) / duration
+
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Drive concurrent simulated clients through getId, "
+                    "checkUploadedFiles, uploadFiles, analyze, getStatus "
+                    "and getResults and report the throughput and the "
+                    "latencies.")
+    parser.add_argument(
+        "--host", type=str, dest="host", default=None,
+        help="Controller to load. Without it a controller and fake analyzer "
+             "workers are started in this process on an in-memory Redis.")
+    parser.add_argument(
+        "--port", type=int, dest="port", default=9090,
+        help="Port of the controller given with --host.")
+    parser.add_argument(
+        "--framed", dest="framed", default=False, action="store_true",
+        help="Use framed transport, which is needed by the nonblocking "
+             "server.")
+    parser.add_argument(
+        "--protocol", type=str, dest="protocol",
+        choices=sorted(PROTOCOLS), default="binary",
+        help="Protocol of the requests.")
+    parser.add_argument(
+        "--clients", type=int, dest="clients", default=8,
+        help="Number of concurrent clients, each in its own process.")
+    parser.add_argument(
+        "--analyses", type=int, dest="analyses", default=10,
+        help="Number of analyses submitted by every client.")
+    parser.add_argument(
+        "--duration", type=float, dest="duration", default=300,
+        help="Clients submit no new analysis after this many seconds.")
+    parser.add_argument(
+        "--parts", type=int, dest="parts", default=4,
+        help="Number of parts of an analysis.")
+    parser.add_argument(
+        "--files-per-part", type=int, dest="files_per_part", default=20,
+        help="Number of files of a part.")
+    parser.add_argument(
+        "--shared-files", type=int, dest="shared_files", default=200,
+        help="Number of the files shared by every client.")
+    parser.add_argument(
+        "--shared-ratio", type=float, dest="shared_ratio", default=0.8,
+        help="Ratio of the files of a part taken from the shared files. The "
+             "rest is unique to the part and always uploaded.")
+    parser.add_argument(
+        "--file-size", type=int, dest="file_size", default=4096,
+        help="Size of a file in bytes.")
+    parser.add_argument(
+        "--repeat-parts", dest="unique_parts", default=True,
+        action="store_false",
+        help="Send the same compile commands in every analysis, so parts of "
+             "the same files are taken from the result cache.")
+    parser.add_argument(
+        "--poll-interval", type=float, dest="poll_interval", default=0.1,
+        help="Seconds between two getStatus requests of a client.")
+    parser.add_argument(
+        "--analyzer-workers", type=int, dest="analyzer_workers", default=8,
+        help="Number of fake analyzer workers of the in-process controller.")
+    parser.add_argument(
+        "--analysis-time", type=float, dest="analysis_time", default=0.05,
+        help="Seconds of the fake analysis of a part.")
+    parser.add_argument(
+        "--jitter", type=float, dest="jitter", default=0.0,
+        help="Maximum random deviation of the analysis time in seconds.")
+    parser.add_argument(
+        "--controller-threads", type=int, dest="controller_threads",
+        default=64,
+        help="Number of threads of the in-process controller. Every client "
+             "holds one of them.")
+    parser.add_argument(
+        "--seed", type=int, dest="seed", default=0,
+        help="Seed of the random choice of the shared files.")
+    parser.add_argument(
+        "-o", "--output", type=str, dest="output", default=None,
+        help="Write the JSON report to this file instead of the standard "
+             "output.")
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        analyzer = None
+        if args.host is None:
+            args.host = "127.0.0.1"
+            args.port = free_port()
+            workspace = os.path.join(temp_dir, "workspace")
+
+            controller_arguments = ["--protocol", args.protocol]
+            if args.framed:
+                controller_arguments.append("--framed")
+
+            database = start_controller(workspace, args.port,
+                                        args.controller_threads,
+                                        controller_arguments)
+            analyzer = FakeAnalyzer(database, workspace, args.analysis_time,
+                                    args.jitter, seed=args.seed)
+            analyzer.start(args.analyzer_workers)
+
+        started = time.monotonic()
+
+        # The clients are started fresh instead of forked from a process
+        # which serves the controller.
+        with ProcessPoolExecutor(
+                max_workers=args.clients,
+                mp_context=multiprocessing.get_context("spawn")) as executor:
+            results = list(executor.map(run_client, [args] * args.clients,
+                                        range(args.clients)))
+
+        duration = time.monotonic() - started
+
+        with RemoteAnalayzerClient(args.host, args.port, args.framed,
+                                   args.protocol) as client:
+            queue_stats = client.getQueueStats()
+
+        if analyzer is not None:
+            analyzer.stop()
+
+    latencies = defaultdict(list)
+    turnarounds = []
+    for client_latencies, client_turnarounds in results:
+        for method, values in client_latencies.items():
+            latencies[method].extend(values)
+        turnarounds.extend(client_turnarounds)
+
+    requests = sum(len(values) for values in latencies.values())
+
+    report = {
+        "timestamp": time.time(),
+        "config": vars(args),
+        "duration": duration,
+        "analyses": len(turnarounds),
+        "analyses_per_second": len(turnarounds) / duration,
+        "requests": requests,
+        "requests_per_second": requests / duration,
+        "rpc": {method: summarize(values, duration)
+                for method, values in sorted(latencies.items())},
+        "turnaround": summarize(turnarounds),
+        "queue_wait": {priority: {"dispatched": stats.dispatched,
+                                  "average_ms": stats.averageWait * 1000,
+                                  "max_ms": stats.maxWait * 1000}
+                       for priority, stats in sorted(queue_stats.items())},
+    }
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
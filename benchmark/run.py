@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of the phases of remote_analyze.py analyze against a local
+controller backed by an in-memory Redis.
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.extend([os.path.join(ROOT_DIR, "client"),
+                 os.path.join(ROOT_DIR, "server"),
+                 os.path.join(ROOT_DIR, "gen-py")])
+
+import generate
+import remote_analyze
+from connection_pool import close_pools
+from phase_stats import PhaseStats
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def start_controller(workspace, port, workers,
+                     controller_arguments=()):
+    """
+    Starts a controller on a thread pool in this process with an in-memory
+    Redis and returns the database.
+    """
+
+    try:
+        import fakeredis
+    except ImportError:
+        sys.exit("The benchmark needs fakeredis with Lua support: "
+                 "pip3 install -r requirements_py/dev/requirements.txt")
+
+    import remote_agent
+
+    database = fakeredis.FakeRedis()
+    arguments = remote_agent.create_parser().parse_args(
+        ["-w", workspace, "--port", str(port)] + list(controller_arguments))
+    remote_agent.setup(arguments, database)
+
+    server = remote_agent.create_server("thread", "127.0.0.1", port, workers,
+                                        arguments.framed, arguments.protocol)
+    threading.Thread(target=server.serve, daemon=True).start()
+
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return database
+        except OSError:
+            time.sleep(0.05)
+
+    sys.exit("The controller did not start.")
+
+
+def run_analysis(client_args):
+    """
+    Runs the analyze command of the client like the users run it, with its
+    pipeline and caches, and returns the statistics of its phases and the
+    transferred bytes.
+    """
+
+    stats = PhaseStats()
+    remote_analyze.STATS = stats
+
+    started = time.perf_counter()
+    try:
+        remote_analyze.analyze(client_args)
+    finally:
+        stats.add("opened_connections", close_pools())
+
+    report = stats.report()
+
+    # The analyze command logs the errors of the requests and returns.
+    if "parts" not in report["counters"]:
+        sys.exit("The analysis failed.")
+
+    report["total"] = time.perf_counter() - started
+
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the phases of the analyze command on a "
+                    "synthetic source tree.")
+    generate.add_arguments(parser)
+    parser.add_argument(
+        "--tree", type=str, dest="tree", default=None,
+        help="Use the compilation database of this generated tree instead "
+             "of generating a new one.")
+    parser.add_argument(
+        "-j", "--jobs", type=int, dest="jobs", default=os.cpu_count(),
+        help="Number of workers of the dependency collection.")
+    parser.add_argument(
+        "--scanner", type=str, dest="scanner",
+        choices=["compiler", "builtin", "verify"], default="compiler",
+        help="How the dependencies are collected.")
+    parser.add_argument(
+        "--compression", type=str, dest="compression", default="auto",
+        help="Compression of the uploaded ZIP files.")
+    parser.add_argument(
+        "--hash-cache", dest="hash_cache", default=False,
+        action="store_true",
+        help="Keep the hashes of the files between the runs.")
+    parser.add_argument(
+        "--dependency-cache", dest="dependency_cache", default=False,
+        action="store_true",
+        help="Keep the dependency lists of the compilation commands between "
+             "the runs.")
+    parser.add_argument(
+        "--runs", type=int, dest="runs", default=2,
+        help="Number of runs. The first one uploads every file, the later "
+             "ones find them on the controller.")
+    parser.add_argument(
+        "--workers", type=int, dest="workers", default=16,
+        help="Number of threads of the controller.")
+    parser.add_argument(
+        "-o", "--output", type=str, dest="output", default=None,
+        help="Write the JSON report to this file instead of the standard "
+             "output.")
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if args.tree:
+            database_path = os.path.join(args.tree, "compile_commands.json")
+        else:
+            database_path = generate.generate(
+                os.path.join(temp_dir, "tree"), args.tus,
+                args.headers_per_tu, args.shared_ratio, args.header_size,
+                args.source_size, args.seed)
+
+        port = free_port()
+        start_controller(os.path.join(temp_dir, "workspace"), port,
+                         args.workers)
+
+        command = ["--host", "127.0.0.1", "--port", str(port), "analyze",
+                   "-cdb", database_path, "-j", str(args.jobs),
+                   "--scanner", args.scanner,
+                   "--compression", args.compression]
+        if args.hash_cache:
+            command += ["--hash-cache",
+                        os.path.join(temp_dir, "hash_cache.sqlite")]
+        if args.dependency_cache:
+            command += ["--dependency-cache",
+                        os.path.join(temp_dir, "dependency_cache.sqlite")]
+        client_args = remote_analyze.create_parser().parse_args(command)
+
+        runs = [run_analysis(client_args) for _ in range(args.runs)]
+
+    report = {
+        "timestamp": time.time(),
+        "config": {name: getattr(args, name) for name in
+                   ("tus", "headers_per_tu", "shared_ratio", "header_size",
+                    "source_size", "seed", "tree", "jobs", "scanner",
+                    "compression", "hash_cache", "dependency_cache",
+                    "workers")},
+        "runs": runs,
+    }
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
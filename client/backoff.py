@@ -0,0 +1,82 @@
+"""
+Retries of the requests refused by a busy server.
+"""
+
+import logging
+import random
+import time
+
+from remote_analyze_api.ttypes import ServerBusyException
+
+LOG = logging.getLogger("CLIENT")
+
+DEFAULT_BUSY_RETRIES = 10
+
+# Seconds of the first and of the longest wait before a retry.
+INITIAL_BACKOFF = 1.0
+DEFAULT_MAX_BACKOFF = 300.0
+
+# The wait is lengthened by a random amount of at most this ratio, so the
+# clients refused together do not retry together.
+JITTER = 0.5
+
+
+def backoff_delay(attempt, retry_after, max_backoff=DEFAULT_MAX_BACKOFF):
+    """
+    Returns the seconds to wait before the given retry. The wait doubles
+    with every attempt, but it is never shorter than the retry-after hint of
+    the server.
+    """
+
+    delay = max(retry_after, INITIAL_BACKOFF * 2 ** (attempt - 1))
+    delay = min(delay, max(max_backoff, retry_after))
+
+    return delay * random.uniform(1, 1 + JITTER)
+
+
+class BusyRetryClient:
+    """
+    Forwards the requests to the client of a pooled connection and retries
+    the ones refused with ServerBusyException with jittered exponential
+    backoff. The connection is closed during the wait, so a waiting client
+    does not hold a worker of the server.
+    """
+
+    def __init__(self, pool, connection, retries=DEFAULT_BUSY_RETRIES,
+                 max_backoff=DEFAULT_MAX_BACKOFF, stats=None):
+        self.pool = pool
+        self.connection = connection
+        self.retries = retries
+        self.max_backoff = max_backoff
+        self.stats = stats
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        def call(*args):
+            attempt = 0
+            while True:
+                if self.connection is None:
+                    self.connection = self.pool.acquire()
+
+                try:
+                    return getattr(self.connection.client, name)(*args)
+                except ServerBusyException as busy:
+                    attempt += 1
+                    if attempt > self.retries:
+                        raise
+
+                    delay = backoff_delay(attempt, busy.retryAfterMs / 1000,
+                                          self.max_backoff)
+                    LOG.warning("Server is busy, retry %s in %.1f s: %s",
+                                name, delay, busy.message)
+                    if self.stats is not None:
+                        self.stats.add("busy_retries")
+                        self.stats.record("busy_wait", delay)
+
+                    self.pool.release(self.connection, broken=True)
+                    self.connection = None
+                    time.sleep(delay)
+
+        return call
@@ -0,0 +1,185 @@
+"""
+Pool of long-lived connections to the server.
+"""
+
+import select
+import threading
+import time
+
+from thrift import Thrift
+from thrift.protocol import TBinaryProtocol, TCompactProtocol, TProtocol
+from thrift.transport import TSocket, TTransport
+
+from remote_analyze_api import RemoteAnalyze
+
+PROTOCOLS = {"binary": TBinaryProtocol.TBinaryProtocol,
+             "compact": TCompactProtocol.TCompactProtocol}
+
+DEFAULT_POOL_SIZE = 4
+
+# Seconds an idle connection is kept open. The thread and process engines of
+# the server hold a worker for every open connection, so the idle ones are
+# closed soon.
+DEFAULT_IDLE_TIMEOUT = 5.0
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+
+class Connection:
+    """
+    An open connection to the server and its client.
+    """
+
+    def __init__(self, host, port, framed, protocol):
+        self.socket = TSocket.TSocket(host, port)
+        if framed:
+            self.transport = TTransport.TFramedTransport(self.socket)
+        else:
+            self.transport = TTransport.TBufferedTransport(self.socket)
+        self.client = RemoteAnalyze.Client(
+            PROTOCOLS[protocol](self.transport))
+
+        self.transport.open()
+
+    def is_alive(self):
+        """
+        Returns False if the server closed the idle connection. An idle
+        connection is readable only if it was closed.
+        """
+
+        if self.socket.handle is None:
+            return False
+
+        readable, _, _ = select.select([self.socket.handle], [], [], 0)
+        return not readable
+
+    def close(self):
+        self.transport.close()
+
+
+def is_broken(exception):
+    """
+    Returns True if the connection can not be used after the exception.
+    Exceptions declared by the service leave it in a clean state.
+    """
+
+    return not isinstance(exception, Thrift.TException) or isinstance(
+        exception, (TTransport.TTransportException,
+                    TProtocol.TProtocolException,
+                    Thrift.TApplicationException))
+
+
+class ConnectionPool:
+    """
+    Keeps at most size idle connections to the server for reuse. Threads
+    which need more connections at once open new ones, which are closed when
+    the pool is full. Connections which were closed by the server or broken
+    by a failed request are replaced by new ones. Connections idle for more
+    than idle_timeout seconds are closed by a background thread, so a client
+    waiting between its requests does not hold the workers of the server.
+    """
+
+    def __init__(self, host, port, framed=False, protocol="binary",
+                 size=DEFAULT_POOL_SIZE, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.framed = framed
+        self.protocol = protocol
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.opened = 0
+
+        self._lock = threading.Lock()
+        self._idle = []
+        self._closed = threading.Event()
+        self._reaper = None
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                connection = self._idle.pop()[0] if self._idle else None
+
+            if connection is None:
+                break
+            if connection.is_alive():
+                return connection
+
+            connection.close()
+
+        connection = Connection(self.host, self.port, self.framed,
+                                self.protocol)
+        with self._lock:
+            self.opened += 1
+
+        return connection
+
+    def release(self, connection, broken=False):
+        if not broken and not self._closed.is_set():
+            with self._lock:
+                if len(self._idle) < self.size:
+                    self._idle.append((connection, time.monotonic()))
+                    if self._reaper is None:
+                        self._reaper = threading.Thread(target=self._reap,
+                                                        daemon=True)
+                        self._reaper.start()
+                    return
+
+        connection.close()
+
+    def _reap(self):
+        """
+        Closes the connections idle for more than idle_timeout seconds
+        until the pool is closed.
+        """
+
+        while not self._closed.wait(self.idle_timeout / 2):
+            deadline = time.monotonic() - self.idle_timeout
+
+            with self._lock:
+                expired = [connection for connection, released
+                           in self._idle if released < deadline]
+                self._idle = [(connection, released) for connection, released
+                              in self._idle if released >= deadline]
+
+            for connection in expired:
+                connection.close()
+
+    def close(self):
+        self._closed.set()
+
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for connection, _ in idle:
+            connection.close()
+
+
+def get_pool(host, port, framed=False, protocol="binary",
+             size=DEFAULT_POOL_SIZE):
+    """
+    Returns the pool of the process for the given server and transport.
+    """
+
+    key = (host, port, framed, protocol)
+
+    with _POOLS_LOCK:
+        if key not in _POOLS:
+            _POOLS[key] = ConnectionPool(host, port, framed, protocol, size)
+        return _POOLS[key]
+
+
+def close_pools():
+    """
+    Closes the idle connections of every pool and returns the number of
+    connections opened by them.
+    """
+
+    with _POOLS_LOCK:
+        pools = list(_POOLS.values())
+        _POOLS.clear()
+
+    for pool in pools:
+        pool.close()
+
+    return sum(pool.opened for pool in pools)
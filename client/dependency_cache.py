@@ -0,0 +1,211 @@
+"""
+Persistent cache of the dependency lists of the compilation commands.
+"""
+
+import json
+import os
+import shlex
+import shutil
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache",
+                                  "remote_codechecker", "dependencies.sqlite")
+DEFAULT_MAX_ENTRIES = 100000
+
+# Options whose arguments are directories searched for headers or headers
+# included implicitly.
+INCLUDE_OPTIONS = ["-I", "-isystem", "-iquote", "-idirafter", "-include"]
+
+# Lists are not stored if a file was modified this close to the time of the
+# collection, because a later modification within the resolution of the file
+# system timestamps would not be noticed.
+RACY_INTERVAL_NS = 2 * 1000 * 1000 * 1000
+
+
+def file_stamp(path):
+    """
+    Returns the size and the modification time of the path, or None if it
+    does not exist.
+    """
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def command_arguments(item):
+    """
+    Returns the arguments of the compilation command as a list.
+    """
+
+    command = item.get("arguments", item.get("command"))
+    if isinstance(command, str):
+        command = shlex.split(command)
+
+    return command
+
+
+def include_dirs(arguments, directory):
+    """
+    Returns the paths given to the include options of the command.
+    """
+
+    dirs = []
+
+    for index, argument in enumerate(arguments):
+        for option in INCLUDE_OPTIONS:
+            if argument == option and index + 1 < len(arguments):
+                dirs.append(arguments[index + 1])
+            elif argument.startswith(option) and argument != option and \
+                    option != "-include":
+                dirs.append(argument[len(option):])
+
+    return [os.path.normpath(os.path.join(directory, path)) for path in dirs]
+
+
+class DependencyCache:
+    """
+    Caches the dependency lists of the compilation commands in an SQLite
+    database between runs.
+
+    An entry is keyed by the command, its directory and the path, size and
+    modification time of the compiler. It is used only while every listed
+    file has the same size and modification time, and every directory of
+    the listed files and of the include options has the same modification
+    time, as when the list was collected. A new header in one of these
+    directories changes its modification time, so an include which would
+    resolve to another file is noticed. When the database grows over
+    max_entries, the least recently used entries are evicted on close.
+    """
+
+    def __init__(self, database_path, max_entries=DEFAULT_MAX_ENTRIES,
+                 rescan=False):
+        self.hits = 0
+        self.misses = 0
+        self.max_entries = max_entries
+        self.rescan = rescan
+
+        self._lock = threading.Lock()
+        self._used_entries = set()
+        self._new_entries = {}
+
+        database_dir = os.path.dirname(os.path.abspath(database_path))
+        os.makedirs(database_dir, exist_ok=True)
+
+        self._connection = sqlite3.connect(database_path,
+                                           check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS dependencies ("
+            "key TEXT PRIMARY KEY, files TEXT, stamps TEXT, "
+            "last_access REAL)")
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS dependencies_last_access "
+            "ON dependencies (last_access)")
+
+    def key(self, item):
+        """
+        Returns the key of the compilation command.
+        """
+
+        arguments = command_arguments(item)
+
+        directory = item["directory"]
+        compiler = arguments[0]
+        if os.sep in compiler:
+            compiler = os.path.normpath(os.path.join(directory, compiler))
+        else:
+            compiler = shutil.which(compiler) or compiler
+
+        return json.dumps([arguments, directory, compiler,
+                           file_stamp(compiler)])
+
+    def get(self, item):
+        """
+        Returns the cached dependency list of the compilation command, or
+        None if it has to be collected again.
+        """
+
+        key = self.key(item)
+
+        with self._lock:
+            row = None
+            if not self.rescan:
+                row = self._connection.execute(
+                    "SELECT files, stamps FROM dependencies WHERE key = ?",
+                    (key,)).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return None
+
+        files = json.loads(row[0])
+        stamps = json.loads(row[1])
+
+        if any(file_stamp(path) != stamp for path, stamp in stamps.items()):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+            self._used_entries.add(key)
+
+        return files
+
+    def put(self, item, dependencies):
+        """
+        Stores the dependency list of the compilation command.
+        """
+
+        directory = item["directory"]
+        arguments = command_arguments(item)
+
+        paths = set(dependencies)
+        paths.update(os.path.dirname(path) for path in dependencies)
+        paths.update(include_dirs(arguments, directory))
+
+        stamps = {path: file_stamp(path) for path in paths}
+
+        now = time.time_ns()
+        if any(stamp is not None and now - stamp[1] < RACY_INTERVAL_NS
+               for stamp in stamps.values()):
+            return
+
+        with self._lock:
+            self._new_entries[self.key(item)] = (dependencies, stamps)
+
+    def close(self):
+        """
+        Stores the new lists and the access times in the database and evicts
+        the least recently used entries over the size limit.
+        """
+
+        if self._connection is None:
+            return
+
+        now = time.time()
+
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO dependencies "
+                "(key, files, stamps, last_access) VALUES (?, ?, ?, ?)",
+                ((key, json.dumps(files), json.dumps(stamps), now)
+                 for key, (files, stamps) in self._new_entries.items()))
+
+            self._connection.executemany(
+                "UPDATE dependencies SET last_access = ? WHERE key = ?",
+                ((now, key) for key in self._used_entries
+                 if key not in self._new_entries))
+
+            self._connection.execute(
+                "DELETE FROM dependencies WHERE key IN ("
+                "SELECT key FROM dependencies ORDER BY last_access DESC "
+                "LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+        self._connection.close()
+        self._connection = None
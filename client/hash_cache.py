@@ -0,0 +1,139 @@
+"""
+Persistent cache of the hashes of the files sent to the remote analysis.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache",
+                                  "remote_codechecker", "file_hashes.sqlite")
+DEFAULT_MAX_ENTRIES = 1000000
+
+READ_CHUNK_SIZE = 1024 * 1024
+
+# Files modified this close to the time of hashing are not stored, because a
+# later modification within the resolution of the file system timestamps
+# would not be noticed.
+RACY_INTERVAL_NS = 2 * 1000 * 1000 * 1000
+
+
+def hash_file(file_path):
+    """
+    Returns the MD5 hash of the given file without reading it to memory at
+    once.
+    """
+
+    md5 = hashlib.md5()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(READ_CHUNK_SIZE), b""):
+            md5.update(chunk)
+
+    return md5.hexdigest()
+
+
+class FileHashCache:
+    """
+    Caches the MD5 hashes of files for the current run and optionally in an
+    SQLite database between runs.
+
+    A stored hash is used only while the size, the modification time and the
+    inode of the file are the same as they were at the time of hashing,
+    otherwise the file is hashed again and the entry is replaced. When the
+    database grows over max_entries, the least recently used entries are
+    evicted on close.
+    """
+
+    def __init__(self, database_path=None, max_entries=DEFAULT_MAX_ENTRIES):
+        self.hits = 0
+        self.misses = 0
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        self._hashes = {}
+        self._new_entries = {}
+        self._used_entries = set()
+        self._connection = None
+
+        if database_path:
+            database_dir = os.path.dirname(os.path.abspath(database_path))
+            os.makedirs(database_dir, exist_ok=True)
+
+            self._connection = sqlite3.connect(database_path,
+                                               check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS file_hashes ("
+                "path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, "
+                "inode INTEGER, hash TEXT, last_access REAL)")
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS file_hashes_last_access "
+                "ON file_hashes (last_access)")
+
+    def get_hash(self, file_path):
+        """
+        Returns the MD5 hash of the given file.
+        """
+
+        stat = os.stat(file_path)
+        key = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+        with self._lock:
+            cached = self._hashes.get(file_path)
+
+            if cached is None and self._connection is not None:
+                row = self._connection.execute(
+                    "SELECT size, mtime, inode, hash FROM file_hashes "
+                    "WHERE path = ?", (file_path,)).fetchone()
+                if row is not None:
+                    cached = (tuple(row[:3]), row[3])
+                    self._used_entries.add(file_path)
+
+            if cached is not None and cached[0] == key:
+                self._hashes[file_path] = cached
+                self.hits += 1
+                return cached[1]
+
+        hashing_started = time.time_ns()
+        file_hash = hash_file(file_path)
+
+        with self._lock:
+            self.misses += 1
+            self._hashes[file_path] = (key, file_hash)
+            if hashing_started - stat.st_mtime_ns > RACY_INTERVAL_NS:
+                self._new_entries[file_path] = (key, file_hash)
+
+        return file_hash
+
+    def close(self):
+        """
+        Stores the new hashes and the access times in the database and evicts
+        the least recently used entries over the size limit.
+        """
+
+        if self._connection is None:
+            return
+
+        now = time.time()
+
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO file_hashes "
+                "(path, size, mtime, inode, hash, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                ((path, key[0], key[1], key[2], file_hash, now)
+                 for path, (key, file_hash) in self._new_entries.items()))
+
+            self._connection.executemany(
+                "UPDATE file_hashes SET last_access = ? WHERE path = ?",
+                ((now, path) for path in self._used_entries
+                 if path not in self._new_entries))
+
+            self._connection.execute(
+                "DELETE FROM file_hashes WHERE path IN ("
+                "SELECT path FROM file_hashes ORDER BY last_access DESC "
+                "LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+        self._connection.close()
+        self._connection = None
@@ -0,0 +1,567 @@
+"""
+Collection of the dependencies of compilation commands by scanning the
+#include directives of the sources instead of preprocessing them.
+"""
+
+import logging
+import os
+import re
+import shlex
+import subprocess
+import threading
+
+import tu_collector
+
+LOG = logging.getLogger("CLIENT")
+
+DIRECTIVE_PATTERN = re.compile(
+    r"^[ \t]*#[ \t]*(include_next|include|import|ifdef|ifndef|if|elif|else|"
+    r"endif|define|undef)\b(.*)$", re.MULTILINE)
+COMMENT_PATTERN = re.compile(r"/\*.*?\*/|//[^\n]*", re.DOTALL)
+TOKEN_PATTERN = re.compile(
+    r"\s*((?:0[xX][0-9a-fA-F]+|\d+)[uUlL]*|[A-Za-z_]\w*|&&|\|\||==|!=|<=|>=|"
+    r"[()!<>+\-])")
+INTEGER_PATTERN = re.compile(r"^(0[xX][0-9a-fA-F]+|\d+)[uUlL]*$")
+
+# Options with a separate or attached argument which change the search
+# path of the headers.
+PATH_OPTIONS = ["-I", "-isystem", "-iquote", "-idirafter", "-include"]
+
+# Options which are passed to the compiler when its default search path and
+# predefined macros are asked.
+PROBE_OPTIONS = ["-std=", "-stdlib=", "--sysroot", "-isysroot", "--target",
+                 "-target", "--gcc-toolchain", "-m32", "-m64", "-nostdinc"]
+
+SEARCH_START = "#include <...> search starts here:"
+SEARCH_END = "End of search list."
+
+
+def command_arguments(item):
+    command = item.get("arguments", item.get("command"))
+    if isinstance(command, str):
+        command = shlex.split(command)
+
+    return command
+
+
+class ConditionEvaluator:
+    """
+    Evaluates simple #if conditions to True, False or None if the result is
+    not known. defined(), !, &&, ||, comparisons, + and - of integers and of
+    macros defined as integers are supported.
+    """
+
+    def __init__(self, macros, unknown_macros):
+        self.macros = macros
+        self.unknown_macros = unknown_macros
+        self.tokens = []
+        self.position = 0
+
+    def evaluate(self, expression):
+        if "__has_include" in expression or "?" in expression:
+            return None
+
+        self.tokens = []
+        position = 0
+        expression = expression.strip()
+        while position < len(expression):
+            match = TOKEN_PATTERN.match(expression, position)
+            if not match or match.end() == position:
+                return None
+            self.tokens.append(match.group(1))
+            position = match.end()
+        self.position = 0
+
+        try:
+            value = self._or()
+        except (IndexError, ValueError):
+            return None
+
+        if self.position != len(self.tokens) or value is None:
+            return None
+
+        return bool(value)
+
+    def _peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def _next(self):
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def _or(self):
+        value = self._and()
+        while self._peek() == "||":
+            self._next()
+            other = self._and()
+            if value or other:
+                value = 1
+            elif value is None or other is None:
+                value = None
+            else:
+                value = 0
+        return value
+
+    def _and(self):
+        value = self._compare()
+        while self._peek() == "&&":
+            self._next()
+            other = self._compare()
+            if value == 0 or other == 0:
+                value = 0
+            elif value is None or other is None:
+                value = None
+            else:
+                value = 1
+        return value
+
+    def _compare(self):
+        value = self._add()
+        operator = self._peek()
+        if operator in ("==", "!=", "<", ">", "<=", ">="):
+            self._next()
+            other = self._add()
+            if value is None or other is None:
+                return None
+            return int({"==": value == other, "!=": value != other,
+                        "<": value < other, ">": value > other,
+                        "<=": value <= other,
+                        ">=": value >= other}[operator])
+        return value
+
+    def _add(self):
+        value = self._unary()
+        while self._peek() in ("+", "-"):
+            operator = self._next()
+            other = self._unary()
+            if value is None or other is None:
+                value = None
+            elif operator == "+":
+                value += other
+            else:
+                value -= other
+        return value
+
+    def _unary(self):
+        token = self._peek()
+        if token == "!":
+            self._next()
+            value = self._unary()
+            return None if value is None else int(not value)
+        if token == "-":
+            self._next()
+            value = self._unary()
+            return None if value is None else -value
+        return self._primary()
+
+    def _primary(self):
+        token = self._next()
+
+        if token == "(":
+            value = self._or()
+            if self._next() != ")":
+                raise ValueError(token)
+            return value
+
+        if token == "defined":
+            name = self._next()
+            if name == "(":
+                name = self._next()
+                if self._next() != ")":
+                    raise ValueError(token)
+            if name in self.unknown_macros:
+                return None
+            return int(name in self.macros)
+
+        if INTEGER_PATTERN.match(token):
+            return int(INTEGER_PATTERN.match(token).group(1), 0)
+
+        if token[0].isalpha() or token[0] == "_":
+            if self._peek() == "(":
+                return None
+            return self._macro_value(token, 0)
+
+        raise ValueError(token)
+
+    def _macro_value(self, name, depth):
+        if name in self.unknown_macros or depth > 10:
+            return None
+        if name not in self.macros:
+            return 0
+
+        value = self.macros[name].strip()
+        if INTEGER_PATTERN.match(value):
+            return int(INTEGER_PATTERN.match(value).group(1), 0)
+        if re.match(r"^[A-Za-z_]\w*$", value):
+            return self._macro_value(value, depth + 1)
+        return None
+
+
+class IncludeScanner:
+    """
+    Collects the files of a translation unit by following its #include
+    directives along the search path of the compiler.
+
+    The default search path and the predefined macros are asked from the
+    compiler once per compiler and language options. The directives of every
+    header are parsed once and shared between the translation units, as are
+    the resolved includes. Branches of conditions which can not be
+    evaluated are followed both, so the result may contain more files than
+    the compiler would use.
+
+    The scanner is unsure if an include is computed by a macro or can not be
+    found in a branch which is known to be compiled. In that case the
+    compiler is asked instead if it is available.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._directives = {}
+        self._probes = {}
+        self._resolved = {}
+
+    def get_dependencies(self, item):
+        """
+        Returns the list of the files of the translation unit and whether the
+        scanner is sure that it is complete.
+        """
+
+        arguments = command_arguments(item)
+        directory = item["directory"]
+        source = os.path.normpath(os.path.join(directory, item["file"]))
+
+        quote_dirs, bracket_dirs, forced_includes, macros = \
+            self._parse_arguments(arguments, directory, source)
+
+        default_dirs, predefined_macros, probe_ok = \
+            self._probe(arguments, source)
+
+        all_macros = dict(predefined_macros)
+        all_macros.update(macros)
+
+        chain = bracket_dirs[0] + default_dirs + bracket_dirs[1]
+
+        state = {"visited": set(), "dependencies": [], "sure": True,
+                 "macros": {name: value for name, value in all_macros.items()
+                            if value is not None},
+                 "unknown": set(),
+                 "chain": tuple(chain),
+                 "quote_dirs": tuple(quote_dirs)}
+
+        # GCC and Clang on Linux include it implicitly in hosted mode.
+        if "-ffreestanding" not in arguments and \
+                "-nostdinc" not in arguments:
+            self._include("include", "<stdc-predef.h>", source, None, False,
+                          state)
+
+        for forced_include in forced_includes:
+            path = os.path.normpath(os.path.join(directory, forced_include))
+            if os.path.isfile(path):
+                self._visit(path, None, state)
+            else:
+                self._include("include", forced_include, source, None, True,
+                              state)
+
+        self._visit(source, None, state)
+
+        # Without the default search path of the compiler the includes
+        # found in it are missing, so the scan is not complete.
+        return state["dependencies"], state["sure"] and probe_ok
+
+    def _parse_arguments(self, arguments, directory, source):
+        quote_dirs = []
+        include_dirs = []
+        system_dirs = []
+        after_dirs = []
+        forced_includes = []
+        macros = {}
+
+        targets = {"-iquote": quote_dirs, "-I": include_dirs,
+                   "-isystem": system_dirs, "-idirafter": after_dirs,
+                   "-include": forced_includes}
+
+        index = 1
+        while index < len(arguments):
+            argument = arguments[index]
+            index += 1
+
+            for option in PATH_OPTIONS:
+                if argument == option and index < len(arguments):
+                    value = arguments[index]
+                    index += 1
+                elif argument.startswith(option) and option != "-include":
+                    value = argument[len(option):]
+                else:
+                    continue
+
+                if option != "-include":
+                    value = os.path.normpath(os.path.join(directory, value))
+                targets[option].append(value)
+                break
+            else:
+                if argument in ("-D", "-U") and index < len(arguments):
+                    argument += arguments[index]
+                    index += 1
+
+                if argument.startswith("-D"):
+                    name, separator, value = argument[2:].partition("=")
+                    macros[name] = value if separator else "1"
+                elif argument.startswith("-U"):
+                    macros[argument[2:]] = None
+
+        return (quote_dirs, (include_dirs + system_dirs, after_dirs),
+                forced_includes, macros)
+
+    def _probe(self, arguments, source):
+        """
+        Returns the default search path and the predefined macros of the
+        compiler for the language options of the command, and whether the
+        compiler could be asked.
+        """
+
+        language = "c" if source.endswith(".c") else "c++"
+        options = []
+        for index, argument in enumerate(arguments[1:], 1):
+            if argument == "-x" and index + 1 < len(arguments):
+                language = arguments[index + 1]
+            elif any(argument.startswith(option) for option in PROBE_OPTIONS):
+                options.append(argument)
+
+        key = (arguments[0], language, tuple(options))
+
+        with self._lock:
+            if key in self._probes:
+                return self._probes[key]
+
+        command = [arguments[0], "-x", language, "-E", "-dM", "-v"] + \
+            options + [os.devnull]
+
+        try:
+            process = subprocess.run(command, stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE,
+                                     stdin=subprocess.DEVNULL,
+                                     encoding="utf-8", errors="replace")
+        except OSError as os_error:
+            LOG.warning("Compiler %s can not be asked for its search path: "
+                        "%s", arguments[0], os_error)
+            probe = ([], {}, False)
+        else:
+            default_dirs = []
+            in_search_list = False
+            for line in process.stderr.splitlines():
+                if line.startswith(SEARCH_START):
+                    in_search_list = True
+                elif line.startswith(SEARCH_END):
+                    in_search_list = False
+                elif in_search_list:
+                    path = line.strip().replace(" (framework directory)", "")
+                    default_dirs.append(os.path.normpath(path))
+
+            predefined_macros = {}
+            for line in process.stdout.splitlines():
+                parts = line.split(None, 2)
+                if len(parts) >= 2 and parts[0] == "#define":
+                    predefined_macros[parts[1]] = \
+                        parts[2] if len(parts) > 2 else ""
+
+            probe = (default_dirs, predefined_macros,
+                     process.returncode == 0)
+
+        with self._lock:
+            self._probes[key] = probe
+
+        return probe
+
+    def _parse(self, path):
+        """
+        Returns the preprocessor directives of the file as (name, argument)
+        pairs.
+        """
+
+        with self._lock:
+            directives = self._directives.get(path)
+        if directives is not None:
+            return directives
+
+        try:
+            with open(path, encoding="utf-8", errors="replace") as source:
+                text = source.read()
+        except OSError:
+            text = ""
+
+        text = text.replace("\\\n", "")
+        if "/*" in text or "//" in text:
+            text = COMMENT_PATTERN.sub(" ", text)
+
+        directives = [(match.group(1), match.group(2).strip())
+                      for match in DIRECTIVE_PATTERN.finditer(text)]
+
+        with self._lock:
+            self._directives[path] = directives
+
+        return directives
+
+    def _visit(self, path, chain_index, state):
+        if path in state["visited"]:
+            return
+
+        state["visited"].add(path)
+        state["dependencies"].append(path)
+
+        # Stack of (branch compiled, any branch taken) of the conditions.
+        # None means the condition is not known.
+        conditions = []
+        evaluator = ConditionEvaluator(state["macros"], state["unknown"])
+
+        for name, argument in self._parse(path):
+            active = True
+            for compiled, _ in conditions:
+                if compiled is False:
+                    active = False
+                    break
+                if compiled is None:
+                    active = None
+
+            if name in ("ifdef", "ifndef", "if"):
+                if active is False:
+                    conditions.append((False, True))
+                    continue
+
+                if name == "if":
+                    compiled = evaluator.evaluate(argument)
+                else:
+                    macro = argument.split()[0] if argument else ""
+                    compiled = None if macro in state["unknown"] else \
+                        (macro in state["macros"]) == (name == "ifdef")
+                conditions.append((compiled, compiled))
+            elif name == "elif" and conditions:
+                _, taken = conditions[-1]
+                if taken is True:
+                    conditions[-1] = (False, True)
+                else:
+                    compiled = evaluator.evaluate(argument)
+                    if taken is None and compiled is not False:
+                        compiled = None
+                    conditions[-1] = (compiled,
+                                      True if compiled else
+                                      None if compiled is None else taken)
+            elif name == "else" and conditions:
+                _, taken = conditions[-1]
+                conditions[-1] = (None if taken is None else not taken, True)
+            elif name == "endif" and conditions:
+                conditions.pop()
+            elif active is False:
+                continue
+            elif name in ("define", "undef"):
+                parts = argument.split(None, 1)
+                if not parts:
+                    continue
+                macro = re.match(r"[A-Za-z_]\w*", parts[0])
+                if not macro:
+                    continue
+                macro = macro.group(0)
+
+                if active is None:
+                    state["unknown"].add(macro)
+                elif name == "define":
+                    state["unknown"].discard(macro)
+                    state["macros"][macro] = \
+                        parts[1] if len(parts) > 1 and \
+                        parts[0] == macro else ""
+                else:
+                    state["unknown"].discard(macro)
+                    state["macros"].pop(macro, None)
+            elif name in ("include", "include_next", "import"):
+                self._include(name, argument, path, chain_index,
+                              active is True, state)
+
+    def _include(self, directive, argument, includer, chain_index, compiled,
+                 state):
+        if len(argument) < 2 or argument[0] not in "<\"" or \
+                argument[-1] != {"<": ">", "\"": "\""}[argument[0]]:
+            if compiled:
+                LOG.debug("Computed include %s in %s.", argument, includer)
+                state["sure"] = False
+            return
+
+        name = argument[1:-1]
+        chain = state["chain"]
+
+        if directive == "include_next" and chain_index is not None:
+            search = [(index, chain[index])
+                      for index in range(chain_index + 1, len(chain))]
+        else:
+            search = []
+            if argument[0] == "\"":
+                search.append((None, os.path.dirname(includer)))
+                search.extend((None, path) for path in state["quote_dirs"])
+            search.extend(enumerate(chain))
+
+        key = (name, tuple(search))
+        with self._lock:
+            resolved = self._resolved.get(key)
+
+        if resolved is None:
+            resolved = (None, None)
+            for index, include_dir in search:
+                candidate = os.path.normpath(os.path.join(include_dir, name))
+                if os.path.isfile(candidate):
+                    resolved = (candidate, index)
+                    break
+
+            with self._lock:
+                self._resolved[key] = resolved
+
+        path, index = resolved
+
+        if path is None:
+            if compiled:
+                LOG.debug("Include %s of %s is not found.", argument,
+                          includer)
+                state["sure"] = False
+            return
+
+        self._visit(path, index, state)
+
+
+SCANNER = IncludeScanner()
+
+
+def get_dependencies(item, mode="builtin"):
+    """
+    Returns the list of the files of the translation unit and whether they
+    were collected without errors.
+
+    builtin -- The includes are scanned and the compiler is asked only when
+               the scanner is unsure.
+    verify -- Both the scanner and the compiler are used, the differences
+              are logged and the result of the compiler is returned.
+    """
+
+    dependencies, sure = SCANNER.get_dependencies(item)
+
+    if mode == "builtin" and sure:
+        return dependencies, True
+
+    compiled, error = tu_collector.get_dependent_headers(
+        list(command_arguments(item)), item["directory"])
+    if error:
+        LOG.error("Error output: %s", error)
+
+    if mode == "verify":
+        scanned = {os.path.realpath(path) for path in dependencies}
+        expected = {os.path.realpath(path) for path in compiled}
+
+        if scanned != expected:
+            LOG.warning("Scanned dependencies of %s differ from the compiler."
+                        " Missing: %s Extra: %s", item["file"],
+                        sorted(expected - scanned),
+                        sorted(scanned - expected))
+    else:
+        LOG.debug("Scanner is unsure about %s, the compiler is used.",
+                  item["file"])
+
+    return list(compiled), not error
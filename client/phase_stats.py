@@ -0,0 +1,96 @@
+"""
+Timing of the phases of the client and counters of the transferred bytes.
+"""
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+
+def percentile(sorted_values, ratio):
+    """
+    Returns the value below which the given ratio of the sorted values are.
+    """
+
+    if not sorted_values:
+        return 0.0
+
+    index = min(int(ratio * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+class PhaseStats:
+    """
+    Records the duration of every run of the phases of the client and sums
+    its counters. Phases may run on several threads at once.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._durations = {}
+        self._counters = {}
+
+    @contextmanager
+    def measure(self, phase):
+        """
+        Records the time spent in the block as a run of the phase.
+        """
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(phase, time.perf_counter() - started)
+
+    def measure_iterator(self, phase, iterator):
+        """
+        Yields the items of the iterator and records the time of producing
+        each of them as a run of the phase.
+        """
+
+        iterator = iter(iterator)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+
+            self.record(phase, time.perf_counter() - started)
+            yield item
+
+    def record(self, phase, seconds):
+        with self._lock:
+            self._durations.setdefault(phase, []).append(seconds)
+
+    def add(self, counter, amount=1):
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + amount
+
+    def report(self):
+        """
+        Returns the number of runs, the total, mean, median, 99th percentile
+        and maximum seconds of every phase and the counters.
+        """
+
+        with self._lock:
+            durations = {phase: sorted(values)
+                         for phase, values in self._durations.items()}
+            counters = dict(self._counters)
+
+        phases = {}
+        for phase, values in durations.items():
+            total = sum(values)
+            phases[phase] = {"count": len(values),
+                             "total": total,
+                             "mean": total / len(values),
+                             "p50": percentile(values, 0.5),
+                             "p99": percentile(values, 0.99),
+                             "max": values[-1]}
+
+        return {"phases": phases, "counters": counters}
+
+    def write(self, path):
+        with open(path, "w") as stats_file:
+            json.dump(self.report(), stats_file, indent=2, sort_keys=True)
@@ -0,0 +1,173 @@
+"""
+Stages of worker threads connected by bounded queues.
+"""
+
+import queue
+import threading
+
+# Seconds between two checks of the failure of another stage while a worker
+# waits for its queue.
+POLL_INTERVAL = 0.1
+
+_DONE = object()
+
+
+class Stage:
+    """
+    A step of the pipeline run by the given number of threads.
+
+    function is called with every item, or with a list of at most
+    batch_size items if batch_size is given, and returns the list of the
+    items passed to the next stage. A batch is formed from the items which
+    are already waiting, so it grows only when the stage falls behind.
+    """
+
+    def __init__(self, name, function, workers=1, batch_size=None):
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.batch_size = batch_size
+
+
+class Pipeline:
+    """
+    Feeds the items of a source through the stages. The queues between the
+    stages hold at most queue_size items, so a slow stage holds back the
+    earlier ones and the number of items in flight stays bounded.
+
+    If a stage raises an exception, every stage stops and run raises it.
+    """
+
+    def __init__(self, stages, queue_size):
+        self.stages = stages
+        self.queue_size = queue_size
+
+        self._failed = threading.Event()
+        self._error = None
+        self._left = 0
+        self._lock = threading.Lock()
+
+    def run(self, source):
+        """
+        Runs the pipeline until the source is exhausted and every item has
+        passed the stages. Returns the number of items which left the last
+        stage.
+        """
+
+        queues = [queue.Queue(self.queue_size)
+                  for _ in range(len(self.stages) + 1)]
+        self._left = 0
+
+        threads = [threading.Thread(target=self._feed,
+                                    args=(source, queues[0]),
+                                    name="pipeline-source", daemon=True)]
+
+        for index, stage in enumerate(self.stages):
+            remaining = [stage.workers]
+            for worker in range(stage.workers):
+                threads.append(threading.Thread(
+                    target=self._work,
+                    args=(stage, queues[index], queues[index + 1],
+                          remaining),
+                    name="pipeline-%s-%d" % (stage.name, worker),
+                    daemon=True))
+
+        threads.append(threading.Thread(target=self._drain,
+                                        args=(queues[-1],),
+                                        name="pipeline-sink", daemon=True))
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if self._error is not None:
+            raise self._error
+
+        return self._left
+
+    def _fail(self, error):
+        with self._lock:
+            if self._error is None:
+                self._error = error
+        self._failed.set()
+
+    def _put(self, target, item):
+        while not self._failed.is_set():
+            try:
+                target.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def _get(self, source):
+        while not self._failed.is_set():
+            try:
+                return source.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                pass
+
+        return _DONE
+
+    def _feed(self, source, target):
+        try:
+            for item in source:
+                if not self._put(target, item):
+                    return
+        except Exception as error:
+            self._fail(error)
+            return
+
+        self._put(target, _DONE)
+
+    def _work(self, stage, source, target, remaining):
+        try:
+            while True:
+                item = self._get(source)
+                if item is _DONE:
+                    break
+
+                if stage.batch_size is None:
+                    outputs = stage.function(item)
+                else:
+                    batch = [item]
+                    while len(batch) < stage.batch_size:
+                        try:
+                            item = source.get_nowait()
+                        except queue.Empty:
+                            break
+                        if item is _DONE:
+                            source.put(_DONE)
+                            break
+                        batch.append(item)
+
+                    outputs = stage.function(batch)
+
+                for output in outputs or []:
+                    if not self._put(target, output):
+                        return
+        except Exception as error:
+            self._fail(error)
+            return
+
+        if self._failed.is_set():
+            return
+
+        # The other workers of the stage are stopped by the same marker and
+        # the last one passes it on.
+        source.put(_DONE)
+        with self._lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            self._put(target, _DONE)
+
+    def _drain(self, source):
+        while True:
+            item = self._get(source)
+            if item is _DONE:
+                return
+            with self._lock:
+                self._left += 1
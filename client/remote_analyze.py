@@ -1,24 +1,44 @@
 #!/usr/bin/env python3
 
 import argparse
-import hashlib
+import collections
+import functools
+import io
 import json
 import logging
 import os
 import sys
 import subprocess
 import tempfile
+import time
 import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import as_completed
 from contextlib import AbstractContextManager
 
 from thrift import Thrift
-from thrift.protocol import TBinaryProtocol
-from thrift.transport import TSocket, TTransport
+from thrift.transport import TTransport
 
+import include_scanner
 import tu_collector
-from remote_analyze_api import RemoteAnalyze
+import dependency_cache as dep_cache
+from backoff import DEFAULT_BUSY_RETRIES, DEFAULT_MAX_BACKOFF, BusyRetryClient
+from connection_pool import DEFAULT_POOL_SIZE, PROTOCOLS, close_pools
+from connection_pool import get_pool, is_broken
+from dependency_cache import DependencyCache
+from hash_cache import DEFAULT_CACHE_PATH, DEFAULT_MAX_ENTRIES, FileHashCache
+from hash_cache import hash_file
+from phase_stats import PhaseStats
+from pipeline import Pipeline, Stage
+from shard_router import get_router, parse_controllers
+from zip_compression import AUTO, CODECS, Compression
 from remote_analyze_api.ttypes import AnalysisNotFoundException
 from remote_analyze_api.ttypes import AnalysisNotCompletedException
+from remote_analyze_api.ttypes import AnalysisFilter
+from remote_analyze_api.ttypes import AnalysisOptions
+from remote_analyze_api.ttypes import Priority
+from remote_analyze_api.ttypes import ReportFilter
+from remote_analyze_api.ttypes import UploadKind
 
 LOG = logging.getLogger("CLIENT")
 LOG.setLevel(logging.INFO)
@@ -29,34 +49,481 @@ FORMATTER = logging.Formatter(
 CH.setFormatter(FORMATTER)
 LOG.addHandler(CH)
 
+# Number of hashes asked from the server in one checkUploadedFiles call.
+CHECK_BATCH_SIZE = 10000
+
+# Maximum number of parts whose files are checked and uploaded together.
+CHECK_BATCH_PARTS = 256
+
+# Number of compilation commands collected ahead of the consumer.
+DEFAULT_COLLECT_WINDOW = 64
+
+# Number of analyses asked in one getStatuses call.
+STATUS_BATCH_SIZE = 10000
+
+# Time of one long poll of the status of an analysis. The server waits at
+# most 20 seconds.
+WAIT_TIMEOUT_MS = 20 * 1000
+
+# Time of the phases and transferred bytes of the current command.
+STATS = PhaseStats()
+
 
 class RemoteAnalayzerClient(AbstractContextManager):
-    def __init__(self, host, port):
-        self.transport = TSocket.TSocket(host, port)
-        self.transport = TTransport.TBufferedTransport(self.transport)
-        self.protocol = TBinaryProtocol.TBinaryProtocol(self.transport)
+    """
+    Lends a client of a pooled connection to the server for the block. The
+    requests refused by a busy server are retried.
+    """
+
+    def __init__(self, host, port, framed=False, protocol="binary",
+                 pool_size=DEFAULT_POOL_SIZE,
+                 busy_retries=DEFAULT_BUSY_RETRIES,
+                 max_backoff=DEFAULT_MAX_BACKOFF):
+        self.pool = get_pool(host, port, framed, protocol, pool_size)
+        self.busy_retries = busy_retries
+        self.max_backoff = max_backoff
+        self.client = None
 
     def __enter__(self):
-        client = RemoteAnalyze.Client(self.protocol)
-        self.transport.open()
-        return client
+        self.client = BusyRetryClient(self.pool, self.pool.acquire(),
+                                      self.busy_retries, self.max_backoff,
+                                      STATS)
+        return self.client
 
-    def __exit__(self, *exc_details):
-        self.transport.close()
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.client.connection is not None:
+            self.pool.release(self.client.connection,
+                              exc_value is not None and is_broken(exc_value))
 
 
-def analyze(args):
+def connect(args, analysis_id=None):
+    """
+    Returns a client context of the server given by the arguments. With a
+    list of controllers, the requests of the given analysis are sent to the
+    controller of its shard and the others to the least loaded controller.
     """
-    This method tries to collect files based on the build command for the
-    remote analysis with tu_collector script to a zip file.
 
-    If it was success it calls server's getId method to get an UUID for the
-    analysis.
+    host, port = args.host, args.port
+    if getattr(args, "controllers", None):
+        host, port = get_router(args.controllers, args.framed, args.protocol,
+                                args.connections).route(analysis_id)
+
+    return RemoteAnalayzerClient(host, port, args.framed, args.protocol,
+                                 args.connections, args.busy_retries,
+                                 args.max_backoff)
 
-    Then the script saves the zip file to the workspace/{received-uuid}
-    directory.
+
+def collect_dependencies_with_subprocess(item):
+    """
+    Collects the dependencies of a compilation command by running the
+    tu_collector script in a separate interpreter. Returns the list of the
+    dependencies and whether they were collected without errors.
     """
 
+    with tempfile.NamedTemporaryFile("w", suffix=".json") as current_item, \
+            tempfile.NamedTemporaryFile() as list_of_dependecies:
+        json.dump([item], current_item)
+        current_item.flush()
+
+        command = ["python3", tu_collector.__file__]
+        command.append("-l")
+        command.append("%s" % current_item.name)
+        command.append("-ld")
+        command.append("%s" % list_of_dependecies.name)
+
+        process = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+
+        LOG.debug(command)
+
+        stdout, stderr = process.communicate()
+        returncode = process.wait()
+
+        LOG.debug('Standard output: %s', stdout)
+
+        if returncode != 0:
+            LOG.error('Error output: %s', stderr)
+
+        LOG.debug("List temp file %s", list_of_dependecies.name)
+
+        with open(list_of_dependecies.name) as dependencies:
+            return json.load(dependencies), returncode == 0
+
+
+def collect_dependencies_in_process(item):
+    """
+    Collects the dependencies of a compilation command by calling tu_collector
+    directly. Returns the list of the dependencies and whether they were
+    collected without errors.
+    """
+
+    dependencies, error = tu_collector.get_dependent_headers(
+        item["command"], item["directory"])
+
+    if error:
+        LOG.error('Error output: %s', error)
+
+    return list(dependencies), not error
+
+
+def collect_dependencies_with_scanner(item, mode):
+    """
+    Collects the dependencies of a compilation command with the built-in
+    include scanner.
+    """
+
+    return include_scanner.get_dependencies(item, mode)
+
+
+def collect_dependencies(compilation_commands, jobs=None, pool="thread",
+                         dependency_cache=None, scanner="compiler",
+                         window=DEFAULT_COLLECT_WINDOW):
+    """
+    Generates (compilation command, list of dependencies) pairs in the order
+    of the compilation commands.
+
+    If jobs is None every compilation command is handled by a separate
+    tu_collector process one after the other. Otherwise tu_collector is called
+    in-process on a thread or process pool with the given number of workers.
+    With the builtin or verify scanner the includes are scanned in-process
+    instead. Compilation commands whose dependencies are in the dependency
+    cache are not collected again.
+
+    The compilation commands are looked up in the cache and submitted to the
+    pool one by one, and at most window of them are in flight, so a consumer
+    which falls behind holds back the collection.
+    """
+
+    if scanner == "compiler":
+        collect = collect_dependencies_in_process
+    else:
+        collect = functools.partial(collect_dependencies_with_scanner,
+                                    mode=scanner)
+
+    if jobs is None:
+        for item in compilation_commands:
+            dependencies = _cached_dependencies(dependency_cache, item)
+            if dependencies is None:
+                if scanner == "compiler":
+                    collected = collect_dependencies_with_subprocess(item)
+                else:
+                    collected = collect(item)
+                dependencies = _store_dependencies(dependency_cache, item,
+                                                   *collected)
+
+            yield item, dependencies
+        return
+
+    if pool == "process":
+        executor = ProcessPoolExecutor(max_workers=jobs)
+    else:
+        executor = ThreadPoolExecutor(max_workers=jobs)
+
+    in_flight = collections.deque()
+
+    with executor:
+        for item in compilation_commands:
+            dependencies = _cached_dependencies(dependency_cache, item)
+            future = executor.submit(collect, item) \
+                if dependencies is None else None
+            in_flight.append((item, dependencies, future))
+
+            if len(in_flight) >= max(window, jobs):
+                yield _collected(dependency_cache, *in_flight.popleft())
+
+        while in_flight:
+            yield _collected(dependency_cache, *in_flight.popleft())
+
+
+def _cached_dependencies(dependency_cache, item):
+    if dependency_cache is None:
+        return None
+
+    return dependency_cache.get(item)
+
+
+def _store_dependencies(dependency_cache, item, dependencies, succeeded):
+    if succeeded and dependency_cache is not None:
+        dependency_cache.put(item, dependencies)
+
+    return dependencies
+
+
+def _collected(dependency_cache, item, dependencies, future):
+    if future is not None:
+        dependencies = _store_dependencies(dependency_cache, item,
+                                           *future.result())
+
+    return item, dependencies
+
+
+def hash_dependencies(dependencies, hash_cache):
+    """
+    Returns a dict of the hashes and paths of the given dependencies.
+    """
+
+    files_and_hashes = {}
+
+    for file_name in dependencies:
+        readable_hash = hash_cache.get_hash(file_name)
+        files_and_hashes[readable_hash] = file_name
+
+    return files_and_hashes
+
+
+def check_uploaded_files(args, file_hashes):
+    """
+    Returns the set of the given hashes which are not available on the server.
+    """
+
+    file_hashes = list(file_hashes)
+    missing_files = set()
+
+    with connect(args) as client:
+        for index in range(0, len(file_hashes), CHECK_BATCH_SIZE):
+            missing_files.update(client.checkUploadedFiles(
+                file_hashes[index:index + CHECK_BATCH_SIZE]))
+
+    return missing_files
+
+
+def upload_file(args, file_path, kind, analyze_id="", compression=None):
+    """
+    Uploads the given file to the server in chunks without reading it to
+    memory at once. If the connection breaks, the upload is continued from
+    the last offset received by the server. The measured bandwidth is
+    reported to the compression if it is given.
+    """
+
+    started = time.monotonic()
+    checksum = hash_file(file_path)
+    chunk_size = args.chunk_size * 1024 * 1024
+    phase = "upload_" + UploadKind._VALUES_TO_NAMES[kind].lower()
+
+    with connect(args, analyze_id) as client:
+        upload_id = client.beginUpload(analyze_id, kind)
+
+    attempt = 0
+    while True:
+        try:
+            with connect(args, analyze_id) as client:
+                offset = client.getUploadOffset(upload_id)
+                if offset:
+                    STATS.add("resumed_upload_bytes", offset)
+
+                with open(file_path, "rb") as source_file:
+                    source_file.seek(offset)
+                    for chunk in iter(lambda: source_file.read(chunk_size),
+                                      b""):
+                        offset = client.uploadChunk(upload_id, offset, chunk)
+
+                client.commitUpload(upload_id, checksum)
+
+            duration = time.monotonic() - started
+            STATS.record(phase, duration)
+            STATS.add(phase + "_bytes", os.path.getsize(file_path))
+
+            if compression is not None:
+                compression.record_upload(os.path.getsize(file_path),
+                                          duration)
+            return
+        except TTransport.TTransportException as transport_exception:
+            attempt += 1
+            if attempt > args.upload_retries:
+                raise
+
+            LOG.warning("Upload of %s was interrupted, resume it: %s",
+                        file_path, transport_exception)
+            time.sleep(min(2 ** attempt, 30))
+
+
+def upload_files(args, files_to_upload, compression):
+    """
+    Uploads the given files to the server in ZIP files of at most
+    args.upload_batch_size bytes of sources. Every file is stored in the ZIP
+    file under its hash.
+    """
+
+    files = list(files_to_upload.items())
+    batch_limit = args.upload_batch_size * 1024 * 1024
+
+    while files:
+        batch_size = 0
+
+        with tempfile.NamedTemporaryFile(suffix=".zip") as zip_file:
+            with STATS.measure("zip_files"), \
+                    zipfile.ZipFile(zip_file.name, "w") as archive:
+                while files and (batch_size == 0 or batch_size < batch_limit):
+                    hash_value, file_name = files.pop()
+                    compression.write(archive, file_name, hash_value)
+                    batch_size += os.path.getsize(file_name)
+
+            upload_file(args, zip_file.name, UploadKind.FILES,
+                        compression=compression)
+
+        LOG.debug("Uploaded %d bytes of sources, %d files left.",
+                  batch_size, len(files))
+
+
+def create_part_zip(zip_path, item, dependencies, files_to_archive,
+                    cached_files, compression):
+    """
+    Creates the ZIP file of a compilation command for the analysis.
+
+    files_to_archive -- Paths of the files which are sent in the ZIP file.
+    cached_files -- Dict of the hashes and paths of the files which are
+                    already available on the server.
+    compression -- Compression which writes the files to the ZIP file.
+    """
+
+    with zipfile.ZipFile(zip_path, "w") as archive:
+        for file_name in files_to_archive:
+            archive_path = os.path.join(
+                "sources-root", file_name.lstrip(os.sep))
+
+            try:
+                archive.getinfo(archive_path)
+            except KeyError:
+                compression.write(archive, file_name, archive_path)
+            else:
+                LOG.debug("%s is already in the ZIP file, skip it!",
+                          file_name)
+
+        set_of_path = set()
+        for dependency in dependencies:
+            set_of_path.add(os.path.dirname(dependency))
+
+        archive.writestr(
+            "sources-root/paths_of_dependencies.json",
+            json.dumps(list(set_of_path)))
+
+        archive.writestr(
+            "sources-root/compile_command.json", json.dumps([item]))
+
+        archive.writestr(
+            "sources-root/cached_files", json.dumps(cached_files))
+
+
+class MissingFileUploader:
+    """
+    Asks the server which files of the parts it does not have yet and
+    uploads them before the parts are passed on, so the parts can refer
+    every file by its hash. A file is asked and uploaded once per run.
+    """
+
+    def __init__(self, args, compression):
+        self.args = args
+        self.compression = compression
+        self.handled = set()
+        self.unique_files = 0
+        self.uploaded_files = 0
+
+    def upload(self, parts):
+        new_files = {}
+        for _, _, files_and_hashes in parts:
+            for hash_value, file_name in files_and_hashes.items():
+                if hash_value not in self.handled:
+                    new_files[hash_value] = file_name
+
+        if new_files:
+            with STATS.measure("check_uploaded_files"):
+                missing_files = check_uploaded_files(self.args,
+                                                     new_files.keys())
+
+            for hash_value, file_name in new_files.items():
+                if hash_value in missing_files:
+                    counter = "uploaded_source"
+                else:
+                    counter = "skipped_source"
+                STATS.add(counter + "_files")
+                STATS.add(counter + "_bytes", os.path.getsize(file_name))
+
+            upload_files(self.args, {hash_value: new_files[hash_value]
+                                     for hash_value in missing_files},
+                         self.compression)
+
+            self.handled.update(new_files)
+            self.unique_files += len(new_files)
+            self.uploaded_files += len(missing_files)
+
+        return parts
+
+
+def existing_dependencies(collected):
+    """
+    Generates the collected compilation commands with the dependencies which
+    exist.
+    """
+
+    for item, dependencies in collected:
+        yield item, [file_name for file_name in dependencies
+                     if os.path.exists(file_name)]
+
+
+def hash_part(part, hash_cache):
+    item, dependencies = part
+
+    with STATS.measure("hash"):
+        return [(item, dependencies,
+                 hash_dependencies(dependencies, hash_cache))]
+
+
+def zip_part(part, zip_dir, use_cache, compression):
+    item, dependencies, files_and_hashes = part
+
+    handle, zip_path = tempfile.mkstemp(suffix=".zip", dir=zip_dir)
+    os.close(handle)
+
+    with STATS.measure("zip_part"):
+        create_part_zip(zip_path, item, dependencies,
+                        [] if use_cache else dependencies,
+                        files_and_hashes, compression)
+
+    LOG.debug("Created temporary zip file %s", zip_path)
+
+    return [zip_path]
+
+
+def upload_part(zip_path, args, analyze_id, compression):
+    try:
+        upload_file(args, zip_path, UploadKind.PART, analyze_id, compression)
+    finally:
+        os.remove(zip_path)
+
+    return [zip_path]
+
+
+def analyze(args):
+    """
+    This method collects the files of the compilation commands for the
+    remote analysis with tu_collector.
+
+    If the cache is used, the files of every compilation command are hashed
+    and the server is asked which of them it does not have yet. Each of the
+    missing files is uploaded once, then every compilation command is sent
+    as a part of the analysis which refers its files by their hashes.
+    Without the cache every part contains all of its files.
+
+    The steps run as a pipeline: while some compilation commands are
+    collected, the earlier ones are hashed, checked, zipped and uploaded by
+    their own workers. The queues between the steps are bounded, so a slow
+    step holds back the others instead of piling up parts in memory.
+
+    Before the first part the script calls server's getId method to get an
+    UUID for the analysis.
+    """
+
+    hash_cache = FileHashCache(args.hash_cache, args.hash_cache_size)
+    dependency_cache = DependencyCache(
+        args.dependency_cache, args.dependency_cache_size, args.rescan) \
+        if args.dependency_cache else None
+    compression = Compression(args.compression)
+    uploader = MissingFileUploader(args, compression)
+
     try:
         build_commands = {}
         compilation_commands = []
@@ -82,144 +549,90 @@ def analyze(args):
         LOG.debug("Build commands: %s", build_commands)
         LOG.debug("Compilation commands: %s", compilation_commands)
 
-        analyze_id = None
-
-        for item in compilation_commands:
-
-            tmp = tempfile.NamedTemporaryFile()
-
-            with open(tmp.name, 'w') as current_item:
-                json.dump([item], current_item)
-
-            with open(tmp.name) as current_item:
-                with tempfile.NamedTemporaryFile() as list_of_dependecies:
-
-                    command = ["python3", tu_collector.__file__]
-                    command.append("-l")
-                    command.append("%s" % current_item.name)
-                    command.append("-ld")
-                    command.append("%s" % list_of_dependecies.name)
-
-                    process = subprocess.Popen(
-                        command,
-                        stdin=subprocess.PIPE,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                    )
-
-                    LOG.debug(command)
-
-                    stdout, stderr = process.communicate()
-                    returncode = process.wait()
-
-                    LOG.debug('Standard output: %s', stdout)
-
-                    if returncode != 0:
-                        LOG.error('Error output: %s', stderr)
-
-                    LOG.debug("List temp file %s", list_of_dependecies.name)
-
-                    files_and_hashes = {}
-
-                    with open(list_of_dependecies.name) as dependencies:
-                        set_of_dependencies = json.load(dependencies)
-
-                        if args.use_cache:
-                            for file_name in set_of_dependencies:
-                                if os.path.exists(file_name):
-                                    with open(file_name, "rb") as file:
-                                        file_in_bytes = file.read()
-                                        readable_hash = hashlib.md5(
-                                            file_in_bytes).hexdigest()
-                                        files_and_hashes[readable_hash] = file_name
-                                else:
-                                    set_of_dependencies.remove(file_name)
-
-                            LOG.debug("File hashes: %s", files_and_hashes)
-
-                            with RemoteAnalayzerClient(args.host, args.port) as client:
-                                missing_files = client.checkUploadedFiles(files_and_hashes.keys())
-                            LOG.debug("Missing files: %s", missing_files)
-
-                            files_to_archive = {}
-                            cached_files = {}
-
-                            for hash_value in files_and_hashes:
-                                if hash_value not in missing_files:
-                                    cached_files[hash_value] = files_and_hashes[hash_value]
-                                else:
-                                    files_to_archive[hash_value] = files_and_hashes[hash_value]
-
-                            LOG.debug("Files need to upload: \n%s",
-                                      files_to_archive)
-                            LOG.debug("Files already uploaded: \n%s",
-                                      cached_files)
-                        else:
-                            files_to_archive = set_of_dependencies
-
-                        with tempfile.NamedTemporaryFile(suffix=".zip") as zip_file:
-                            with zipfile.ZipFile(zip_file.name, "a") as archive:
-                                if files_to_archive is not None:
-                                    for file in files_to_archive:
-                                        archive_path = os.path.join(
-                                            "sources-root",
-                                            files_to_archive[file].lstrip(
-                                                os.sep),
-                                        )
-
-                                        try:
-                                            archive.getinfo(archive_path)
-                                        except KeyError:
-                                            archive.write(
-                                                files_to_archive[file], archive_path
-                                            )
-                                        else:
-                                            LOG.debug(
-                                                "%s is already in the ZIP file, skip it!", file
-                                            )
-
-                                set_of_path = set()
-                                for dependency in set_of_dependencies:
-                                    set_of_path.add(os.path.dirname(dependency))
-
-                                archive.writestr(
-                                    "sources-root/paths_of_dependencies.json",
-                                    json.dumps(list(set_of_path)))
-
-                                archive.writestr(
-                                    "sources-root/compile_command.json", current_item.read())
-
-                                archive.writestr(
-                                    "sources-root/cached_files", json.dumps(
-                                        cached_files)
-                                )
-
-                            LOG.debug("Created temporary zip file %s",
-                                      zip_file.name)
-
-                            with RemoteAnalayzerClient(args.host, args.port) as client:
-                                if analyze_id is None:
-                                    analyze_id = client.getId()
-                                    LOG.info("Received id %s", analyze_id)
-
-                                with open(zip_file.name, "rb") as source_file:
-                                    file_content = source_file.read()
-
-                                    client.analyze(analyze_id, file_content)
-
-                                LOG.info("Stored sources for id %s", analyze_id)
+        with STATS.measure("get_id"), connect(args) as client:
+            analyze_id = client.getId(AnalysisOptions(
+                submitter=args.submitter,
+                priority=Priority._NAMES_TO_VALUES[args.priority.upper()],
+                weight=args.weight,
+                expectedParts=len(compilation_commands) or None))
+        LOG.info("Received id %s", analyze_id)
+
+        with tempfile.TemporaryDirectory() as zip_dir:
+            stages = []
+
+            if args.use_cache:
+                stages.append(Stage(
+                    "hash", functools.partial(hash_part,
+                                              hash_cache=hash_cache),
+                    args.hash_workers))
+                stages.append(Stage("check", uploader.upload,
+                                    batch_size=CHECK_BATCH_PARTS))
+
+            stages.append(Stage(
+                "zip", functools.partial(zip_part, zip_dir=zip_dir,
+                                         use_cache=args.use_cache,
+                                         compression=compression),
+                args.zip_workers))
+            stages.append(Stage(
+                "upload", functools.partial(upload_part, args=args,
+                                            analyze_id=analyze_id,
+                                            compression=compression),
+                args.upload_workers))
+
+            parts = existing_dependencies(STATS.measure_iterator(
+                "collect", collect_dependencies(
+                    compilation_commands, args.jobs, args.pool,
+                    dependency_cache, args.scanner, args.queue_size)))
+            if not args.use_cache:
+                parts = ((item, dependencies, {})
+                         for item, dependencies in parts)
+
+            Pipeline(stages, args.queue_size).run(parts)
+
+        if args.use_cache:
+            LOG.info("%d of %d unique files were uploaded.",
+                     uploader.uploaded_files, uploader.unique_files)
+            LOG.info("File hash cache: %d hits, %d misses",
+                     hash_cache.hits, hash_cache.misses)
+            STATS.add("hash_cache_hits", hash_cache.hits)
+            STATS.add("hash_cache_misses", hash_cache.misses)
+
+        LOG.info("Stored sources for id %s", analyze_id)
+
+        with connect(args, analyze_id) as client:
+            part_stats = client.getPartStats(analyze_id)
+        LOG.info("%d of %d parts were taken from the result cache.",
+                 part_stats.cachedParts, part_stats.parts)
+        STATS.add("parts", part_stats.parts)
+        STATS.add("cached_parts", part_stats.cachedParts)
 
     except Thrift.TException as thrift_exception:
         LOG.error("%s", thrift_exception.message)
 
+    finally:
+        hash_cache.close()
+        if dependency_cache is not None:
+            LOG.info("Dependency cache: %d hits, %d misses",
+                     dependency_cache.hits, dependency_cache.misses)
+            STATS.add("dependency_cache_hits", dependency_cache.hits)
+            STATS.add("dependency_cache_misses", dependency_cache.misses)
+            dependency_cache.close()
+
 
 def get_status(args):
     """
     This method tries to get the status of the analysis from the server.
     """
 
+    if args.ids_file:
+        get_statuses(args)
+        return
+    if args.list:
+        list_analyses(args)
+        return
+
     try:
-        with RemoteAnalayzerClient(args.host, args.port) as client:
+        with connect(args, args.id) as client:
             try:
                 response = client.getStatus(args.id)
                 LOG.info("Status of analysis: %s", response)
@@ -231,15 +644,354 @@ def get_status(args):
         LOG.error("%s", thrift_exception.message)
 
 
+def print_status(analysis_id, status):
+    if status is None:
+        print("%s\tNOT_FOUND" % analysis_id)
+        return
+
+    print("%s\t%s\t%d/%d parts\t%d cached" % (
+        analysis_id, status.state, status.completedParts, status.parts,
+        status.cachedParts))
+
+
+def get_statuses(args):
+    """
+    This method gets the status of every analysis listed in the ids file,
+    one per line, with a single connection.
+    """
+
+    if args.ids_file == "-":
+        analysis_ids = sys.stdin.read().split()
+    else:
+        with open(args.ids_file) as ids_file:
+            analysis_ids = ids_file.read().split()
+
+    try:
+        with connect(args) as client:
+            for index in range(0, len(analysis_ids), STATUS_BATCH_SIZE):
+                batch = analysis_ids[index:index + STATUS_BATCH_SIZE]
+                statuses = client.getStatuses(batch)
+
+                for analysis_id in batch:
+                    print_status(analysis_id, statuses.get(analysis_id))
+
+    except Thrift.TException as thrift_exception:
+        LOG.error("%s", thrift_exception.message)
+
+
+def list_analyses(args):
+    """
+    This method lists the analyses of the server which match the state,
+    submitter and priority filters page by page.
+    """
+
+    analysis_filter = AnalysisFilter(
+        state=args.state, submitter=args.submitter,
+        priority=Priority._NAMES_TO_VALUES[args.priority.upper()]
+        if args.priority else None)
+    cursor = ""
+
+    try:
+        with connect(args) as client:
+            while True:
+                page = client.listAnalyses(analysis_filter, cursor,
+                                           args.page_size)
+
+                for status in page.analyses:
+                    print_status(status.analysisId, status)
+
+                cursor = page.cursor
+                if not cursor:
+                    break
+
+    except Thrift.TException as thrift_exception:
+        LOG.error("%s", thrift_exception.message)
+
+
+def query_reports(args):
+    """
+    This method prints the reports of the completed analysis which match the
+    checker, file, severity and report hash filters page by page, then the
+    numbers of the matching reports, without downloading the results.
+    """
+
+    report_filter = ReportFilter(checkers=args.checkers, files=args.files,
+                                 severities=args.severities,
+                                 reportHashes=args.report_hashes)
+    cursor = ""
+    limit = 0 if args.summary_only else args.page_size
+
+    try:
+        with connect(args, args.id) as client:
+            while True:
+                try:
+                    page = client.queryReports(args.id, report_filter,
+                                               cursor, limit)
+                except AnalysisNotFoundException:
+                    LOG.warning("AnalysisNotFoundException.")
+                    sys.exit(1)
+                except AnalysisNotCompletedException:
+                    LOG.warning("AnalysisNotCompletedException.")
+                    sys.exit(1)
+
+                for report in page.reports:
+                    print("%s:%d:%d\t%s\t%s\t%s\t%s" % (
+                        report.file, report.line, report.column,
+                        report.severity, report.checker, report.reportHash,
+                        report.message))
+
+                cursor = page.cursor
+                if not cursor:
+                    break
+
+        summary = page.summary
+        LOG.info("%d matching reports.", summary.total)
+        for severity, count in sorted(summary.bySeverity.items()):
+            LOG.info("%s: %d", severity, count)
+        for checker, count in sorted(summary.byChecker.items()):
+            LOG.info("%s: %d", checker, count)
+
+    except Thrift.TException as thrift_exception:
+        LOG.error("%s", thrift_exception.message)
+
+
+def get_queue_stats(args):
+    """
+    This method gets the statistics of the queues of the priority classes
+    from the server.
+    """
+
+    try:
+        with connect(args) as client:
+            queue_stats = client.getQueueStats()
+
+        for priority, stats in sorted(queue_stats.items()):
+            LOG.info("%s: %d queued, %d dispatched, average wait %.1f s, "
+                     "maximum wait %.1f s", priority, stats.depth,
+                     stats.dispatched, stats.averageWait, stats.maxWait)
+
+    except Thrift.TException as thrift_exception:
+        LOG.error("%s", thrift_exception.message)
+
+
+def wait_for_results(args):
+    """
+    This method waits until the analysis is completed with long polls of the
+    server, then gets its results.
+    """
+
+    deadline = time.monotonic() + args.timeout if args.timeout else None
+    state = ""
+
+    try:
+        while state != "ANALYZE_COMPLETED":
+            if deadline is not None and time.monotonic() > deadline:
+                LOG.warning("Analysis is not completed in %d seconds.",
+                            args.timeout)
+                sys.exit(1)
+
+            with STATS.measure("wait"), connect(args, args.id) as client:
+                try:
+                    new_state = client.waitForStatus(args.id, state,
+                                                     WAIT_TIMEOUT_MS)
+                except AnalysisNotFoundException:
+                    LOG.warning("AnalysisNotFoundException.")
+                    sys.exit(1)
+
+            if new_state != state:
+                LOG.info("Status of analysis: %s", new_state)
+                state = new_state
+
+    except Thrift.TException as thrift_exception:
+        LOG.error("%s", thrift_exception.message)
+        return
+
+    get_results(args)
+
+
+def download_chunk(args, chunk_size, result_file, index):
+    """
+    Downloads the chunk of the results with the given index and writes it to
+    its place in the result file. Returns the index of the chunk.
+    """
+
+    offset = index * chunk_size
+
+    attempt = 0
+    while True:
+        try:
+            with STATS.measure("download_chunk"), \
+                    connect(args, args.id) as client:
+                chunk = client.getResultsChunk(args.id, offset, chunk_size)
+            break
+        except TTransport.TTransportException:
+            attempt += 1
+            if attempt > args.download_retries:
+                raise
+            time.sleep(min(2 ** attempt, 30))
+
+    os.pwrite(result_file, chunk, offset)
+    STATS.add("downloaded_bytes", len(chunk))
+
+    return index
+
+
+def download_results(args, results_info, file_path):
+    """
+    Downloads the results to the given file in chunks with parallel
+    connections. The downloaded chunks are recorded in a progress file next to
+    the partial download, so an interrupted download is continued with the
+    missing chunks only.
+    """
+
+    chunk_size = args.chunk_size * 1024 * 1024
+    partial_path = file_path + ".part"
+    progress_path = partial_path + ".json"
+
+    progress = {"checksum": results_info.checksum, "chunks": []}
+    if os.path.isfile(partial_path) and os.path.isfile(progress_path):
+        with open(progress_path) as progress_file:
+            stored_progress = json.load(progress_file)
+        if stored_progress["checksum"] == results_info.checksum:
+            progress = stored_progress
+
+    done_chunks = set(progress["chunks"])
+    chunk_count = (results_info.size + chunk_size - 1) // chunk_size
+    missing_chunks = [index for index in range(chunk_count)
+                      if index not in done_chunks]
+
+    LOG.debug("Download %d of %d chunks of the results.",
+              len(missing_chunks), chunk_count)
+
+    result_file = os.open(partial_path, os.O_RDWR | os.O_CREAT)
+    try:
+        os.ftruncate(result_file, results_info.size)
+
+        with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            futures = [executor.submit(download_chunk, args, chunk_size,
+                                       result_file, index)
+                       for index in missing_chunks]
+
+            for future in as_completed(futures):
+                progress["chunks"].append(future.result())
+                with open(progress_path, "w") as progress_file:
+                    json.dump(progress, progress_file)
+    finally:
+        os.close(result_file)
+
+    if hash_file(partial_path) != results_info.checksum:
+        os.remove(partial_path)
+        os.remove(progress_path)
+        raise IOError("Checksum of the downloaded results does not match.")
+
+    os.replace(partial_path, file_path)
+    os.remove(progress_path)
+
+
+def download_part(args, part_number):
+    """
+    Downloads the reports of the completed part with the given number.
+    """
+
+    with STATS.measure("download_part"), connect(args, args.id) as client:
+        part_zip = client.getPartResult(args.id, part_number)
+
+    STATS.add("downloaded_bytes", len(part_zip))
+
+    return part_zip
+
+
+def merge_part(part_zip, output_dir):
+    """
+    Extracts the reports of a part into the output directory. Like in the
+    results of the whole analysis, a report which already exists is kept.
+    Returns the number of the extracted reports.
+    """
+
+    extracted = 0
+
+    with zipfile.ZipFile(io.BytesIO(part_zip)) as archive:
+        for name in archive.namelist():
+            target_path = os.path.normpath(os.path.join(output_dir, name))
+            if not target_path.startswith(output_dir + os.sep):
+                LOG.warning("Report %s is outside of the output directory, "
+                            "skip it.", name)
+                continue
+            if os.path.exists(target_path):
+                continue
+
+            archive.extract(name, output_dir)
+            extracted += 1
+
+    return extracted
+
+
+def follow_results(args):
+    """
+    This method downloads the reports of the parts of the analysis as soon
+    as they are completed and merges them into a directory named after the
+    analysis, so the first reports are available before the slowest part is
+    completed.
+    """
+
+    output_dir = os.path.abspath(args.id)
+    os.makedirs(output_dir, exist_ok=True)
+
+    started = time.monotonic()
+    cursor = ""
+    merged_parts = 0
+
+    try:
+        with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            while True:
+                with STATS.measure("poll_parts"), \
+                        connect(args, args.id) as client:
+                    try:
+                        completed = client.getCompletedParts(args.id, cursor)
+                    except AnalysisNotFoundException:
+                        LOG.warning("AnalysisNotFoundException.")
+                        sys.exit(1)
+
+                futures = {executor.submit(download_part, args, part_number):
+                           part_number
+                           for part_number in completed.partNumbers}
+
+                for future in as_completed(futures):
+                    reports = merge_part(future.result(), output_dir)
+                    if merged_parts == 0:
+                        STATS.record("first_part",
+                                     time.monotonic() - started)
+                    merged_parts += 1
+                    LOG.info("Merged %d reports of part %d.", reports,
+                             futures[future])
+
+                cursor = completed.cursor
+                if completed.finished:
+                    break
+                if not completed.partNumbers:
+                    time.sleep(args.poll_interval)
+
+    except Thrift.TException as thrift_exception:
+        LOG.error("%s", thrift_exception.message)
+        return
+
+    LOG.info("Stored the reports of %d parts of analysis %s in %s",
+             merged_parts, args.id, output_dir)
+
+
 def get_results(args):
     """
     This method tries to get the results of the analysis from the server.
     """
 
+    if getattr(args, "follow", False):
+        follow_results(args)
+        return
+
     try:
-        with RemoteAnalayzerClient(args.host, args.port) as client:
+        with connect(args, args.id) as client:
             try:
-                response = client.getResults(args.id)
+                results_info = client.getResultsInfo(args.id)
             except AnalysisNotFoundException:
                 LOG.warning("AnalysisNotFoundException.")
                 sys.exit(1)
@@ -247,18 +999,18 @@ def get_results(args):
                 LOG.warning("AnalysisNotCompletedException.")
                 sys.exit(1)
 
-            with open(args.id + ".zip", "wb") as source:
-                try:
-                    source.write(response)
-                    LOG.info("Stored the results of analysis %s", args.id)
-                except Exception:
-                    LOG.error("Failed to store received ZIP.")
+        try:
+            with STATS.measure("download"):
+                download_results(args, results_info, args.id + ".zip")
+            LOG.info("Stored the results of analysis %s", args.id)
+        except IOError as io_error:
+            LOG.error("Failed to store received ZIP: %s", io_error)
 
     except Thrift.TException as thrift_exception:
         LOG.error("%s", (thrift_exception.message))
 
 
-def main():
+def create_parser():
     parser = argparse.ArgumentParser(description=".....")
 
     parser.add_argument(
@@ -268,10 +1020,52 @@ def main():
     parser.add_argument("--port", type=str, dest="port",
                         default="9090", help="...")
 
+    parser.add_argument(
+        "--controllers", type=parse_controllers, dest="controllers",
+        default=None,
+        help="Comma separated list of the host:port of the controllers of a "
+             "sharded cluster, instead of --host and --port. New analyses "
+             "are started on the least loaded controller and the requests "
+             "of an analysis are sent to the controller of its shard.")
+
+    parser.add_argument(
+        "--framed", dest="framed", default=False, action="store_true",
+        help="Use framed transport, which is needed by the nonblocking "
+             "server.")
+
+    parser.add_argument(
+        "--protocol", type=str, dest="protocol",
+        choices=sorted(PROTOCOLS), default="binary",
+        help="Protocol of the requests. It has to match the --protocol of "
+             "the server. compact encodes the lists of hashes in less "
+             "bytes.")
+
+    parser.add_argument(
+        "--connections", type=int, dest="connections",
+        default=DEFAULT_POOL_SIZE,
+        help="Number of idle connections kept open for the next requests.")
+
+    parser.add_argument(
+        "--busy-retries", type=int, dest="busy_retries",
+        default=DEFAULT_BUSY_RETRIES,
+        help="Number of times a request refused by a busy server is retried "
+             "with exponential backoff.")
+
+    parser.add_argument(
+        "--max-backoff", type=float, dest="max_backoff",
+        default=DEFAULT_MAX_BACKOFF,
+        help="Longest wait in seconds before the retry of a refused request, "
+             "unless the server asks for a longer one.")
+
     parser.add_argument(
         "--no-cache", dest="use_cache", default=True, action="store_false"
     )
 
+    parser.add_argument(
+        "--stats-json", type=str, dest="stats_json", default=None,
+        help="Write the time of every phase and the number of uploaded, "
+             "skipped and downloaded bytes to this JSON file.")
+
     subparsers = parser.add_subparsers(help="sub-command help")
 
     parser_analyze = subparsers.add_parser("analyze", help="analyze help")
@@ -286,21 +1080,211 @@ def main():
         help="...",
     )
     group.set_defaults(func=analyze)
+    parser_analyze.add_argument(
+        "-j", "--jobs", type=int, dest="jobs", default=None,
+        help="Collect the dependencies in-process with this many parallel "
+             "workers instead of starting a tu_collector process per "
+             "compilation command.")
+    parser_analyze.add_argument(
+        "--pool", type=str, dest="pool", choices=["thread", "process"],
+        default="thread",
+        help="Type of the worker pool used for the dependency collection "
+             "with -j.")
+    parser_analyze.add_argument(
+        "--hash-cache", type=str, dest="hash_cache", nargs="?",
+        const=DEFAULT_CACHE_PATH, default=None,
+        help="Keep the hashes of the files in this SQLite database between "
+             "runs so unchanged files are not hashed again. (default: %s)"
+             % DEFAULT_CACHE_PATH)
+    parser_analyze.add_argument(
+        "--hash-cache-size", type=int, dest="hash_cache_size",
+        default=DEFAULT_MAX_ENTRIES,
+        help="Maximum number of files in the hash cache. The least recently "
+             "used entries are evicted above it.")
+    parser_analyze.add_argument(
+        "--scanner", type=str, dest="scanner",
+        choices=["compiler", "builtin", "verify"], default="compiler",
+        help="How the dependencies are collected. compiler preprocesses "
+             "every compilation command with -E -M. builtin scans the "
+             "#include directives and asks the compiler only when it is "
+             "unsure. verify does both and logs the differences.")
+    parser_analyze.add_argument(
+        "--dependency-cache", type=str, dest="dependency_cache", nargs="?",
+        const=dep_cache.DEFAULT_CACHE_PATH, default=None,
+        help="Keep the dependency lists of the compilation commands in this "
+             "SQLite database between runs, so a compilation command is "
+             "preprocessed again only when its files or include directories "
+             "change. (default: %s)" % dep_cache.DEFAULT_CACHE_PATH)
+    parser_analyze.add_argument(
+        "--dependency-cache-size", type=int, dest="dependency_cache_size",
+        default=dep_cache.DEFAULT_MAX_ENTRIES,
+        help="Maximum number of compilation commands in the dependency "
+             "cache. The least recently used entries are evicted above it.")
+    parser_analyze.add_argument(
+        "--rescan", dest="rescan", default=False, action="store_true",
+        help="Collect every dependency list again and refresh the "
+             "dependency cache with them.")
+    parser_analyze.add_argument(
+        "--hash-workers", type=int, dest="hash_workers", default=4,
+        help="Number of threads hashing the files of the compilation "
+             "commands.")
+    parser_analyze.add_argument(
+        "--zip-workers", type=int, dest="zip_workers", default=2,
+        help="Number of threads creating the ZIP files of the parts.")
+    parser_analyze.add_argument(
+        "--upload-workers", type=int, dest="upload_workers", default=4,
+        help="Number of parts uploaded at once.")
+    parser_analyze.add_argument(
+        "--queue-size", type=int, dest="queue_size", default=64,
+        help="Maximum number of compilation commands waiting between two "
+             "steps of the pipeline. It bounds the memory and the "
+             "temporary ZIP files of large compilation databases.")
+    parser_analyze.add_argument(
+        "--upload-batch-size", type=int, dest="upload_batch_size",
+        default=64,
+        help="Maximum size of the sources uploaded in one ZIP file in MiB.")
+    parser_analyze.add_argument(
+        "--compression", type=str, dest="compression",
+        choices=[AUTO] + sorted(CODECS), default=AUTO,
+        help="Compression of the sources in the uploaded ZIP files. auto "
+             "chooses by the measured speed of the codecs and of the "
+             "uploads. Files which do not compress are stored.")
+    parser_analyze.add_argument(
+        "--chunk-size", type=int, dest="chunk_size", default=4,
+        help="Size of the chunks of the uploads in MiB.")
+    parser_analyze.add_argument(
+        "--upload-retries", type=int, dest="upload_retries", default=5,
+        help="Number of times an interrupted upload is resumed.")
+
+    parser_analyze.add_argument(
+        "--priority", type=str, dest="priority",
+        choices=["high", "normal", "low"], default="normal",
+        help="Priority class of the parts of the analysis.")
+    parser_analyze.add_argument(
+        "--submitter", type=str, dest="submitter", default=None,
+        help="The workers are shared fairly between the submitters. Without "
+             "it the analysis is a submitter of its own.")
+    parser_analyze.add_argument(
+        "--weight", type=int, dest="weight", default=1,
+        help="Share of the submitter of the workers relative to the others "
+             "of the same priority class.")
 
     parser_status = subparsers.add_parser("status", help="status help")
+    status_group = parser_status.add_mutually_exclusive_group(required=True)
+    status_group.add_argument(
+        "-id", "--id", type=str, dest="id", help="..."
+    )
+    status_group.add_argument(
+        "--ids-file", type=str, dest="ids_file", default=None,
+        help="Print the status of every analysis listed in this file, one "
+             "id per line, with bulk requests. - reads the standard input.")
+    status_group.add_argument(
+        "--list", dest="list", default=False, action="store_true",
+        help="Print the status of every analysis of the server which "
+             "matches the --state, --submitter and --priority filters.")
+    parser_status.add_argument(
+        "--state", type=str, dest="state", default=None,
+        choices=["ID_PROVIDED", "QUEUED", "ANALYZE_IN_PROGRESS",
+                 "ANALYZE_COMPLETED"],
+        help="List only the analyses in this state.")
+    parser_status.add_argument(
+        "--submitter", type=str, dest="submitter", default=None,
+        help="List only the analyses of this submitter.")
+    parser_status.add_argument(
+        "--priority", type=str, dest="priority", default=None,
+        choices=["high", "normal", "low"],
+        help="List only the analyses of this priority class.")
     parser_status.add_argument(
+        "--page-size", type=int, dest="page_size", default=1000,
+        help="Number of analyses examined by the server in one request of "
+             "the listing.")
+    parser_status.set_defaults(func=get_status)
+
+    parser_reports = subparsers.add_parser(
+        "reports", help="Query the reports of a completed analysis on the "
+                        "server.")
+    parser_reports.add_argument(
         "-id", "--id", type=str, dest="id", required=True, help="..."
     )
-    parser_status.set_defaults(func=get_status)
+    parser_reports.add_argument(
+        "--checker", type=str, dest="checkers", action="append",
+        default=None,
+        help="Print only the reports of the checkers which match this glob "
+             "pattern, like core.*. Can be given more times.")
+    parser_reports.add_argument(
+        "--file", type=str, dest="files", action="append", default=None,
+        help="Print only the reports in the files which match this glob "
+             "pattern, like */src/main.cpp. Can be given more times.")
+    parser_reports.add_argument(
+        "--severity", type=str, dest="severities", action="append",
+        default=None,
+        help="Print only the reports of this severity. Can be given more "
+             "times.")
+    parser_reports.add_argument(
+        "--report-hash", type=str, dest="report_hashes", action="append",
+        default=None,
+        help="Print only the report of this hash. Can be given more times.")
+    parser_reports.add_argument(
+        "--summary-only", dest="summary_only", default=False,
+        action="store_true",
+        help="Print only the numbers of the matching reports by severity "
+             "and checker.")
+    parser_reports.add_argument(
+        "--page-size", type=int, dest="page_size", default=1000,
+        help="Number of reports asked in one request.")
+    parser_reports.set_defaults(func=query_reports)
+
+    parser_queue = subparsers.add_parser(
+        "queue", help="Show the statistics of the queues of the server.")
+    parser_queue.set_defaults(func=get_queue_stats)
 
     parser_results = subparsers.add_parser("results", help="results help")
+    parser_wait = subparsers.add_parser(
+        "wait", help="Wait until the analysis is completed and get its "
+                     "results.")
+
+    for subparser in (parser_results, parser_wait):
+        subparser.add_argument(
+            "-id", "--id", type=str, dest="id", required=True, help="..."
+        )
+        subparser.add_argument(
+            "-j", "--jobs", type=int, dest="jobs", default=4,
+            help="Number of parallel connections of the download.")
+        subparser.add_argument(
+            "--chunk-size", type=int, dest="chunk_size", default=4,
+            help="Size of the chunks of the download in MiB.")
+        subparser.add_argument(
+            "--download-retries", type=int, dest="download_retries",
+            default=5,
+            help="Number of times the download of a chunk is retried.")
+
     parser_results.add_argument(
-        "-id", "--id", type=str, dest="id", required=True, help="..."
-    )
+        "--follow", dest="follow", default=False, action="store_true",
+        help="Download the reports of every part as soon as it is completed "
+             "and merge them into a directory named after the analysis, "
+             "instead of waiting for the results of the whole analysis.")
+    parser_results.add_argument(
+        "--poll-interval", type=float, dest="poll_interval", default=1.0,
+        help="Seconds between two requests of the completed parts with "
+             "--follow.")
     parser_results.set_defaults(func=get_results)
+    parser_wait.add_argument(
+        "--timeout", type=int, dest="timeout", default=None,
+        help="Give up waiting after this many seconds.")
+    parser_wait.set_defaults(func=wait_for_results)
+
+    return parser
 
-    args = parser.parse_args()
-    args.func(args)
+
+def main():
+    args = create_parser().parse_args()
+
+    try:
+        args.func(args)
+    finally:
+        STATS.add("opened_connections", close_pools())
+        if args.stats_json:
+            STATS.write(args.stats_json)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,175 @@
+"""
+Routing of the requests to the shards of a cluster of controllers.
+"""
+
+import bisect
+import hashlib
+import logging
+import random
+import threading
+
+from thrift import Thrift
+
+from connection_pool import DEFAULT_POOL_SIZE, get_pool, is_broken
+
+LOG = logging.getLogger("CLIENT")
+
+# Number of points of a shard on the hash ring.
+VIRTUAL_NODES = 64
+
+SHARD_SEPARATOR = "."
+
+_ROUTERS = {}
+_ROUTERS_LOCK = threading.Lock()
+
+
+def parse_controllers(value):
+    """
+    Returns the list of the hosts and ports of a comma separated list of
+    host:port items.
+    """
+
+    controllers = []
+
+    for item in value.split(","):
+        host, _, port = item.strip().rpartition(":")
+        controllers.append((host or "localhost", int(port)))
+
+    return controllers
+
+
+def ring_hash(key):
+    return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:16], 16)
+
+
+class HashRing:
+    """
+    Consistent hashing of the keys to the nodes. When a node leaves, only
+    its keys are moved to the other nodes.
+    """
+
+    def __init__(self, nodes, virtual_nodes=VIRTUAL_NODES):
+        self._points = sorted((ring_hash("%s#%d" % (node, index)), node)
+                              for node in nodes
+                              for index in range(virtual_nodes))
+        self._hashes = [point for point, _ in self._points]
+
+    def owner(self, key):
+        """
+        Returns the node of the key, or None if the ring is empty.
+        """
+
+        if not self._points:
+            return None
+
+        index = bisect.bisect(self._hashes, ring_hash(key))
+        return self._points[index % len(self._points)][1]
+
+
+class ShardRouter:
+    """
+    Sends the requests of an analysis to the controller of the shard encoded
+    in its id, and the other requests, like the one which starts a new
+    analysis, to the least loaded controller.
+
+    The controllers are asked for their shards and loads once. An analysis
+    whose shard is not reachable, or which was started on a controller
+    without a shard, is routed by consistent hashing of its id to the
+    reachable controllers, which share its state in the database and in
+    the workspace.
+    """
+
+    def __init__(self, controllers, framed=False, protocol="binary",
+                 pool_size=DEFAULT_POOL_SIZE):
+        self.controllers = controllers
+        self.framed = framed
+        self.protocol = protocol
+        self.pool_size = pool_size
+
+        self._lock = threading.Lock()
+        self._shards = None
+        self._loads = {}
+        self._ring = None
+        self._chosen = None
+
+    def _discover(self):
+        with self._lock:
+            if self._shards is not None:
+                return
+
+            shards = {}
+            error = None
+
+            for host, port in self.controllers:
+                pool = get_pool(host, port, self.framed, self.protocol,
+                                self.pool_size)
+                try:
+                    connection = pool.acquire()
+                except Thrift.TException as exception:
+                    LOG.warning("Controller %s:%d is not reachable: %s",
+                                host, port, exception)
+                    error = exception
+                    continue
+
+                try:
+                    info = connection.client.getShardInfo()
+                except Thrift.TException as exception:
+                    pool.release(connection, is_broken(exception))
+                    LOG.warning("Controller %s:%d is not reachable: %s",
+                                host, port, exception)
+                    error = exception
+                    continue
+                pool.release(connection)
+
+                name = info.shard or "%s:%d" % (host, port)
+                shards[name] = (host, port)
+                self._loads[name] = info.activeUploads
+
+            if not shards:
+                raise error
+
+            LOG.debug("Shards: %s", shards)
+
+            self._ring = HashRing(shards)
+            self._shards = shards
+
+    def route(self, analysis_id=None):
+        """
+        Returns the host and port of the controller of the analysis, or of
+        the least loaded controller if no analysis is given.
+        """
+
+        self._discover()
+
+        if not analysis_id:
+            # Equally loaded controllers are chosen randomly, so clients
+            # started together are spread over them. The choice is kept, so
+            # the files are uploaded where the analysis is started.
+            with self._lock:
+                if self._chosen is None:
+                    self._chosen = min(
+                        self._shards, key=lambda shard: (self._loads[shard],
+                                                         random.random()))
+            return self._shards[self._chosen]
+
+        shard = analysis_id.split(SHARD_SEPARATOR, 1)[0] \
+            if SHARD_SEPARATOR in analysis_id else None
+        if shard in self._shards:
+            return self._shards[shard]
+
+        return self._shards[self._ring.owner(analysis_id)]
+
+
+def get_router(controllers, framed=False, protocol="binary",
+               pool_size=DEFAULT_POOL_SIZE):
+    """
+    Returns the router of the process for the given controllers.
+    """
+
+    key = (tuple(controllers), framed, protocol)
+
+    with _ROUTERS_LOCK:
+        if key not in _ROUTERS:
+            _ROUTERS[key] = ShardRouter(controllers, framed, protocol,
+                                        pool_size)
+        return _ROUTERS[key]
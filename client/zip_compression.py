@@ -0,0 +1,170 @@
+"""
+Selection of the compression of the files in the uploaded ZIP files.
+"""
+
+import bz2
+import lzma
+import os
+import threading
+import time
+import zipfile
+import zlib
+
+# Codecs by their names with their ZIP compression methods and levels. Every
+# codec can be extracted by the zipfile module of the Python of the server
+# image, so zstd, which needs Python 3.14, is not offered.
+CODECS = {
+    "stored": (zipfile.ZIP_STORED, None),
+    "deflate": (zipfile.ZIP_DEFLATED, 6),
+    "bz2": (zipfile.ZIP_BZIP2, 9),
+    "lzma": (zipfile.ZIP_LZMA, None),
+}
+for level in range(1, 10):
+    CODECS["deflate-%d" % level] = (zipfile.ZIP_DEFLATED, level)
+
+AUTO = "auto"
+
+# Codecs the auto mode chooses from.
+AUTO_CANDIDATES = ["stored", "deflate-1", "deflate-6", "deflate-9", "lzma"]
+
+# Files with these extensions are already compressed.
+COMPRESSED_EXTENSIONS = {".7z", ".bz2", ".gz", ".jar", ".jpeg", ".jpg",
+                         ".png", ".xz", ".zip", ".zst"}
+
+# A file is not compressed if its first SAMPLE_SIZE bytes do not get smaller
+# than this ratio with the fastest deflate level.
+INCOMPRESSIBLE_RATIO = 0.9
+SAMPLE_SIZE = 64 * 1024
+
+# The auto mode measures the codecs on the beginning of the files until this
+# many bytes are sampled.
+AUTO_SAMPLE_LIMIT = 4 * 1024 * 1024
+
+# Assumed upload bandwidth in bytes per second until the first upload is
+# measured.
+DEFAULT_BANDWIDTH = 10 * 1024 * 1024
+
+
+def compress_sample(name, data):
+    """
+    Returns the size of the data compressed with the given codec.
+    """
+
+    method, level = CODECS[name]
+
+    if method == zipfile.ZIP_STORED:
+        return len(data)
+    if method == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        return len(compressor.compress(data) + compressor.flush())
+    if method == zipfile.ZIP_BZIP2:
+        return len(bz2.compress(data, level))
+
+    return len(lzma.compress(data, format=lzma.FORMAT_ALONE))
+
+
+class Compression:
+    """
+    Writes files to ZIP files with the compression of the given codec.
+
+    In auto mode the codec is chosen by the estimated time of compressing and
+    uploading a byte, from the speed and the ratio of every candidate
+    measured on the beginning of the files and the bandwidth measured on the
+    uploads. Files which do not compress are stored.
+    """
+
+    def __init__(self, codec=AUTO):
+        if codec != AUTO and codec not in CODECS:
+            raise ValueError("Unknown compression: %s" % codec)
+
+        self.codec = codec
+        self.bandwidth = DEFAULT_BANDWIDTH
+
+        self._lock = threading.Lock()
+        self._sampled = 0
+        self._uploads = 0
+        self._samples = {name: [0, 0, 0.0] for name in AUTO_CANDIDATES}
+
+    def write(self, archive, file_name, archive_path):
+        """
+        Writes the file to the archive.
+        """
+
+        with open(file_name, "rb") as source:
+            sample = source.read(SAMPLE_SIZE)
+
+        name = self._choose(file_name, sample)
+        method, level = CODECS[name]
+
+        archive.write(file_name, archive_path, method, level)
+
+    def record_upload(self, size, seconds):
+        """
+        Updates the estimated bandwidth with a finished upload.
+        """
+
+        if seconds <= 0:
+            return
+
+        with self._lock:
+            measured = size / seconds
+            if self._uploads:
+                self.bandwidth = (self.bandwidth + measured) / 2
+            else:
+                self.bandwidth = measured
+            self._uploads += 1
+
+    def best_codec(self):
+        """
+        Returns the candidate of the shortest estimated time of compressing
+        and uploading a byte.
+        """
+
+        with self._lock:
+            bandwidth = self.bandwidth
+            samples = {name: list(sample)
+                       for name, sample in self._samples.items()}
+
+        def cost(name):
+            raw, compressed, seconds = samples[name]
+            if not raw:
+                return 0.0
+            return seconds / raw + compressed / raw / bandwidth
+
+        if not samples["stored"][0]:
+            return "deflate"
+
+        return min(AUTO_CANDIDATES, key=cost)
+
+    def _choose(self, file_name, sample):
+        if self.codec == "stored":
+            return self.codec
+
+        if os.path.splitext(file_name)[1].lower() in COMPRESSED_EXTENSIONS:
+            return "stored"
+
+        if sample and compress_sample("deflate-1", sample) > \
+                len(sample) * INCOMPRESSIBLE_RATIO:
+            return "stored"
+
+        if self.codec != AUTO:
+            return self.codec
+
+        if sample and self._sampled < AUTO_SAMPLE_LIMIT:
+            self._measure(sample)
+
+        return self.best_codec()
+
+    def _measure(self, sample):
+        for name in AUTO_CANDIDATES:
+            started = time.perf_counter()
+            compressed = compress_sample(name, sample)
+            seconds = time.perf_counter() - started
+
+            with self._lock:
+                self._samples[name][0] += len(sample)
+                self._samples[name][1] += compressed
+                self._samples[name][2] += seconds
+
+        with self._lock:
+            self._sampled += len(sample)
@@ -1,13 +1,140 @@
+enum UploadKind {
+  PART = 1,
+  FILES = 2
+}
+
+enum Priority {
+  HIGH = 1,
+  NORMAL = 2,
+  LOW = 3
+}
+
+struct AnalysisOptions {
+  1: optional string submitter,
+  2: optional Priority priority,
+  3: optional i32 weight,
+  4: optional i64 expectedParts
+}
+
+struct QueueStats {
+  1: i64 depth,
+  2: i64 dispatched,
+  3: double averageWait,
+  4: double maxWait
+}
+
+struct PartStats {
+  1: i64 parts,
+  2: i64 completedParts,
+  3: i64 cachedParts
+}
+
+struct AnalysisStatus {
+  1: string analysisId,
+  2: string state,
+  3: i64 parts,
+  4: i64 completedParts,
+  5: i64 cachedParts,
+  6: optional string submitter,
+  7: optional string priority,
+  8: double lastUse
+}
+
+struct AnalysisFilter {
+  1: optional string state,
+  2: optional string submitter,
+  3: optional Priority priority
+}
+
+struct AnalysisPage {
+  1: list<AnalysisStatus> analyses,
+  2: string cursor
+}
+
+struct CompletedParts {
+  1: list<i64> partNumbers,
+  2: string cursor,
+  3: bool finished
+}
+
+struct ShardInfo {
+  1: string shard,
+  2: i64 activeUploads
+}
+
+struct ResultsInfo {
+  1: i64 size,
+  2: string checksum
+}
+
+struct ReportFilter {
+  1: optional list<string> checkers,
+  2: optional list<string> files,
+  3: optional list<string> severities,
+  4: optional list<string> reportHashes
+}
+
+struct Report {
+  1: string reportHash,
+  2: string checker,
+  3: string severity,
+  4: string file,
+  5: i32 line,
+  6: i32 column,
+  7: string message
+}
+
+struct ReportSummary {
+  1: i64 total,
+  2: map<string, i64> bySeverity,
+  3: map<string, i64> byChecker
+}
+
+struct ReportPage {
+  1: list<Report> reports,
+  2: string cursor,
+  3: ReportSummary summary
+}
+
 exception AnalysisNotFoundException {
 }
 
 exception AnalysisNotCompletedException {
 }
 
+exception UploadNotFoundException {
+}
+
+exception ServerBusyException {
+  1: string message,
+  2: string reason,
+  3: i64 retryAfterMs
+}
+
+exception InvalidUploadException {
+  1: string message
+}
+
 service RemoteAnalyze {
-  string getId()
+  string getId(1:AnalysisOptions options) throws (1:ServerBusyException busyException)
   list<string> checkUploadedFiles(1:list<string> fileHashes)
-  void analyze(1:string analysisId, 2:binary zipFile)
+  void uploadFiles(1:binary zipFile) throws (1:ServerBusyException busyException)
+  void analyze(1:string analysisId, 2:binary zipFile) throws (1:ServerBusyException busyException)
+  string beginUpload(1:string analysisId, 2:UploadKind kind) throws (1:ServerBusyException busyException)
+  i64 getUploadOffset(1:string uploadId) throws (1:UploadNotFoundException notFoundException)
+  i64 uploadChunk(1:string uploadId, 2:i64 offset, 3:binary chunk) throws (1:UploadNotFoundException notFoundException, 2:InvalidUploadException invalidUploadException, 3:ServerBusyException busyException)
+  void commitUpload(1:string uploadId, 2:string checksum) throws (1:UploadNotFoundException notFoundException, 2:InvalidUploadException invalidUploadException, 3:ServerBusyException busyException)
+  map<string, QueueStats> getQueueStats()
+  ShardInfo getShardInfo()
   string getStatus(1:string analysisId) throws (1:AnalysisNotFoundException notFoundException)
+  PartStats getPartStats(1:string analysisId) throws (1:AnalysisNotFoundException notFoundException)
+  map<string, AnalysisStatus> getStatuses(1:list<string> analysisIds)
+  AnalysisPage listAnalyses(1:AnalysisFilter filter, 2:string cursor, 3:i32 limit)
+  string waitForStatus(1:string analysisId, 2:string knownState, 3:i64 timeoutMs) throws (1:AnalysisNotFoundException notFoundException)
   binary getResults(1:string analysisId) throws (1:AnalysisNotFoundException notFoundException, 2:AnalysisNotCompletedException notCompletedException)
-}
\ No newline at end of file
+  ResultsInfo getResultsInfo(1:string analysisId) throws (1:AnalysisNotFoundException notFoundException, 2:AnalysisNotCompletedException notCompletedException)
+  CompletedParts getCompletedParts(1:string analysisId, 2:string sinceCursor) throws (1:AnalysisNotFoundException notFoundException)
+  binary getPartResult(1:string analysisId, 2:i64 partNumber) throws (1:AnalysisNotFoundException notFoundException, 2:AnalysisNotCompletedException notCompletedException)
+  ReportPage queryReports(1:string analysisId, 2:ReportFilter filter, 3:string cursor, 4:i32 limit) throws (1:AnalysisNotFoundException notFoundException, 2:AnalysisNotCompletedException notCompletedException)
+  binary getResultsChunk(1:string analysisId, 2:i64 offset, 3:i32 length) throws (1:AnalysisNotFoundException notFoundException, 2:AnalysisNotCompletedException notCompletedException)
+}
@@ -0,0 +1,81 @@
+"""
+Admission control of the ingest requests of the controller.
+"""
+
+import shutil
+import threading
+
+DEFAULT_RETRY_AFTER = 30
+
+# Reasons of the refusals, used as the label of their metric.
+QUEUE_DEPTH = "queue_depth"
+SUBMITTER_BYTES = "submitter_bytes"
+FREE_DISK = "free_disk"
+
+
+class AdmissionControl:
+    """
+    Refuses the ingest requests while the controller is overloaded, so the
+    clients retry them later instead of filling the queue and the workspace.
+
+    New analyses and parts are refused while max_queue_depth parts are
+    waiting for the analyzers. Parts are refused while the queued parts of
+    their submitter, or of the analysis without a submitter, are larger
+    than max_submitter_bytes. Every upload is refused when the free space of
+    the workspace falls below the low watermark, until it grows over the
+    high watermark again. A limit of None is not checked.
+    """
+
+    def __init__(self, scheduler, workspace, max_queue_depth=None,
+                 max_submitter_bytes=None, low_watermark=None,
+                 high_watermark=None, retry_after=DEFAULT_RETRY_AFTER):
+        self.scheduler = scheduler
+        self.workspace = workspace
+        self.max_queue_depth = max_queue_depth
+        self.max_submitter_bytes = max_submitter_bytes
+        self.low_watermark = low_watermark
+        self.high_watermark = max(high_watermark or 0, low_watermark or 0)
+        self.retry_after = retry_after
+
+        self._lock = threading.Lock()
+        self._disk_full = False
+
+    def refusal(self, analysis_id=None, new_work=False):
+        """
+        Returns the reason and the message of the refusal of an upload, or
+        None if it is admitted. new_work is given for the requests which
+        add a new analysis or part of the analysis to the queue.
+        """
+
+        if self.low_watermark is not None:
+            free = shutil.disk_usage(self.workspace).free
+
+            with self._lock:
+                if free < self.low_watermark:
+                    self._disk_full = True
+                elif free >= self.high_watermark:
+                    self._disk_full = False
+                disk_full = self._disk_full
+
+            if disk_full:
+                return FREE_DISK, "Only %d MiB of the workspace is free." % (
+                    free // (1024 * 1024))
+
+        if not new_work:
+            return None
+
+        if self.max_queue_depth is not None:
+            depth = self.scheduler.depth()
+            if depth >= self.max_queue_depth:
+                return QUEUE_DEPTH, "%d parts are waiting for the " \
+                                    "analyzers." % depth
+
+        if self.max_submitter_bytes is not None and analysis_id:
+            queued_bytes = self.scheduler.queued_bytes(analysis_id)
+            if queued_bytes >= self.max_submitter_bytes:
+                return SUBMITTER_BYTES, "%d MiB of the parts of the " \
+                                        "submitter are waiting for the " \
+                                        "analyzers." % (
+                                            queued_bytes // (1024 * 1024))
+
+        return None
@@ -0,0 +1,175 @@
+"""
+Bulk reading and paged listing of the states of the analyses.
+"""
+
+import time
+
+# Sorted set of the analyses scored by the time of their last use.
+ANALYSES_KEY = "ANALYSES"
+
+# Number of analyses read in one pipeline.
+READ_BATCH_SIZE = 1000
+
+# Upper limit of the analyses returned by one page of the listing.
+MAX_PAGE_SIZE = 1000
+
+FIELDS = ["state", "parts", "completed_parts", "cached_parts", "submitter",
+          "priority", "expected_parts"]
+
+# Marks an analysis queued unless its parts were all completed meanwhile,
+# so a late write does not hide the completion of the analysis.
+QUEUE_SCRIPT = """
+local completed = tonumber(redis.call('HGET', KEYS[1], 'completed_parts'))
+local target = tonumber(redis.call('HGET', KEYS[1], 'expected_parts') or
+                        redis.call('HGET', KEYS[1], 'parts'))
+if (completed or 0) < (target or 0) then
+    redis.call('HSET', KEYS[1], 'state', 'QUEUED')
+    return 1
+end
+return 0
+"""
+
+
+def touch_analysis(database, analysis_id):
+    """
+    Records the current time as the last use of the analysis.
+    """
+
+    database.zadd(ANALYSES_KEY, {analysis_id: time.time()})
+
+
+def completion_target(parts, expected_parts):
+    """
+    Returns the number of the completed parts which complete the analysis.
+    It is the number of the parts announced by the client, or the number of
+    the parts received so far if the client did not announce it.
+    """
+
+    if expected_parts is not None:
+        return int(expected_parts)
+
+    return int(parts or 0)
+
+
+def mark_queued(database, analysis_id):
+    """
+    Marks the analysis queued if it is not completed yet.
+    """
+
+    return database.eval(QUEUE_SCRIPT, 1, analysis_id)
+
+
+def reported_state(state, completed_parts, expected_parts):
+    """
+    Returns the state of the analysis as reported to the clients. The
+    analyzers complete an analysis when every part received so far is
+    completed, so an analysis whose client announced more parts is still in
+    progress.
+    """
+
+    if state == "ANALYZE_COMPLETED" and expected_parts is not None and \
+            int(completed_parts or 0) < int(expected_parts):
+        return "ANALYZE_IN_PROGRESS"
+
+    return state
+
+
+def analysis_state(database, analysis_id):
+    """
+    Returns the reported state of the analysis, or None if it does not
+    exist.
+    """
+
+    state, completed_parts, expected_parts = database.hmget(
+        analysis_id, "state", "completed_parts", "expected_parts")
+
+    if state is None:
+        return None
+
+    return reported_state(state.decode("utf-8"), completed_parts,
+                          expected_parts)
+
+
+def read_statuses(database, analysis_ids):
+    """
+    Returns a dict of the given analyses and their states, part counts,
+    submitters, priorities and times of last use. The hashes are read in
+    pipelines. Analyses which do not exist are left out.
+    """
+
+    statuses = {}
+    analysis_ids = list(analysis_ids)
+
+    for index in range(0, len(analysis_ids), READ_BATCH_SIZE):
+        batch = analysis_ids[index:index + READ_BATCH_SIZE]
+
+        pipeline = database.pipeline(transaction=False)
+        for analysis_id in batch:
+            pipeline.hmget(analysis_id, *FIELDS)
+            pipeline.zscore(ANALYSES_KEY, analysis_id)
+        results = pipeline.execute()
+
+        for position, analysis_id in enumerate(batch):
+            values = results[2 * position]
+            last_use = results[2 * position + 1]
+
+            state, parts, completed_parts, cached_parts, submitter, \
+                priority, expected_parts = values
+            if state is None:
+                continue
+
+            statuses[analysis_id] = {
+                "state": reported_state(state.decode("utf-8"),
+                                        completed_parts, expected_parts),
+                "parts": int(parts or 0),
+                "completed_parts": int(completed_parts or 0),
+                "cached_parts": int(cached_parts or 0),
+                "submitter":
+                    submitter.decode("utf-8") if submitter else None,
+                "priority":
+                    priority.decode("utf-8") if priority else "NORMAL",
+                "last_use": last_use or 0.0}
+
+    return statuses
+
+
+def list_analyses(database, cursor, limit, state=None, submitter=None,
+                  priority=None):
+    """
+    Returns the analyses which match the given state, submitter and
+    priority from the next about limit analyses, and the cursor of the next
+    page, which is empty after the last page.
+
+    The analyses are iterated with ZSCAN over the index of the retention, so
+    an analysis which exists during the whole listing is returned at least
+    once, and a page of a selective filter may be empty before the last one.
+    """
+
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    scan_cursor = int(cursor) if cursor else 0
+    examined = 0
+    matching = []
+
+    while True:
+        scan_cursor, members = database.zscan(
+            ANALYSES_KEY, scan_cursor, count=limit - examined)
+        examined += len(members)
+
+        statuses = read_statuses(
+            database, [member.decode("utf-8") for member, _ in members])
+
+        for analysis_id, status in statuses.items():
+            if state is not None and status["state"] != state:
+                continue
+            if submitter is not None and status["submitter"] != submitter:
+                continue
+            if priority is not None and status["priority"] != priority:
+                continue
+
+            status["analysis_id"] = analysis_id
+            matching.append(status)
+
+        if scan_cursor == 0 or examined >= limit:
+            break
+
+    return matching, str(scan_cursor) if scan_cursor else ""
@@ -0,0 +1,132 @@
+"""
+Content-addressable store of the uploaded files in the workspace.
+"""
+
+import errno
+import os
+import re
+import shutil
+import stat
+import uuid
+
+# Directory of the store in the workspace.
+BLOBS_DIR = "blobs"
+
+# The blobs are sharded into two levels of directories by the first
+# characters of their hashes, so no directory grows too large.
+SHARD_LENGTH = 2
+SHARD_LEVELS = 2
+
+# Marker of the store whose blobs were copied to the parts at least once,
+# so the number of their links does not tell whether a part uses them.
+COPIED_MARKER = ".copied"
+
+# The names of the blobs are MD5 hashes. Anything else could name a path
+# outside of the store.
+HASH_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+
+def is_valid_hash(hash_value):
+    """
+    Returns True if the value is a hex encoded MD5 hash.
+    """
+
+    return isinstance(hash_value, str) and \
+        HASH_PATTERN.match(hash_value) is not None
+
+
+class BlobStore:
+    """
+    Stores files named by their MD5 hashes under WORKSPACE/blobs/ab/cd/.
+
+    The blobs are read-only and are placed into the source trees of the
+    parts by hardlinks, so the same header is stored on the disk only once.
+    When hardlinks are not possible, for example the target is on another
+    file system, the blob is copied and the store is marked, as its blobs
+    can not be told apart from the unused ones by their links anymore.
+    """
+
+    def __init__(self, workspace):
+        self.root = os.path.join(workspace, BLOBS_DIR)
+        self._copied = False
+
+    def path(self, hash_value):
+        """
+        Returns the path of the blob with the given hash. Raises ValueError
+        if the hash is not a valid MD5 hash.
+        """
+
+        if not is_valid_hash(hash_value):
+            raise ValueError("Invalid hash of a blob: %r" % (hash_value,))
+
+        shards = [hash_value[level * SHARD_LENGTH:(level + 1) * SHARD_LENGTH]
+                  for level in range(SHARD_LEVELS)]
+
+        return os.path.join(self.root, *shards, hash_value)
+
+    def contains(self, hash_value):
+        return is_valid_hash(hash_value) and \
+            os.path.isfile(self.path(hash_value))
+
+    def store(self, hash_value, content):
+        """
+        Stores the content under the given hash. The blob is replaced
+        atomically, so concurrent uploads of the same file are safe.
+        """
+
+        blob_path = self.path(hash_value)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+
+        temp_path = blob_path + "_" + str(uuid.uuid4()) + ".tmp"
+        with open(temp_path, "wb") as blob:
+            blob.write(content)
+        os.chmod(temp_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        os.replace(temp_path, blob_path)
+
+    def has_copies(self):
+        """
+        Returns True if a blob of the store was ever copied to a part
+        instead of hardlinked.
+        """
+
+        return self._copied or \
+            os.path.exists(os.path.join(self.root, COPIED_MARKER))
+
+    def remove(self, hash_value):
+        if not is_valid_hash(hash_value):
+            return
+
+        try:
+            os.remove(self.path(hash_value))
+        except FileNotFoundError:
+            pass
+
+    def materialize(self, hash_value, target_path):
+        """
+        Places the blob to the target path, by a hardlink when possible.
+        Returns False if the blob is not in the store or the hash is not
+        valid.
+        """
+
+        if not is_valid_hash(hash_value):
+            return False
+
+        blob_path = self.path(hash_value)
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+
+        try:
+            os.link(blob_path, target_path)
+        except FileNotFoundError:
+            return False
+        except FileExistsError:
+            pass
+        except OSError as os_error:
+            if os_error.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            shutil.copyfile(blob_path, target_path)
+
+            if not self._copied:
+                self._copied = True
+                open(os.path.join(self.root, COPIED_MARKER), "a").close()
+
+        return True
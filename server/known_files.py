@@ -0,0 +1,165 @@
+"""
+Index of the files which are available on the server, stored in Redis.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+# The hashes are spread over buckets by their first characters. A Redis hash
+# with few small fields is stored in the compact ziplist encoding, so with
+# the default hash-max-ziplist-entries of 128 millions of files stay compact.
+BUCKET_KEY_PREFIX = "FILES:"
+BUCKET_PREFIX_LENGTH = 4
+
+STATS_KEY = "FILES_STATS"
+
+# Sorted set of the known files scored by the time of their last use.
+ACCESS_KEY = "FILES_LRU"
+
+# Number of hashes checked in one pipeline.
+PIPELINE_BATCH_SIZE = 1000
+
+DEFAULT_CACHE_TTL = 60
+DEFAULT_CACHE_SIZE = 100000
+
+
+def bucket_key(hash_value):
+    return BUCKET_KEY_PREFIX + hash_value[:BUCKET_PREFIX_LENGTH]
+
+
+class KnownFiles:
+    """
+    Keeps the hashes and sizes of the known files in bucketed Redis hashes
+    and the number and total size of them in a statistics hash. The time of
+    the last use of every file is kept for the retention.
+
+    Hashes found in the database are remembered in the process for
+    cache_ttl seconds, so repeated queries for hot files do not reach Redis.
+    Missing hashes are never cached, because another connection may upload
+    them at any time.
+    """
+
+    def __init__(self, database, cache_ttl=DEFAULT_CACHE_TTL,
+                 cache_size=DEFAULT_CACHE_SIZE):
+        self.database = database
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+
+    def missing(self, hashes):
+        """
+        Returns the given hashes which are not known, in their order.
+        """
+
+        now = time.monotonic()
+        to_check = []
+
+        with self._lock:
+            for hash_value in hashes:
+                expires = self._cache.get(hash_value)
+                if expires is None or expires < now:
+                    to_check.append(hash_value)
+                else:
+                    self._cache.move_to_end(hash_value)
+
+        missing_files = []
+        found_files = []
+
+        for index in range(0, len(to_check), PIPELINE_BATCH_SIZE):
+            batch = to_check[index:index + PIPELINE_BATCH_SIZE]
+
+            pipeline = self.database.pipeline(transaction=False)
+            for hash_value in batch:
+                pipeline.hexists(bucket_key(hash_value), hash_value)
+
+            for hash_value, exists in zip(batch, pipeline.execute()):
+                if exists:
+                    found_files.append(hash_value)
+                else:
+                    missing_files.append(hash_value)
+
+        self._remember(found_files)
+        self.touch(found_files)
+
+        return missing_files
+
+    def add(self, hash_value, size):
+        """
+        Registers a stored file.
+        """
+
+        if self.database.hsetnx(bucket_key(hash_value), hash_value, size):
+            pipeline = self.database.pipeline(transaction=False)
+            pipeline.hincrby(STATS_KEY, "count", 1)
+            pipeline.hincrby(STATS_KEY, "bytes", size)
+            pipeline.execute()
+
+        self._remember([hash_value])
+        self.touch([hash_value])
+
+    def touch(self, hashes):
+        """
+        Records the current time as the last use of the given files.
+        """
+
+        now = time.time()
+
+        for index in range(0, len(hashes), PIPELINE_BATCH_SIZE):
+            self.database.zadd(ACCESS_KEY, {
+                hash_value: now
+                for hash_value in hashes[index:index + PIPELINE_BATCH_SIZE]})
+
+    def least_recently_used(self, used_before, count):
+        """
+        Returns at most count hashes of the files which were not used since
+        the given time, the least recently used first.
+        """
+
+        return [hash_value.decode("utf-8") for hash_value in
+                self.database.zrangebyscore(ACCESS_KEY, "-inf", used_before,
+                                            start=0, num=count)]
+
+    def remove(self, hash_value):
+        """
+        Unregisters a file.
+        """
+
+        key = bucket_key(hash_value)
+        size = self.database.hget(key, hash_value)
+
+        if size is not None and self.database.hdel(key, hash_value):
+            pipeline = self.database.pipeline(transaction=False)
+            pipeline.hincrby(STATS_KEY, "count", -1)
+            pipeline.hincrby(STATS_KEY, "bytes", -int(size))
+            pipeline.execute()
+
+        self.database.zrem(ACCESS_KEY, hash_value)
+
+        with self._lock:
+            self._cache.pop(hash_value, None)
+
+    def stats(self):
+        """
+        Returns the number and the total size of the known files.
+        """
+
+        count, size = self.database.hmget(STATS_KEY, "count", "bytes")
+
+        return {"count": int(count or 0), "bytes": int(size or 0)}
+
+    def _remember(self, hashes):
+        if not self.cache_ttl:
+            return
+
+        expires = time.monotonic() + self.cache_ttl
+
+        with self._lock:
+            for hash_value in hashes:
+                self._cache[hash_value] = expires
+                self._cache.move_to_end(hash_value)
+
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
@@ -0,0 +1,349 @@
+"""
+Histograms and counters of the requests of the controller, exposed in the
+Prometheus text format.
+"""
+
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import redis
+
+LOG = logging.getLogger("SERVER")
+
+# Hash of the metrics of every process of every controller. The fields are
+# the JSON encoded name, labels and bucket of a series.
+METRICS_KEY = "METRICS"
+
+PREFIX = "remote_codechecker_"
+
+# Upper bounds of the buckets of the histograms.
+SECONDS_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+                   5, 10, 30, 60, 300]
+BYTES_BUCKETS = [2 ** exponent for exponent in range(6, 30, 2)]
+
+# Type, help and buckets of the metrics.
+METRICS = {
+    "rpc_duration_seconds": (
+        "histogram", "Time of the requests by method.", SECONDS_BUCKETS),
+    "rpc_redis_seconds": (
+        "histogram", "Time spent in Redis commands by method.",
+        SECONDS_BUCKETS),
+    "rpc_request_bytes": (
+        "histogram", "Size of the binary arguments of the requests.",
+        BYTES_BUCKETS),
+    "rpc_response_bytes": (
+        "histogram", "Size of the binary responses.", BYTES_BUCKETS),
+    "rpc_errors_total": (
+        "counter", "Requests which raised an exception.", None),
+    "checked_files_total": (
+        "counter", "Hashes asked by checkUploadedFiles by whether the file "
+                   "was known.", None),
+    "stored_files_total": (
+        "counter", "Uploaded files stored in the blob store.", None),
+    "stored_file_bytes_total": (
+        "counter", "Bytes of the uploaded files stored in the blob store.",
+        None),
+    "queued_parts_total": (
+        "counter", "Received parts by whether their reports were taken from "
+                   "the result cache.", None),
+    "refused_requests_total": (
+        "counter", "Uploads refused by the admission control by reason.",
+        None),
+}
+
+# Seconds between two flushes of the metrics of a process to the database.
+DEFAULT_FLUSH_INTERVAL = 5.0
+
+
+class Metrics:
+    """
+    Collects the metrics of the process in memory and adds them to the
+    METRICS hash in the database periodically, so the metrics of the forked
+    workers and of other controllers are exposed together.
+    """
+
+    def __init__(self, database, flush_interval=DEFAULT_FLUSH_INTERVAL):
+        self.database = database
+        self.flush_interval = flush_interval
+
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._pending = {}
+        self._flusher_pid = None
+        self._local = threading.local()
+
+    def increment(self, name, labels=None, amount=1):
+        """
+        Increases the counter of the given labels.
+        """
+
+        self._add(json.dumps([name, labels or {}, None], sort_keys=True),
+                  amount)
+
+    def observe(self, name, value, labels=None):
+        """
+        Records a value in the histogram of the given labels.
+        """
+
+        buckets = METRICS[name][2]
+        index = bisect.bisect_left(buckets, value)
+        bucket = buckets[index] if index < len(buckets) else "+Inf"
+        labels = labels or {}
+
+        self._add(json.dumps([name, labels, bucket], sort_keys=True), 1)
+        self._add(json.dumps([name, labels, "sum"], sort_keys=True), value)
+
+    def _add(self, field, amount):
+        self._ensure_flusher()
+
+        with self._lock:
+            self._pending[field] = self._pending.get(field, 0) + amount
+
+    def _ensure_flusher(self):
+        """
+        Starts the flusher thread in the current process. Forked workers
+        start their own one and drop the metrics of the parent.
+        """
+
+        if self._flusher_pid == os.getpid():
+            return
+
+        with self._start_lock:
+            if self._flusher_pid == os.getpid():
+                return
+
+            self._lock = threading.Lock()
+            self._pending = {}
+            self._flusher_pid = os.getpid()
+
+        thread = threading.Thread(target=self._flush_periodically,
+                                  daemon=True, name="metrics-flusher")
+        thread.start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except redis.RedisError as redis_error:
+                LOG.warning("Metrics can not be stored: %s", redis_error)
+
+    def flush(self):
+        """
+        Adds the metrics collected since the last flush to the database.
+        """
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        if not pending:
+            return
+
+        pipeline = self.database.pipeline(transaction=False)
+        for field, amount in pending.items():
+            pipeline.hincrbyfloat(METRICS_KEY, field, amount)
+        pipeline.execute()
+
+    def begin_request(self):
+        """
+        Starts counting the time of the Redis commands of the request served
+        by the current thread.
+        """
+
+        self._local.redis_seconds = 0.0
+
+    def end_request(self):
+        """
+        Returns the time of the Redis commands since begin_request.
+        """
+
+        redis_seconds = getattr(self._local, "redis_seconds", 0.0)
+        self._local.redis_seconds = None
+
+        return redis_seconds
+
+    def add_redis_time(self, seconds):
+        if getattr(self._local, "redis_seconds", None) is not None:
+            self._local.redis_seconds += seconds
+
+    def render(self, gauges=None):
+        """
+        Returns the metrics in the Prometheus text format. The gauges are
+        (name, help, {labels: value}) tuples of current values.
+        """
+
+        self.flush()
+
+        series = {}
+        for field, value in self.database.hgetall(METRICS_KEY).items():
+            name, labels, bucket = json.loads(field.decode("utf-8"))
+            key = (name, tuple(sorted(labels.items())))
+            series.setdefault(key, {})[bucket] = float(value)
+
+        lines = []
+        for name, (kind, help_text, buckets) in sorted(METRICS.items()):
+            lines.append("# HELP %s%s %s" % (PREFIX, name, help_text))
+            lines.append("# TYPE %s%s %s" % (PREFIX, name, kind))
+
+            for (series_name, labels), values in sorted(series.items()):
+                if series_name != name:
+                    continue
+
+                if kind == "counter":
+                    lines.append(format_sample(name, labels, values[None]))
+                    continue
+
+                count = 0
+                for bound in buckets + ["+Inf"]:
+                    count += values.get(bound, 0)
+                    lines.append(format_sample(
+                        name + "_bucket",
+                        labels + (("le", format_value(bound)),), count))
+                lines.append(format_sample(name + "_sum", labels,
+                                           values.get("sum", 0)))
+                lines.append(format_sample(name + "_count", labels, count))
+
+        for name, help_text, values in gauges or []:
+            lines.append("# HELP %s%s %s" % (PREFIX, name, help_text))
+            lines.append("# TYPE %s%s gauge" % (PREFIX, name))
+            for labels, value in sorted(values.items()):
+                lines.append(format_sample(name, labels, value))
+
+        return "\n".join(lines) + "\n"
+
+    def serve(self, host, port, gauges=None):
+        """
+        Serves the metrics on /metrics of the given address from a thread.
+        gauges is called for the current gauges on every request.
+        """
+
+        metrics = self
+
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+
+                body = metrics.render(
+                    gauges() if gauges is not None else None).encode("utf-8")
+
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *_):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        server.daemon_threads = True
+
+        thread = threading.Thread(target=server.serve_forever, daemon=True,
+                                  name="metrics-server")
+        thread.start()
+
+        return server
+
+
+def format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def format_sample(name, labels, value):
+    label_text = ",".join('%s="%s"' % (label, str(label_value).replace(
+        "\\", "\\\\").replace('"', '\\"')) for label, label_value in labels)
+
+    return "%s%s%s %s" % (PREFIX, name,
+                          "{%s}" % label_text if label_text else "",
+                          format_value(float(value)))
+
+
+class TimedDatabase:
+    """
+    Forwards the commands to the Redis client and adds their time to the
+    request served by the current thread.
+    """
+
+    def __init__(self, database, metrics):
+        self._database = database
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        attribute = getattr(self._database, name)
+
+        if not callable(attribute):
+            return attribute
+
+        if name == "pipeline":
+            return lambda *args, **kwargs: TimedDatabase(
+                attribute(*args, **kwargs), self._metrics)
+
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                self._metrics.add_redis_time(time.perf_counter() - started)
+
+        return timed
+
+
+class InstrumentedHandler:
+    """
+    Forwards the requests to the handler and records their time, the time of
+    their Redis commands, the size of their binary payloads and their
+    exceptions by method.
+    """
+
+    def __init__(self, handler, metrics):
+        self._handler = handler
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        method = getattr(self._handler, name)
+
+        if name.startswith("_") or not callable(method):
+            return method
+
+        def instrumented(*args):
+            labels = {"method": name}
+
+            request_bytes = sum(len(argument) for argument in args
+                                if isinstance(argument, bytes))
+            if request_bytes:
+                self._metrics.observe("rpc_request_bytes", request_bytes,
+                                      labels)
+
+            self._metrics.begin_request()
+            started = time.perf_counter()
+            try:
+                response = method(*args)
+            except Exception as exception:
+                self._metrics.increment(
+                    "rpc_errors_total",
+                    {"method": name,
+                     "exception": type(exception).__name__})
+                raise
+            finally:
+                self._metrics.observe("rpc_duration_seconds",
+                                      time.perf_counter() - started, labels)
+                self._metrics.observe("rpc_redis_seconds",
+                                      self._metrics.end_request(), labels)
+
+            if isinstance(response, bytes):
+                self._metrics.observe("rpc_response_bytes", len(response),
+                                      labels)
+
+            return response
+
+        return instrumented
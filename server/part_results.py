@@ -0,0 +1,166 @@
+"""
+Log of the completed parts of the analyses and the reports of single parts.
+"""
+
+import io
+import os
+import re
+import zipfile
+
+from analysis_status import completion_target
+from result_cache import PART_OUTPUT_DIR
+
+# Sorted set of the completed parts of an analysis scored by the order of
+# their completion, which is the cursor of the clients.
+COMPLETED_PARTS_KEY = "COMPLETED_PARTS:%s"
+
+PART_OUTPUT_PATTERN = re.compile(r"^output_(\d+)$")
+
+# Upper limit of the parts returned by one getCompletedParts call.
+MAX_PARTS_PER_CALL = 10000
+
+# Adds a part to the log once and returns its sequence number, or 0 if it
+# was already logged. Parts are never removed from the log, so its size is
+# the last sequence number.
+RECORD_SCRIPT = """
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    return 0
+end
+local sequence = redis.call('ZCARD', KEYS[1]) + 1
+redis.call('ZADD', KEYS[1], sequence, ARGV[1])
+return sequence
+"""
+
+# Counts a part of the analysis as completed and logs it in the same step.
+# Returns the number of the completed parts of the analysis, or 0 if the
+# part was already completed.
+COMPLETE_SCRIPT = """
+if redis.call('ZSCORE', KEYS[2], ARGV[1]) then
+    return 0
+end
+local sequence = redis.call('ZCARD', KEYS[2]) + 1
+redis.call('ZADD', KEYS[2], sequence, ARGV[1])
+return redis.call('HINCRBY', KEYS[1], 'completed_parts', 1)
+"""
+
+
+class PartResults:
+    """
+    Keeps the log of the completed parts of the analyses.
+
+    The parts are counted and logged in one step by complete, which the
+    controller calls for the parts taken from the result cache and the
+    analyzer workers for the parts they analyzed. Workers which only count
+    the completed parts are supported too: when their analysis is
+    completed, the output directories of its unlogged parts are logged.
+    """
+
+    def __init__(self, database, workspace):
+        self.database = database
+        self.workspace = workspace
+
+        self._record = database.register_script(RECORD_SCRIPT)
+        self._complete = database.register_script(COMPLETE_SCRIPT)
+
+    def complete(self, analysis_id, part_number):
+        """
+        Counts the part of the analysis as completed and logs it. Returns
+        the number of the completed parts of the analysis, or 0 if the part
+        was already completed.
+        """
+
+        return self._complete(
+            keys=[analysis_id, COMPLETED_PARTS_KEY % analysis_id],
+            args=[part_number])
+
+    def record(self, analysis_id, part_number):
+        """
+        Logs the part of the analysis as completed without counting it.
+        """
+
+        self._record(keys=[COMPLETED_PARTS_KEY % analysis_id],
+                     args=[part_number])
+
+    def completed(self, analysis_id, cursor):
+        """
+        Returns the numbers of the parts completed after the given cursor in
+        the order of their completion, and the cursor of the last one.
+        Returns None if the analysis does not exist.
+        """
+
+        if not self._reconcile(analysis_id):
+            return None
+
+        position = int(cursor) if cursor else 0
+        logged = self.database.zrangebyscore(
+            COMPLETED_PARTS_KEY % analysis_id, "(%d" % position, "+inf",
+            start=0, num=MAX_PARTS_PER_CALL, withscores=True)
+
+        part_numbers = [int(member) for member, _ in logged]
+        if logged:
+            position = int(logged[-1][1])
+
+        return part_numbers, str(position)
+
+    def is_completed(self, analysis_id, part_number):
+        """
+        Returns True if the part of the analysis is logged as completed.
+        """
+
+        key = COMPLETED_PARTS_KEY % analysis_id
+        if self.database.zscore(key, part_number) is not None:
+            return True
+
+        self._reconcile(analysis_id)
+        return self.database.zscore(key, part_number) is not None
+
+    def part_zip(self, analysis_id, part_number):
+        """
+        Returns a ZIP file of the reports of the part.
+        """
+
+        part_output = os.path.join(self.workspace, analysis_id,
+                                   PART_OUTPUT_DIR % part_number)
+
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+            for root, _, files in os.walk(part_output):
+                for file_name in files:
+                    file_path = os.path.join(root, file_name)
+                    archive.write(file_path,
+                                  os.path.relpath(file_path, part_output))
+
+        return buffer.getvalue()
+
+    def _reconcile(self, analysis_id):
+        """
+        Logs the output directories of the parts of a completed analysis
+        which were completed by workers that do not log their parts.
+        Returns False if the analysis does not exist.
+        """
+
+        parts, completed_parts, expected_parts = self.database.hmget(
+            analysis_id, "parts", "completed_parts", "expected_parts")
+        if completed_parts is None:
+            return False
+
+        completed_parts = int(completed_parts)
+        if completed_parts < completion_target(parts, expected_parts):
+            return True
+
+        key = COMPLETED_PARTS_KEY % analysis_id
+        if self.database.zcard(key) >= completed_parts:
+            return True
+
+        analysis_dir = os.path.join(self.workspace, analysis_id)
+        try:
+            entries = os.listdir(analysis_dir)
+        except OSError:
+            return True
+
+        part_numbers = sorted(int(match.group(1)) for match in map(
+            PART_OUTPUT_PATTERN.match, entries) if match)
+        for part_number in part_numbers:
+            self.record(analysis_id, part_number)
+
+        return True
@@ -5,19 +5,55 @@ Server for handling remote analyze requests with CodeChecker.
 """
 
 import argparse
+import hashlib
+import io
+import json
 import logging
 import os
+import socket
 import uuid
+import zipfile
 from enum import Enum
 
 import redis
-from thrift.protocol import TBinaryProtocol
-from thrift.server import TServer
+from thrift.protocol import TBinaryProtocol, TCompactProtocol
+from thrift.server import TNonblockingServer, TProcessPoolServer, TServer
 from thrift.transport import TSocket, TTransport
 
+from admission import DEFAULT_RETRY_AFTER, AdmissionControl
+from analysis_status import analysis_state, completion_target, list_analyses
+from analysis_status import mark_queued, read_statuses, touch_analysis
+from blob_store import BlobStore, is_valid_hash
+from known_files import DEFAULT_CACHE_TTL, KnownFiles
+from metrics import InstrumentedHandler, Metrics, TimedDatabase
+from part_results import MAX_PARTS_PER_CALL, PartResults
 from remote_analyze_api import RemoteAnalyze
 from remote_analyze_api.ttypes import AnalysisNotFoundException
 from remote_analyze_api.ttypes import AnalysisNotCompletedException
+from remote_analyze_api.ttypes import AnalysisPage
+from remote_analyze_api.ttypes import AnalysisStatus
+from remote_analyze_api.ttypes import CompletedParts
+from remote_analyze_api.ttypes import InvalidUploadException
+from remote_analyze_api.ttypes import PartStats
+from remote_analyze_api.ttypes import Priority
+from remote_analyze_api.ttypes import QueueStats
+from remote_analyze_api.ttypes import Report
+from remote_analyze_api.ttypes import ReportPage
+from remote_analyze_api.ttypes import ReportSummary
+from remote_analyze_api.ttypes import ResultsInfo
+from remote_analyze_api.ttypes import ServerBusyException
+from remote_analyze_api.ttypes import ShardInfo
+from remote_analyze_api.ttypes import UploadKind
+from remote_analyze_api.ttypes import UploadNotFoundException
+from report_index import ReportIndex, request_index
+from result_cache import ResultCache, build_results
+from retention import UPLOAD_KEY_PREFIX, UPLOADS_DIR, RetentionEngine
+from scheduler import DEFAULT_DISPATCH_DEPTH, Scheduler
+from shards import SHARD_NAME_PATTERN, LoadTrackingHandler
+from shards import shard_analysis_id, shard_load
+from status_watcher import StatusWatcher
+from retention import DEFAULT_COMPLETED_TTL, DEFAULT_INTERVAL
+from retention import DEFAULT_STALE_TTL, DEFAULT_UPLOAD_TTL
 
 LOG = logging.getLogger("SERVER")
 LOG.setLevel(logging.INFO)
@@ -28,6 +64,34 @@ formatter = logging.Formatter(
 ch.setFormatter(formatter)
 LOG.addHandler(ch)
 
+# Committed uploads are remembered by their size and checksum for a while,
+# so a client whose reply of the commit was lost can repeat it.
+COMMITTED_KEY_PREFIX = "UPLOAD_COMMITTED:"
+COMMITTED_TTL = 3600
+
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+READ_CHUNK_SIZE = 1024 * 1024
+
+# Upper limit of the time a connection may wait for a status change in
+# seconds. A waiting connection holds a worker of the server, so the clients
+# poll again instead of waiting long.
+MAX_WAIT_TIMEOUT = 20
+
+# Seconds a connection may be idle between its requests before the thread
+# and process engines close it and free its worker.
+DEFAULT_CLIENT_TIMEOUT = 60
+
+PROTOCOL_FACTORIES = {
+    "binary": TBinaryProtocol.TBinaryProtocolFactory,
+    "compact": TCompactProtocol.TCompactProtocolFactory,
+}
+
+# Metrics of the requests, None if they are not collected.
+METRICS = None
+
+# Name of the shard of the controller, None if it is not sharded.
+SHARD = None
+
 
 class AnalyzeStatus(Enum):
     """
@@ -41,27 +105,50 @@ class AnalyzeStatus(Enum):
 
 
 class RemoteAnalyzeHandler:
-    def __init__(self):
-        self.log = {}
+    """
+    Handles the requests of the clients. The handler keeps no state of its
+    own, everything is stored in the database and in the workspace, so it can
+    be used by concurrent threads and processes.
+    """
 
-    def getId(self):
+    def getId(self, options):
         """
-        Privides a uuid for the analysation.
+        Privides a uuid for the analysation. The options set the priority
+        class of its parts and the submitter and weight its parts are shared
+        the workers by. With the expected number of parts the analysation is
+        not reported completed before so many parts are completed.
         """
 
         LOG.debug("Provide an id for the analysis")
 
-        new_analyze_id = str(uuid.uuid4())
+        self._admit(new_work=True)
+
+        new_analyze_id = shard_analysis_id(SHARD, str(uuid.uuid4()))
 
         REDIS_DATABASE.hset(new_analyze_id, "state",
                             AnalyzeStatus.ID_PROVIDED.name)
 
         REDIS_DATABASE.hset(new_analyze_id, "completed_parts", 0)
 
+        if options is not None:
+            if options.priority is not None:
+                priority = Priority._VALUES_TO_NAMES[options.priority]
+                REDIS_DATABASE.hset(new_analyze_id, "priority", priority)
+            if options.submitter:
+                REDIS_DATABASE.hset(new_analyze_id, "submitter",
+                                    options.submitter)
+            if options.weight:
+                REDIS_DATABASE.hset(new_analyze_id, "weight",
+                                    max(options.weight, 1))
+            if options.expectedParts:
+                REDIS_DATABASE.hset(new_analyze_id, "expected_parts",
+                                    options.expectedParts)
+
+        touch_analysis(REDIS_DATABASE, new_analyze_id)
+
         new_analyze_dir = os.path.abspath(
             os.path.join(WORKSPACE, new_analyze_id))
-        if not os.path.exists(new_analyze_dir):
-            os.makedirs(new_analyze_dir)
+        os.makedirs(new_analyze_dir, exist_ok=True)
 
         return new_analyze_id
 
@@ -72,13 +159,49 @@ class RemoteAnalyzeHandler:
 
         LOG.debug("Check missing files")
 
-        missing_files = []
+        # Only MD5 hashes name files of the store, anything else is skipped.
+        invalid_hashes = [hash_value for hash_value in fileHashes
+                          if not is_valid_hash(hash_value)]
+        if invalid_hashes:
+            LOG.warning("Skip %d invalid file hashes.", len(invalid_hashes))
+            fileHashes = [hash_value for hash_value in fileHashes
+                          if is_valid_hash(hash_value)]
+
+        missing_files = KNOWN_FILES.missing(fileHashes)
+
+        # Files which were removed from the store behind the database are
+        # unregistered and reported as missing.
+        missing_set = set(missing_files)
         for hash_value in fileHashes:
-            if REDIS_DATABASE.get(hash_value) is None:
+            if hash_value not in missing_set and \
+                    not BLOB_STORE.contains(hash_value):
+                LOG.warning("File %s is not in the store anymore.",
+                            hash_value)
+                KNOWN_FILES.remove(hash_value)
                 missing_files.append(hash_value)
+                missing_set.add(hash_value)
+
+        if METRICS is not None:
+            METRICS.increment("checked_files_total", {"known": "false"},
+                              len(missing_files))
+            METRICS.increment("checked_files_total", {"known": "true"},
+                              len(fileHashes) - len(missing_files))
 
         return missing_files
 
+    def uploadFiles(self, zipFile):
+        """
+        Stores the files of the received ZIP file, which are named by their
+        hashes, in the blob store and registers them in the database so later
+        parts can refer them in their cached_files.
+        """
+
+        LOG.debug("Store uploaded files")
+
+        self._admit()
+
+        self._store_files(io.BytesIO(zipFile))
+
     def analyze(self, analyzeId, zipFile):
         """
         Prepares the analysation step.
@@ -86,28 +209,10 @@ class RemoteAnalyzeHandler:
 
         LOG.debug("Store new part sources for analysis %s", analyzeId)
 
-        file_name = "source"
-        part_number = 1
-        file_extension = ".zip"
+        self._admit(analyzeId, new_work=True)
 
-        file_path = os.path.join(
-            WORKSPACE, analyzeId, file_name + "_" +
-            str(part_number) + file_extension
-        )
-
-        if os.path.isfile(file_path):
-            while True:
-                part_number += 1
-                new_file_path = os.path.join(WORKSPACE,
-                                             analyzeId,
-                                             file_name + "_" +
-                                             str(part_number) + file_extension,
-                                             )
-                if os.path.isfile(new_file_path):
-                    continue
-                else:
-                    file_path = new_file_path
-                    break
+        file_path = os.path.join(WORKSPACE, analyzeId,
+                                 "source_" + str(uuid.uuid4()) + ".tmp")
 
         with open(file_path, "wb") as source:
             try:
@@ -115,29 +220,423 @@ class RemoteAnalyzeHandler:
             except Exception:
                 LOG.error("Failed to store received ZIP.")
 
+        self._queue_part(analyzeId, file_path)
+
+    def beginUpload(self, analyzeId, kind):
+        """
+        Starts a chunked upload of a part of the analysis or of a ZIP file of
+        files named by their hashes, and returns the id of the upload.
+        """
+
+        self._admit(analyzeId, new_work=kind == UploadKind.PART)
+
+        upload_id = str(uuid.uuid4())
+
+        LOG.debug("Begin upload %s for analysis %s", upload_id, analyzeId)
+
+        os.makedirs(os.path.join(WORKSPACE, UPLOADS_DIR), exist_ok=True)
+        open(self._upload_path(upload_id), "wb").close()
+
+        REDIS_DATABASE.hset(UPLOAD_KEY_PREFIX + upload_id,
+                            "analysis", analyzeId)
+        REDIS_DATABASE.hset(UPLOAD_KEY_PREFIX + upload_id, "kind", kind)
+
+        if analyzeId:
+            touch_analysis(REDIS_DATABASE, analyzeId)
+
+        return upload_id
+
+    def getUploadOffset(self, uploadId):
+        """
+        Returns the number of bytes received so far, where an interrupted
+        upload has to be continued. The size of an upload committed
+        recently is returned too.
+        """
+
+        committed = self._get_committed(uploadId)
+        if committed is not None:
+            return committed[0]
+
+        self._get_upload(uploadId)
+
+        return os.path.getsize(self._upload_path(uploadId))
+
+    def uploadChunk(self, uploadId, offset, chunk):
+        """
+        Writes the chunk to the given offset of the upload and returns the
+        number of bytes received so far.
+        """
+
+        self._get_upload(uploadId)
+        self._admit()
+
+        if len(chunk) > MAX_CHUNK_SIZE:
+            raise InvalidUploadException(
+                "Chunk is larger than %d bytes." % MAX_CHUNK_SIZE)
+
+        upload_path = self._upload_path(uploadId)
+        received = os.path.getsize(upload_path)
+
+        if offset < 0 or offset > received:
+            raise InvalidUploadException(
+                "Chunk offset %d is not continuous with the %d bytes "
+                "received so far." % (offset, received))
+
+        with open(upload_path, "r+b") as upload:
+            upload.seek(offset)
+            upload.write(chunk)
+
+        return max(received, offset + len(chunk))
+
+    def commitUpload(self, uploadId, checksum):
+        """
+        Checks the MD5 checksum of the finished upload and stores it as a part
+        of the analysis or as uploaded files. A commit repeated with the same
+        checksum after a lost reply succeeds without storing it again.
+        """
+
+        committed = self._get_committed(uploadId)
+        if committed is not None and committed[1] == checksum:
+            LOG.debug("Upload %s is already committed.", uploadId)
+            return
+
+        analyze_id, kind = self._get_upload(uploadId)
+        self._admit()
+
+        if analyze_id:
+            touch_analysis(REDIS_DATABASE, analyze_id)
+
+        # The upload is claimed before it is read, so only one of concurrent
+        # commits of the same upload stores it.
+        if not REDIS_DATABASE.delete(UPLOAD_KEY_PREFIX + uploadId):
+            LOG.info("Upload %s is committed by another request.", uploadId)
+            raise UploadNotFoundException(
+                "Upload with the provided id is already committed.")
+
+        upload_path = self._upload_path(uploadId)
+
+        md5 = hashlib.md5()
+        with open(upload_path, "rb") as upload:
+            for chunk in iter(lambda: upload.read(READ_CHUNK_SIZE), b""):
+                md5.update(chunk)
+
+        if md5.hexdigest() != checksum:
+            os.remove(upload_path)
+            raise InvalidUploadException(
+                "Checksum of upload %s does not match." % uploadId)
+
+        LOG.debug("Commit upload %s for analysis %s", uploadId, analyze_id)
+
+        size = os.path.getsize(upload_path)
+
+        if kind == UploadKind.PART:
+            self._queue_part(analyze_id, upload_path)
+        else:
+            self._store_files(upload_path)
+            os.remove(upload_path)
+
+        # The commit is recorded only after the upload is stored, so a
+        # repeated commit never succeeds for an upload which was lost.
+        committed_key = COMMITTED_KEY_PREFIX + uploadId
+        pipeline = REDIS_DATABASE.pipeline(transaction=False)
+        pipeline.hset(committed_key, "size", size)
+        pipeline.hset(committed_key, "checksum", checksum)
+        pipeline.expire(committed_key, COMMITTED_TTL)
+        pipeline.execute()
+
+    def _upload_path(self, upload_id):
+        return os.path.join(WORKSPACE, UPLOADS_DIR, upload_id)
+
+    def _admit(self, analysis_id=None, new_work=False):
+        """
+        Raises ServerBusyException if the admission control refuses the
+        upload. new_work is given for the requests which add a new analysis
+        or part to the queue.
+        """
+
+        refusal = ADMISSION.refusal(analysis_id, new_work)
+        if refusal is None:
+            return
+
+        reason, message = refusal
+        LOG.info("Refuse the request: %s", message)
+        if METRICS is not None:
+            METRICS.increment("refused_requests_total", {"reason": reason})
+
+        raise ServerBusyException(
+            message=message, reason=reason,
+            retryAfterMs=int(ADMISSION.retry_after * 1000))
+
+    def _get_committed(self, upload_id):
+        """
+        Returns the size and the checksum of the upload if it was committed
+        recently, otherwise None.
+        """
+
+        size, checksum = REDIS_DATABASE.hmget(
+            COMMITTED_KEY_PREFIX + upload_id, "size", "checksum")
+
+        if size is None:
+            return None
+
+        return int(size), checksum.decode("utf-8")
+
+    def _get_upload(self, upload_id):
+        """
+        Returns the analysis id and the kind of the upload.
+        """
+
+        upload = REDIS_DATABASE.hgetall(UPLOAD_KEY_PREFIX + upload_id)
+
+        if not upload:
+            LOG.info("Upload with the provided id does not exist.")
+            raise UploadNotFoundException(
+                "Upload with the provided id does not exist.")
+
+        return upload[b"analysis"].decode("utf-8"), int(upload[b"kind"])
+
+    def _store_files(self, zip_file):
+        """
+        Stores the files of a ZIP file, which are named by their hashes, and
+        registers them in the database.
+        """
+
+        with zipfile.ZipFile(zip_file) as archive:
+            for hash_value in archive.namelist():
+                content = archive.read(hash_value)
+
+                if hashlib.md5(content).hexdigest() != hash_value:
+                    LOG.warning("Content of uploaded file %s does not match "
+                                "its hash, skip it.", hash_value)
+                    continue
+
+                BLOB_STORE.store(hash_value, content)
+                KNOWN_FILES.add(hash_value, len(content))
+
+                if METRICS is not None:
+                    METRICS.increment("stored_files_total")
+                    METRICS.increment("stored_file_bytes_total",
+                                      amount=len(content))
+
+    def _queue_part(self, analyzeId, source_path):
+        """
+        Moves the received ZIP file of a part to its place in the workspace
+        of the analysis, rebuilds its source tree and puts the part into the
+        queue.
+        """
+
+        # The part number is allocated atomically, so parts of the same
+        # analysis can be received by concurrent connections.
+        part_number = REDIS_DATABASE.hincrby(analyzeId, "parts", 1)
+        touch_analysis(REDIS_DATABASE, analyzeId)
+
+        file_path = os.path.join(
+            WORKSPACE, analyzeId, "source_" + str(part_number) + ".zip")
+
+        os.replace(source_path, file_path)
+
+        if RESULT_CACHE is not None:
+            fingerprint = RESULT_CACHE.fingerprint(file_path)
+
+            if RESULT_CACHE.reuse(fingerprint, analyzeId, part_number):
+                LOG.info("Part %s of analyze %s is taken from the result "
+                         "cache.", part_number, analyzeId)
+                if METRICS is not None:
+                    METRICS.increment("queued_parts_total",
+                                      {"result_cache": "hit"})
+                self._complete_cached_part(analyzeId, part_number)
+                return
+
+        self._materialize_part(file_path, os.path.splitext(file_path)[0])
+
         REDIS_DATABASE.hset(analyzeId, "state", AnalyzeStatus.QUEUED.name)
-        REDIS_DATABASE.hincrby(analyzeId, "parts", 1)
-        REDIS_DATABASE.rpush(
-            "ANALYSES_QUEUE", analyzeId + "_" + str(part_number))
+        SCHEDULER.enqueue(analyzeId, analyzeId + "_" + str(part_number),
+                          os.path.getsize(file_path))
+        if METRICS is not None:
+            METRICS.increment("queued_parts_total", {"result_cache": "miss"})
         LOG.info("Part %s is %s for analyze %s.",
                  part_number,
                  AnalyzeStatus.QUEUED.name,
                  analyzeId)
 
+    def _complete_cached_part(self, analyzeId, part_number):
+        """
+        Counts a part whose reports were taken from the result cache as
+        completed. If it completes the analysis, the results are built here,
+        as no analyzer takes part in it.
+        """
+
+        REDIS_DATABASE.hincrby(analyzeId, "cached_parts", 1)
+        completed_parts = PART_RESULTS.complete(analyzeId, part_number)
+        parts, expected_parts = REDIS_DATABASE.hmget(
+            analyzeId, "parts", "expected_parts")
+
+        if completed_parts < completion_target(parts, expected_parts):
+            mark_queued(REDIS_DATABASE, analyzeId)
+            return
+
+        # The number of the parts of the analysis is final, so its results
+        # are built once, even if its last parts complete concurrently.
+        if expected_parts is not None and \
+                not REDIS_DATABASE.hsetnx(analyzeId, "results_built", 1):
+            return
+
+        analysis_dir = os.path.join(WORKSPACE, analyzeId)
+        result_path = os.path.join(analysis_dir, "output.zip")
+        build_results(analysis_dir, result_path)
+        REPORT_INDEX.build(result_path)
+
+        REDIS_DATABASE.hset(analyzeId, "state",
+                            AnalyzeStatus.ANALYZE_COMPLETED.name)
+        LOG.info("Analyze %s is %s from the result cache.", analyzeId,
+                 AnalyzeStatus.ANALYZE_COMPLETED.name)
+
+    def _materialize_part(self, zip_path, part_dir):
+        """
+        Extracts the ZIP file of a part to the given directory and places the
+        files of its cached_files manifest to their paths in sources-root as
+        hardlinks from the blob store.
+        """
+
+        with zipfile.ZipFile(zip_path) as archive:
+            archive.extractall(part_dir)
+
+        sources_root = os.path.normpath(os.path.join(part_dir, "sources-root"))
+        manifest_path = os.path.join(sources_root, "cached_files")
+        if not os.path.isfile(manifest_path):
+            return
+
+        with open(manifest_path) as manifest:
+            cached_files = json.load(manifest)
+
+        for hash_value, file_name in cached_files.items():
+            if not is_valid_hash(hash_value):
+                LOG.warning("Cached file %s has an invalid hash, skip it.",
+                            file_name)
+                continue
+
+            target_path = os.path.normpath(
+                os.path.join(sources_root, file_name.lstrip(os.sep)))
+
+            if not target_path.startswith(sources_root + os.sep):
+                LOG.warning("Cached file %s is outside of the source tree, "
+                            "skip it.", file_name)
+                continue
+
+            if not BLOB_STORE.materialize(hash_value, target_path):
+                LOG.warning("Cached file %s is not in the store.", file_name)
+
+    def getQueueStats(self):
+        """
+        Returns the statistics of the queues of the priority classes.
+        """
+
+        return {priority: QueueStats(depth=stats["depth"],
+                                     dispatched=stats["dispatched"],
+                                     averageWait=stats["average_wait"],
+                                     maxWait=stats["max_wait"])
+                for priority, stats in SCHEDULER.stats().items()}
+
+    def getShardInfo(self):
+        """
+        Returns the name of the shard of the controller, which prefixes the
+        ids of its analysations, and the number of its uploads in progress.
+        """
+
+        if SHARD is None:
+            return ShardInfo(shard="", activeUploads=0)
+
+        return ShardInfo(shard=SHARD,
+                         activeUploads=shard_load(REDIS_DATABASE, SHARD))
+
     def getStatus(self, analyzeId):
         """
         Returns the status of the analysation.
         """
         LOG.info("Get status of analysis %s", analyzeId)
 
-        analysis_state = REDIS_DATABASE.hget(analyzeId, "state")
+        state = analysis_state(REDIS_DATABASE, analyzeId)
 
-        if analysis_state is not None:
-            return analysis_state.decode('utf-8')
+        if state is not None:
+            touch_analysis(REDIS_DATABASE, analyzeId)
+            return state
         else:
             LOG.info("Analysis with the provided id does not exist.")
-            raise AnalysisNotFoundException("Analysis with the provided id does not exist.")
+            raise AnalysisNotFoundException(
+                "Analysis with the provided id does not exist.")
+
+
+    def getPartStats(self, analyzeId):
+        """
+        Returns the number of parts of the analysation, how many of them are
+        completed and how many were taken from the result cache.
+        """
+
+        parts, completed_parts, cached_parts = REDIS_DATABASE.hmget(
+            analyzeId, "parts", "completed_parts", "cached_parts")
+
+        if completed_parts is None:
+            LOG.info("Analysis with the provided id does not exist.")
+            raise AnalysisNotFoundException(
+                "Analysis with the provided id does not exist.")
+
+        return PartStats(parts=int(parts or 0),
+                         completedParts=int(completed_parts),
+                         cachedParts=int(cached_parts or 0))
+
+    def getStatuses(self, analysisIds):
+        """
+        Returns the states and part counts of the given analysations, read
+        in pipelines. Unknown ids are left out. Unlike getStatus, this does
+        not count as a use of the analyses, so a dashboard does not keep
+        them from being removed.
+        """
+        LOG.debug("Get status of %d analyses", len(analysisIds))
+
+        return {analysis_id: analysis_status(analysis_id, status)
+                for analysis_id, status
+                in read_statuses(REDIS_DATABASE, analysisIds).items()}
+
+    def listAnalyses(self, analysisFilter, cursor, limit):
+        """
+        Returns a page of the analysations which match the filter and the
+        cursor of the next page, which is empty after the last page.
+        """
+        LOG.debug("List analyses from cursor %s", cursor)
 
+        state = submitter = priority = None
+        if analysisFilter is not None:
+            state = analysisFilter.state
+            submitter = analysisFilter.submitter
+            if analysisFilter.priority is not None:
+                priority = Priority._VALUES_TO_NAMES[
+                    analysisFilter.priority]
+
+        statuses, next_cursor = list_analyses(
+            REDIS_DATABASE, cursor, limit, state, submitter, priority)
+
+        return AnalysisPage(
+            analyses=[analysis_status(status["analysis_id"], status)
+                      for status in statuses],
+            cursor=next_cursor)
+
+    def waitForStatus(self, analyzeId, knownState, timeoutMs):
+        """
+        Returns the status of the analysation as soon as it differs from the
+        known state, or the known state when the timeout expires.
+        """
+        LOG.debug("Wait for status of analysis %s", analyzeId)
+
+        timeout = min(timeoutMs / 1000, MAX_WAIT_TIMEOUT)
+        analysis_state = STATUS_WATCHER.wait(analyzeId, knownState, timeout)
+
+        if analysis_state is not None:
+            touch_analysis(REDIS_DATABASE, analyzeId)
+            return analysis_state
+        else:
+            LOG.info("Analysis with the provided id does not exist.")
+            raise AnalysisNotFoundException(
+                "Analysis with the provided id does not exist.")
 
     def getResults(self, analyzeId):
         """
@@ -145,45 +644,528 @@ class RemoteAnalyzeHandler:
         """
         LOG.info("Get results of analysis %s", analyzeId)
 
-        analysis_state = REDIS_DATABASE.hget(analyzeId, "state")
+        result_path = self._get_results_path(analyzeId)
 
-        if analysis_state is not None:
-            if analysis_state.decode('utf-8') == AnalyzeStatus.ANALYZE_COMPLETED.name:
-                result_path = os.path.join(WORKSPACE, analyzeId, "output.zip")
+        with open(result_path, "rb") as result:
+            response = result.read()
+
+        return response
+
+    def getResultsInfo(self, analyzeId):
+        """
+        Returns the size and the MD5 checksum of the results of the
+        analysation.
+        """
+        LOG.info("Get results info of analysis %s", analyzeId)
+
+        result_path = self._get_results_path(analyzeId)
+        stat = os.stat(result_path)
+
+        checksum, mtime = REDIS_DATABASE.hmget(
+            analyzeId, "results_checksum", "results_mtime")
+
+        if checksum is None or int(mtime) != stat.st_mtime_ns:
+            md5 = hashlib.md5()
+            with open(result_path, "rb") as result:
+                for chunk in iter(lambda: result.read(READ_CHUNK_SIZE), b""):
+                    md5.update(chunk)
+            checksum = md5.hexdigest()
+
+            REDIS_DATABASE.hset(analyzeId, "results_checksum", checksum)
+            REDIS_DATABASE.hset(analyzeId, "results_mtime", stat.st_mtime_ns)
+        else:
+            checksum = checksum.decode("utf-8")
+
+        return ResultsInfo(size=stat.st_size, checksum=checksum)
+
+    def getResultsChunk(self, analyzeId, offset, length):
+        """
+        Returns at most length bytes of the results of the analysation from
+        the given offset.
+        """
+        LOG.debug("Get results chunk of analysis %s from %d",
+                  analyzeId, offset)
+
+        result_path = self._get_results_path(analyzeId)
+
+        with open(result_path, "rb") as result:
+            result.seek(offset)
+            return result.read(min(length, MAX_CHUNK_SIZE))
+
+    def getCompletedParts(self, analysisId, sinceCursor):
+        """
+        Returns the numbers of the parts of the analysation completed after
+        the cursor, the cursor of the next call and whether the analysation
+        is completed, so no more parts follow the returned ones.
+        """
+        LOG.debug("Get completed parts of analysis %s from cursor %s",
+                  analysisId, sinceCursor)
+
+        state = analysis_state(REDIS_DATABASE, analysisId)
+        completed = PART_RESULTS.completed(analysisId, sinceCursor)
+
+        if state is None or completed is None:
+            LOG.info("Analysis with the provided id does not exist.")
+            raise AnalysisNotFoundException(
+                "Analysis with the provided id does not exist.")
+
+        touch_analysis(REDIS_DATABASE, analysisId)
+
+        part_numbers, cursor = completed
+
+        # The state is read first, so the parts of a completed analysis are
+        # all in the log by now. A full page may be followed by more.
+        finished = state == AnalyzeStatus.ANALYZE_COMPLETED.name and \
+            len(part_numbers) < MAX_PARTS_PER_CALL
+
+        return CompletedParts(partNumbers=part_numbers, cursor=cursor,
+                              finished=finished)
+
+    def getPartResult(self, analysisId, partNumber):
+        """
+        Returns a ZIP file of the reports of a completed part of the
+        analysation.
+        """
+        LOG.info("Get results of part %d of analysis %s", partNumber,
+                 analysisId)
+
+        if analysis_state(REDIS_DATABASE, analysisId) is None:
+            LOG.info("Analysis with the provided id does not exist.")
+            raise AnalysisNotFoundException(
+                "Analysis with the provided id does not exist.")
+
+        touch_analysis(REDIS_DATABASE, analysisId)
+
+        if not PART_RESULTS.is_completed(analysisId, partNumber):
+            LOG.info("Part %d of the analysis is not completed yet.",
+                     partNumber)
+            raise AnalysisNotCompletedException(
+                "Part of the analysis is not completed yet.")
+
+        return PART_RESULTS.part_zip(analysisId, partNumber)
+
+    def queryReports(self, analysisId, reportFilter, cursor, limit):
+        """
+        Returns a page of the reports of the completed analysation which
+        match the filter, the cursor of the next page, which is empty after
+        the last page, and the numbers of the matching reports.
+        """
+        LOG.debug("Query reports of analysis %s from cursor %s", analysisId,
+                  cursor)
+
+        result_path = self._get_results_path(analysisId)
 
-                with open(result_path, "rb") as result:
-                    response = result.read()
+        checkers = files = severities = report_hashes = None
+        if reportFilter is not None:
+            checkers = reportFilter.checkers
+            files = reportFilter.files
+            severities = reportFilter.severities
+            report_hashes = reportFilter.reportHashes
 
-                return response
+        page = REPORT_INDEX.query(result_path, cursor, limit, checkers,
+                                  files, severities, report_hashes)
+
+        # The results built by an analyzer which did not queue them for
+        # indexing are queued by their first query.
+        if page is None:
+            request_index(REDIS_DATABASE, analysisId)
+            LOG.info("Reports of the analysis are not indexed yet.")
+            raise AnalysisNotCompletedException(
+                "Reports of the analysis are not indexed yet.")
+
+        rows, next_cursor, by_severity, by_checker = page
+
+        return ReportPage(
+            reports=[Report(reportHash=report_hash, checker=checker,
+                            severity=severity, file=file_path, line=line,
+                            column=column, message=message)
+                     for _, report_hash, checker, severity, file_path, line,
+                     column, message in rows],
+            cursor=next_cursor,
+            summary=ReportSummary(total=sum(by_severity.values()),
+                                  bySeverity=by_severity,
+                                  byChecker=by_checker))
+
+    def _get_results_path(self, analyzeId):
+        """
+        Returns the path of the results of the analysis if it is completed.
+        """
+
+        state = analysis_state(REDIS_DATABASE, analyzeId)
+
+        if state is not None:
+            touch_analysis(REDIS_DATABASE, analyzeId)
+            if state == AnalyzeStatus.ANALYZE_COMPLETED.name:
+                return os.path.join(WORKSPACE, analyzeId, "output.zip")
             else:
                 LOG.info("Analysis with the provided id is not completed yet.")
-                raise AnalysisNotCompletedException("Analysis with the provided id is not completed yet.")
+                raise AnalysisNotCompletedException(
+                    "Analysis with the provided id is not completed yet.")
         else:
             LOG.info("Analysis with the provided id does not exist.")
-            raise AnalysisNotFoundException("Analysis with the provided id does not exist.")
+            raise AnalysisNotFoundException(
+                "Analysis with the provided id does not exist.")
 
 
-if __name__ == "__main__":
-    PARSER = argparse.ArgumentParser(description=".....")
+def analysis_status(analysis_id, status):
+    """
+    Returns the AnalysisStatus of a status read from the database.
+    """
+
+    return AnalysisStatus(analysisId=analysis_id,
+                          state=status["state"],
+                          parts=status["parts"],
+                          completedParts=status["completed_parts"],
+                          cachedParts=status["cached_parts"],
+                          submitter=status["submitter"],
+                          priority=status["priority"],
+                          lastUse=status["last_use"])
+
+
+def metrics_gauges():
+    """
+    Returns the current queue and file statistics for the metrics endpoint.
+    """
+
+    queue_stats = SCHEDULER.stats()
+    file_stats = KNOWN_FILES.stats()
+    retention_stats = RETENTION.stats()
+
+    return [
+        ("queued_parts", "Parts waiting in the queue of the priority class.",
+         {(("priority", priority),): stats["depth"]
+          for priority, stats in queue_stats.items()}),
+        ("queue_max_wait_seconds",
+         "Longest wait of a dispatched part of the priority class.",
+         {(("priority", priority),): stats["max_wait"]
+          for priority, stats in queue_stats.items()}),
+        ("known_files", "Files in the blob store.",
+         {(): file_stats["count"]}),
+        ("known_file_bytes", "Bytes of the files in the blob store.",
+         {(): file_stats["bytes"]}),
+        ("retention_removed",
+         "Analyses, unfinished uploads and blobs removed by the retention.",
+         {(("kind", kind),): retention_stats.get(kind, 0)
+          for kind in ("analyses", "uploads", "blobs")}),
+        ("retention_reclaimed_bytes",
+         "Bytes of the workspace reclaimed by the retention.",
+         {(): retention_stats.get("reclaimed_bytes", 0)}),
+    ]
+
+
+class ClientSocket(TSocket.TSocket):
+    """
+    Accepted connection whose idle timeout ends it like a closed one, so the
+    engines free its worker without logging an error.
+    """
+
+    def read(self, sz):
+        try:
+            return TSocket.TSocket.read(self, sz)
+        except socket.timeout:
+            raise TTransport.TTransportException(
+                TTransport.TTransportException.TIMED_OUT,
+                "Idle connection timed out.")
+
+
+class TimeoutServerSocket(TSocket.TServerSocket):
+    """
+    Listening socket whose accepted connections time out after they were
+    idle for client_timeout seconds.
+    """
+
+    def __init__(self, host, port, client_timeout):
+        TSocket.TServerSocket.__init__(self, host=host, port=port)
+        self.client_timeout = client_timeout
+
+    def accept(self):
+        handle, _ = self.handle.accept()
+        client = ClientSocket()
+        client.setHandle(handle)
+        client.setTimeout(self.client_timeout * 1000)
+        return client
+
+
+def create_server(engine, host, port, workers, framed=False,
+                  protocol="binary", client_timeout=DEFAULT_CLIENT_TIMEOUT):
+    """
+    Creates the Thrift server of the given engine, transport and protocol.
+    The thread and process engines close the connections idle for
+    client_timeout seconds, or never if it is 0.
 
-    PARSER.add_argument(
+    thread -- Connections are served by a pool of threads.
+    process -- Connections are served by forked worker processes which share
+               the listening socket.
+    nonblocking -- Requests of framed connections are read by a single
+                   select loop and processed by a pool of threads. It is
+                   always framed.
+    """
+
+    handler = RemoteAnalyzeHandler()
+    if SHARD is not None:
+        handler = LoadTrackingHandler(handler, REDIS_DATABASE, SHARD)
+    if METRICS is not None:
+        handler = InstrumentedHandler(handler, METRICS)
+
+    processor = RemoteAnalyze.Processor(handler)
+    p_factory = PROTOCOL_FACTORIES[protocol]()
+
+    # The nonblocking engine serves the idle connections in its select loop
+    # without a worker, so they are not closed.
+    if engine == "nonblocking":
+        transport = TSocket.TServerSocket(host=host, port=port)
+        return TNonblockingServer.TNonblockingServer(
+            processor, transport, p_factory, p_factory, threads=workers)
+
+    if client_timeout:
+        transport = TimeoutServerSocket(host, port, client_timeout)
+    else:
+        transport = TSocket.TServerSocket(host=host, port=port)
+
+    if framed:
+        t_factory = TTransport.TFramedTransportFactory()
+    else:
+        t_factory = TTransport.TBufferedTransportFactory()
+
+    if engine == "process":
+        server = TProcessPoolServer.TProcessPoolServer(
+            processor, transport, t_factory, p_factory)
+        server.setNumWorkers(workers)
+    elif engine == "thread":
+        server = TServer.TThreadPoolServer(
+            processor, transport, t_factory, p_factory, daemon=True)
+        server.setNumThreads(workers)
+    else:
+        server = TServer.TSimpleServer(
+            processor, transport, t_factory, p_factory)
+
+    return server
+
+
+def shard_name(value):
+    """
+    Returns the name of the shard if it can prefix the ids of the analyses.
+    """
+
+    if not SHARD_NAME_PATTERN.match(value):
+        raise argparse.ArgumentTypeError(
+            "The name of the shard may contain letters, digits and hyphens "
+            "only: %s" % value)
+
+    return value
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description=".....")
+
+    parser.add_argument(
         "-w", "--workspace", type=str, dest="workspace", default="workspace", help="..."
     )
+    parser.add_argument(
+        "--host", type=str, dest="host", default="0.0.0.0",
+        help="Address the server is bound to.")
+    parser.add_argument(
+        "--port", type=int, dest="port", default=9090,
+        help="Port the server listens on.")
+    parser.add_argument(
+        "--server", type=str, dest="server",
+        choices=["simple", "thread", "process", "nonblocking"],
+        default="thread",
+        help="Engine of the server. The nonblocking server accepts framed "
+             "connections only.")
+    parser.add_argument(
+        "--workers", type=int, dest="workers", default=32,
+        help="Number of threads or processes serving the requests.")
+    parser.add_argument(
+        "--client-timeout", type=int, dest="client_timeout",
+        default=DEFAULT_CLIENT_TIMEOUT,
+        help="Seconds a connection may be idle before the thread and "
+             "process servers close it and free its worker. 0 keeps the "
+             "idle connections open.")
+    parser.add_argument(
+        "--framed", dest="framed", default=False, action="store_true",
+        help="Use framed transport. The clients have to use --framed too. "
+             "The nonblocking server is always framed.")
+    parser.add_argument(
+        "--protocol", type=str, dest="protocol",
+        choices=sorted(PROTOCOL_FACTORIES), default="binary",
+        help="Protocol of the requests. The clients have to use the same "
+             "--protocol.")
+    parser.add_argument(
+        "--redis-host", type=str, dest="redis_host",
+        default=os.environ.get("REDIS_HOST", "redis"),
+        help="Host of the Redis database. Every shard of a cluster uses the "
+             "same database.")
+    parser.add_argument(
+        "--redis-port", type=int, dest="redis_port", default=6379,
+        help="Port of the Redis database.")
+    parser.add_argument(
+        "--shard", type=shard_name, dest="shard", default=None,
+        help="Name of the shard of the controller in a cluster of "
+             "controllers which share the Redis database and the workspace. "
+             "The ids of its analyses start with the name, so the clients "
+             "send their requests to this controller.")
+    parser.add_argument(
+        "--known-files-cache-ttl", type=int, dest="known_files_cache_ttl",
+        default=DEFAULT_CACHE_TTL,
+        help="Seconds for which a known file is remembered in the process "
+             "without asking the database. 0 disables the cache.")
+    parser.add_argument(
+        "--dispatch-depth", type=int, dest="dispatch_depth",
+        default=DEFAULT_DISPATCH_DEPTH,
+        help="Number of parts kept in the list the analyzers pop from. The "
+             "rest waits in the priority queues.")
+    parser.add_argument(
+        "--shortest-job-first", dest="shortest_job_first", default=False,
+        action="store_true",
+        help="Dispatch the parts of an analysis or submitter in the order of "
+             "their sizes instead of their arrival.")
+    parser.add_argument(
+        "--max-queue-depth", type=int, dest="max_queue_depth", default=None,
+        help="Refuse new analyses and parts while this many parts are "
+             "waiting for the analyzers.")
+    parser.add_argument(
+        "--max-submitter-queued", type=int, dest="max_submitter_queued",
+        default=None,
+        help="Refuse the parts of a submitter while its parts waiting for "
+             "the analyzers are larger than this many MiB. Analyses "
+             "without a submitter are limited one by one.")
+    parser.add_argument(
+        "--disk-low-watermark", type=int, dest="disk_low_watermark",
+        default=None,
+        help="Refuse every upload when less than this many MiB of the "
+             "workspace is free.")
+    parser.add_argument(
+        "--disk-high-watermark", type=int, dest="disk_high_watermark",
+        default=None,
+        help="Accept the uploads again only when this many MiB of the "
+             "workspace is free. (default: --disk-low-watermark)")
+    parser.add_argument(
+        "--busy-retry-after", type=float, dest="busy_retry_after",
+        default=DEFAULT_RETRY_AFTER,
+        help="Seconds after which the clients are asked to retry a refused "
+             "request.")
+    parser.add_argument(
+        "--no-result-cache", dest="use_result_cache", default=True,
+        action="store_false",
+        help="Analyze every part instead of reusing the reports of earlier "
+             "parts with the same inputs.")
+    parser.add_argument(
+        "--analyzer-config-key", type=str, dest="analyzer_config_key",
+        default="",
+        help="Identifies the analyzer version and configuration. Reports "
+             "are reused only from parts analyzed with the same key.")
+    parser.add_argument(
+        "--severity-map", type=str, dest="severity_map", default=None,
+        help="JSON file of the severities of the checkers, like "
+             "checker_severity_map.json of CodeChecker. The reports are "
+             "indexed for queryReports with these severities.")
+    parser.add_argument(
+        "--retention-interval", type=int, dest="retention_interval",
+        default=DEFAULT_INTERVAL,
+        help="Seconds between two cleanups of the workspace.")
+    parser.add_argument(
+        "--completed-ttl", type=int, dest="completed_ttl",
+        default=DEFAULT_COMPLETED_TTL,
+        help="Seconds after the last use when a completed analysis is "
+             "removed.")
+    parser.add_argument(
+        "--stale-ttl", type=int, dest="stale_ttl",
+        default=DEFAULT_STALE_TTL,
+        help="Seconds after the last use when an analysis which is not "
+             "completed is removed.")
+    parser.add_argument(
+        "--upload-ttl", type=int, dest="upload_ttl",
+        default=DEFAULT_UPLOAD_TTL,
+        help="Seconds after the last chunk when an unfinished upload is "
+             "removed.")
+    parser.add_argument(
+        "--workspace-quota", type=int, dest="workspace_quota", default=None,
+        help="Size of the workspace in MiB above which the least recently "
+             "used completed analyses and files are removed.")
+    parser.add_argument(
+        "--metrics-port", type=int, dest="metrics_port", default=None,
+        help="Collect the time, the Redis time and the payload sizes of the "
+             "requests and serve them with the queue and file statistics "
+             "in the Prometheus text format on /metrics of this port.")
+
+    return parser
+
+
+def setup(arguments, database):
+    """
+    Sets up the workspace, the database and the background services of the
+    handler from the command line arguments.
+    """
+
+    global WORKSPACE, REDIS_DATABASE, BLOB_STORE, KNOWN_FILES, \
+        STATUS_WATCHER, RESULT_CACHE, SCHEDULER, METRICS, PART_RESULTS, \
+        REPORT_INDEX, SHARD, ADMISSION, RETENTION
+
+    WORKSPACE = arguments.workspace
+    REDIS_DATABASE = database
+    SHARD = arguments.shard
 
-    ARGUMENTS = PARSER.parse_args()
+    if arguments.metrics_port is not None:
+        METRICS = Metrics(database)
+        REDIS_DATABASE = TimedDatabase(database, METRICS)
 
-    WORKSPACE = ARGUMENTS.workspace
+    BLOB_STORE = BlobStore(WORKSPACE)
+    KNOWN_FILES = KnownFiles(REDIS_DATABASE,
+                             arguments.known_files_cache_ttl)
 
-    HANDLER = RemoteAnalyzeHandler()
-    PROCESSOR = RemoteAnalyze.Processor(HANDLER)
-    TRANSPORT = TSocket.TServerSocket(host="0.0.0.0", port=9090)
-    T_FACTORY = TTransport.TBufferedTransportFactory()
-    P_FACTORY = TBinaryProtocol.TBinaryProtocolFactory()
+    STATUS_WATCHER = StatusWatcher(REDIS_DATABASE)
+    PART_RESULTS = PartResults(REDIS_DATABASE, WORKSPACE)
+    REPORT_INDEX = ReportIndex(REDIS_DATABASE, WORKSPACE,
+                               arguments.severity_map)
+    REPORT_INDEX.start()
+
+    RESULT_CACHE = ResultCache(REDIS_DATABASE, WORKSPACE, PART_RESULTS,
+                               arguments.analyzer_config_key) \
+        if arguments.use_result_cache else None
+
+    SCHEDULER = Scheduler(REDIS_DATABASE, arguments.dispatch_depth,
+                          shortest_job_first=arguments.shortest_job_first)
+    SCHEDULER.start()
+
+    mib = 1024 * 1024
+    ADMISSION = AdmissionControl(
+        SCHEDULER, WORKSPACE, arguments.max_queue_depth,
+        arguments.max_submitter_queued * mib
+        if arguments.max_submitter_queued is not None else None,
+        arguments.disk_low_watermark * mib
+        if arguments.disk_low_watermark is not None else None,
+        arguments.disk_high_watermark * mib
+        if arguments.disk_high_watermark is not None else None,
+        arguments.busy_retry_after)
+
+    RETENTION = RetentionEngine(
+        REDIS_DATABASE, WORKSPACE, BLOB_STORE, KNOWN_FILES, SCHEDULER,
+        interval=arguments.retention_interval,
+        completed_ttl=arguments.completed_ttl,
+        stale_ttl=arguments.stale_ttl,
+        upload_ttl=arguments.upload_ttl,
+        quota=arguments.workspace_quota * 1024 * 1024
+        if arguments.workspace_quota is not None else None)
+    RETENTION.start()
+
+    if METRICS is not None:
+        METRICS.serve(arguments.host, arguments.metrics_port, metrics_gauges)
+
+
+if __name__ == "__main__":
+    ARGUMENTS = create_parser().parse_args()
 
-    SERVER = TServer.TSimpleServer(PROCESSOR, TRANSPORT, T_FACTORY, P_FACTORY)
+    # The connection pool of the client is shared by the threads and is
+    # recreated in forked worker processes on first use.
+    setup(ARGUMENTS, redis.Redis(host=ARGUMENTS.redis_host,
+                                 port=ARGUMENTS.redis_port, db=0))
 
-    REDIS_DATABASE = redis.Redis(host="redis", port=6379, db=0)
+    SERVER = create_server(ARGUMENTS.server, ARGUMENTS.host, ARGUMENTS.port,
+                           ARGUMENTS.workers, ARGUMENTS.framed,
+                           ARGUMENTS.protocol, ARGUMENTS.client_timeout)
 
-    LOG.info("Starting the server...")
+    LOG.info("Starting the %s server on %s:%d...", ARGUMENTS.server,
+             ARGUMENTS.host, ARGUMENTS.port)
     SERVER.serve()
     LOG.info("Server stopped.")
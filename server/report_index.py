@@ -0,0 +1,313 @@
+"""
+Index of the reports of the completed analyses for queries without the
+download of the results.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import plistlib
+import sqlite3
+import tempfile
+import threading
+import zipfile
+
+LOG = logging.getLogger("SERVER")
+
+# The index of an analysis is stored next to its results, so the retention
+# removes them together.
+INDEX_FILE = "reports.sqlite"
+
+# Queue of the analyses whose results are indexed by the controllers, and
+# the prefix of the keys which keep an analysis from being queued again
+# until its index is built.
+QUEUE_KEY = "REPORT_INDEX_QUEUE"
+REQUEST_KEY_PREFIX = "REPORT_INDEX_REQUESTED:"
+REQUEST_TTL = 600
+
+# Seconds the indexer blocks on the empty queue before checking whether it
+# is stopped.
+POP_TIMEOUT = 1
+
+# Upper limit of the reports returned by one page of a query.
+MAX_PAGE_SIZE = 1000
+
+DEFAULT_SEVERITY = "UNSPECIFIED"
+
+SCHEMA = [
+    "CREATE TABLE reports ("
+    "id INTEGER PRIMARY KEY, report_hash TEXT, checker TEXT, "
+    "severity TEXT, file TEXT, line INTEGER, column INTEGER, "
+    "message TEXT, UNIQUE (report_hash, checker, file, line, column))",
+    "CREATE INDEX reports_checker ON reports (checker)",
+    "CREATE INDEX reports_file ON reports (file)",
+    "CREATE INDEX reports_severity ON reports (severity)",
+    "CREATE INDEX reports_report_hash ON reports (report_hash)",
+    "CREATE TABLE source (mtime INTEGER)",
+]
+
+
+def plist_reports(content, severities):
+    """
+    Returns the reports of a plist file of the analyzer as tuples of the
+    report hash, checker, severity, file, line, column and message.
+    """
+
+    plist = plistlib.loads(content)
+    files = plist.get("files", [])
+
+    for diagnostic in plist.get("diagnostics", []):
+        location = diagnostic.get("location", {})
+        file_index = location.get("file", 0)
+        file_path = files[file_index] if file_index < len(files) else ""
+        line = location.get("line", 0)
+        column = location.get("col", 0)
+        checker = diagnostic.get("check_name", "unknown")
+        message = diagnostic.get("description", "")
+
+        report_hash = diagnostic.get("issue_hash_content_of_line_in_context")
+        if not report_hash:
+            report_hash = hashlib.md5(("%s:%d:%d:%s:%s" % (
+                file_path, line, column, checker, message)).encode(
+                    "utf-8")).hexdigest()
+
+        severity = diagnostic.get("severity") or \
+            severities.get(checker, DEFAULT_SEVERITY)
+
+        yield (report_hash, checker, severity, file_path, line, column,
+               message)
+
+
+def request_index(database, analysis_id):
+    """
+    Queues the results of the completed analysis to be indexed by a
+    controller, unless they are queued already.
+    """
+
+    if database.set(REQUEST_KEY_PREFIX + analysis_id, 1, nx=True,
+                    ex=REQUEST_TTL):
+        database.rpush(QUEUE_KEY, analysis_id)
+
+
+def index_path(result_path):
+    """
+    Returns the path of the index of the results.
+    """
+
+    return os.path.join(os.path.dirname(result_path), INDEX_FILE)
+
+
+def build_index(result_path, index_path, severities):
+    """
+    Creates the index of the reports of the plist files in the results ZIP
+    file. The index is written to a temporary file and moved to its place,
+    so a concurrent query sees either no index or a whole one.
+    """
+
+    mtime = os.stat(result_path).st_mtime_ns
+    handle, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(index_path), prefix=INDEX_FILE + ".")
+    os.close(handle)
+
+    try:
+        connection = sqlite3.connect(temp_path)
+        try:
+            for statement in SCHEMA:
+                connection.execute(statement)
+
+            with zipfile.ZipFile(result_path) as archive:
+                for name in archive.namelist():
+                    if not name.endswith(".plist"):
+                        continue
+
+                    try:
+                        reports = list(plist_reports(archive.read(name),
+                                                     severities))
+                    except Exception as error:
+                        LOG.warning("Failed to index report file %s: %s",
+                                    name, error)
+                        continue
+
+                    connection.executemany(
+                        "INSERT OR IGNORE INTO reports (report_hash, "
+                        "checker, severity, file, line, column, message) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)", reports)
+
+            connection.execute("INSERT INTO source VALUES (?)", (mtime,))
+            connection.commit()
+        finally:
+            connection.close()
+
+        os.replace(temp_path, index_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+class ReportIndex:
+    """
+    Indexes the results of the completed analyses by checker, file, severity
+    and report hash and answers the queries from the index.
+
+    The index is built when the analysis is completed: by the controller
+    which builds its results, or by the indexer thread of a controller for
+    the analyses queued by their analyzers with request_index. Queries only
+    read the index, so they do not block on the parsing of the results.
+
+    The analyzer does not store the severities in the reports, so they are
+    taken from the severity map of the checkers, like the one of
+    CodeChecker, if it is given.
+    """
+
+    def __init__(self, database, workspace, severity_map_path=None):
+        self.database = database
+        self.workspace = workspace
+        self.severities = {}
+
+        if severity_map_path:
+            with open(severity_map_path) as severity_map:
+                self.severities = json.load(severity_map)
+
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Starts the indexer in a daemon thread.
+        """
+
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name="report-index")
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.run_once(POP_TIMEOUT)
+            except Exception:
+                LOG.exception("Indexing of the reports failed.")
+
+    def run_once(self, timeout):
+        """
+        Indexes the results of the next queued analysis, waiting at most
+        timeout seconds for one. Returns whether an analysis was indexed.
+        """
+
+        item = self.database.blpop([QUEUE_KEY], timeout)
+        if item is None:
+            return False
+
+        analysis_id = item[1].decode("utf-8")
+        result_path = os.path.join(self.workspace, analysis_id, "output.zip")
+
+        try:
+            if os.path.isfile(result_path):
+                self.build(result_path)
+            else:
+                LOG.warning("Results of analysis %s to index do not exist.",
+                            analysis_id)
+        finally:
+            self.database.delete(REQUEST_KEY_PREFIX + analysis_id)
+
+        return True
+
+    def is_current(self, result_path):
+        """
+        Returns whether the index of the results exists and is built from
+        their current version.
+        """
+
+        path = index_path(result_path)
+
+        try:
+            mtime = os.stat(result_path).st_mtime_ns
+        except FileNotFoundError:
+            return False
+
+        if not os.path.isfile(path):
+            return False
+
+        connection = sqlite3.connect(path)
+        try:
+            row = connection.execute("SELECT mtime FROM source").fetchone()
+        except sqlite3.Error as error:
+            LOG.warning("Index %s is broken: %s", path, error)
+            row = None
+        finally:
+            connection.close()
+
+        return row is not None and row[0] == mtime
+
+    def build(self, result_path):
+        """
+        Builds the index of the results unless it is current.
+        """
+
+        if self.is_current(result_path):
+            return
+
+        LOG.info("Index the reports of %s", result_path)
+        build_index(result_path, index_path(result_path), self.severities)
+
+    def query(self, result_path, cursor, limit, checkers=None, files=None,
+              severities=None, report_hashes=None):
+        """
+        Returns the reports of the results which match the filters, at most
+        limit of them after the cursor, the cursor of the next page, which
+        is empty after the last page, and the numbers of the matching
+        reports in total, by severity and by checker.
+
+        checkers and files are lists of glob patterns, severities and
+        report_hashes lists of values. A report matches a filter if it
+        matches any element of it.
+
+        Returns None if the index of the results is not built yet.
+        """
+
+        if not self.is_current(result_path):
+            return None
+
+        conditions = []
+        parameters = []
+
+        for column, values, operator in (
+                ("checker", checkers, "GLOB"),
+                ("file", files, "GLOB"),
+                ("severity", severities, "="),
+                ("report_hash", report_hashes, "=")):
+            if values:
+                conditions.append("(%s)" % " OR ".join(
+                    ["%s %s ?" % (column, operator)] * len(values)))
+                parameters.extend(values)
+
+        where = " AND ".join(conditions) if conditions else "1"
+        limit = max(0, min(limit, MAX_PAGE_SIZE))
+        position = int(cursor) if cursor else 0
+
+        connection = sqlite3.connect(index_path(result_path))
+        try:
+            rows = connection.execute(
+                "SELECT id, report_hash, checker, severity, file, line, "
+                "column, message FROM reports WHERE id > ? AND %s "
+                "ORDER BY id LIMIT ?" % where,
+                [position] + parameters + [limit]).fetchall()
+
+            by_severity = dict(connection.execute(
+                "SELECT severity, COUNT(*) FROM reports WHERE %s "
+                "GROUP BY severity" % where, parameters).fetchall())
+            by_checker = dict(connection.execute(
+                "SELECT checker, COUNT(*) FROM reports WHERE %s "
+                "GROUP BY checker" % where, parameters).fetchall())
+        finally:
+            connection.close()
+
+        next_cursor = str(rows[-1][0]) if rows and len(rows) == limit \
+            else ""
+
+        return rows, next_cursor, by_severity, by_checker
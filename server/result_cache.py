@@ -0,0 +1,192 @@
+"""
+Cache of the results of the parts by the fingerprints of their inputs.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import zipfile
+
+# Hash of the fingerprints and the parts which produced their results.
+CACHE_KEY = "RESULT_CACHE"
+
+# Hash of the fingerprints and the parts which were queued for them and are
+# not confirmed to have produced usable results yet.
+PENDING_KEY = "RESULT_CACHE_PENDING"
+
+# The analyzer stores the failed analyses of a part in this directory of its
+# output.
+FAILED_DIR = "failed"
+
+# The analyzer writes the reports of part N of an analysis to this directory
+# of the analysis.
+PART_OUTPUT_DIR = "output_%d"
+
+# Files of the part ZIP files which describe the part instead of being its
+# sources.
+METADATA_FILES = {"sources-root/paths_of_dependencies.json",
+                  "sources-root/compile_command.json",
+                  "sources-root/cached_files"}
+
+
+def build_results(analysis_dir, result_path):
+    """
+    Creates the results ZIP file of an analysis from the reports of its
+    parts. Reports of the same name are added once. The ZIP file is written
+    to a temporary file of its own and moved to its place, so concurrent
+    builds do not interfere.
+    """
+
+    handle, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(result_path),
+        prefix=os.path.basename(result_path) + ".", suffix=".tmp")
+    os.close(handle)
+
+    try:
+        _write_results(analysis_dir, temp_path)
+        os.replace(temp_path, result_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def _write_results(analysis_dir, archive_path):
+    with zipfile.ZipFile(archive_path, "w", zipfile.ZIP_DEFLATED) as archive:
+        names = set()
+
+        for entry in sorted(os.listdir(analysis_dir)):
+            part_output = os.path.join(analysis_dir, entry)
+            if not entry.startswith("output_") or \
+                    not os.path.isdir(part_output):
+                continue
+
+            for root, _, files in os.walk(part_output):
+                for file_name in files:
+                    file_path = os.path.join(root, file_name)
+                    archive_path = os.path.relpath(file_path, part_output)
+
+                    if archive_path not in names:
+                        names.add(archive_path)
+                        archive.write(file_path, archive_path)
+
+
+class ResultCache:
+    """
+    Finds the results of earlier parts with the same compile command, the
+    same source and header contents and the same analyzer configuration.
+
+    The fingerprint of a part is registered as pending when the part is
+    queued. It is confirmed when a later part of the same fingerprint
+    arrives, if the pending part is completed with reports and without
+    failures, and the later part reuses its reports by hardlinks. A part
+    which reused the reports becomes the registered part itself, so the
+    cache lives as long as the retention keeps the analyses which use it.
+    """
+
+    def __init__(self, database, workspace, part_results, config_key=""):
+        self.database = database
+        self.workspace = workspace
+        self.part_results = part_results
+        self.config_key = config_key
+
+    def fingerprint(self, zip_path):
+        """
+        Returns the fingerprint of the part from its compile command, the
+        hashes and paths of its files and the analyzer configuration.
+        """
+
+        with zipfile.ZipFile(zip_path) as archive:
+            names = set(archive.namelist())
+
+            compile_command = json.loads(
+                archive.read("sources-root/compile_command.json"))
+
+            if "sources-root/cached_files" in names:
+                files = json.loads(archive.read("sources-root/cached_files"))
+            else:
+                files = {}
+
+            for name in names - METADATA_FILES:
+                files[hashlib.md5(archive.read(name)).hexdigest()] = name
+
+        fingerprint = hashlib.md5(json.dumps(
+            [self.config_key, compile_command, sorted(files.items())],
+            sort_keys=True).encode("utf-8"))
+
+        return fingerprint.hexdigest()
+
+    def reuse(self, fingerprint, analysis_id, part_number):
+        """
+        Links the reports of an earlier part of the same fingerprint into the
+        output directory of the part, if that part completed with usable
+        reports. Otherwise the part is registered as pending for the
+        fingerprint, unless the pending part is still waiting for its
+        analysis. Returns True if the reports were reused.
+        """
+
+        part = analysis_id + "_" + str(part_number)
+        target_dir = os.path.join(self.workspace, analysis_id,
+                                  PART_OUTPUT_DIR % part_number)
+
+        entry = self.database.hget(CACHE_KEY, fingerprint)
+        if entry is not None:
+            source_dir = self._output_dir(entry.decode("utf-8"))
+            if self._is_usable(source_dir):
+                self._link_tree(source_dir, target_dir)
+                self.database.hset(CACHE_KEY, fingerprint, part)
+                return True
+
+        pending = self.database.hget(PENDING_KEY, fingerprint)
+        if pending is not None:
+            pending = pending.decode("utf-8")
+            pending_id, pending_part = pending.rsplit("_", 1)
+
+            if self.part_results.is_completed(pending_id, int(pending_part)):
+                source_dir = self._output_dir(pending)
+                if self._is_usable(source_dir):
+                    self._link_tree(source_dir, target_dir)
+                    self.database.hset(CACHE_KEY, fingerprint, part)
+                    self.database.hdel(PENDING_KEY, fingerprint)
+                    return True
+            elif self.database.exists(pending_id):
+                # The pending part may be analyzed yet.
+                return False
+
+        self.database.hset(PENDING_KEY, fingerprint, part)
+
+        return False
+
+    def _output_dir(self, part):
+        analysis_id, part_number = part.rsplit("_", 1)
+
+        return os.path.join(self.workspace, analysis_id,
+                            PART_OUTPUT_DIR % int(part_number))
+
+    def _is_usable(self, output_dir):
+        """
+        Returns True if the output directory of a part has reports and no
+        failed analyses.
+        """
+
+        if os.path.exists(os.path.join(output_dir, FAILED_DIR)):
+            return False
+
+        for _, _, files in os.walk(output_dir):
+            if files:
+                return True
+
+        return False
+
+    def _link_tree(self, source_dir, target_dir):
+        for root, _, files in os.walk(source_dir):
+            target_root = os.path.join(target_dir,
+                                       os.path.relpath(root, source_dir))
+            os.makedirs(target_root, exist_ok=True)
+
+            for file_name in files:
+                try:
+                    os.link(os.path.join(root, file_name),
+                            os.path.join(target_root, file_name))
+                except FileExistsError:
+                    pass
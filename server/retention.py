@@ -0,0 +1,328 @@
+"""
+Retention of the analyses, the unfinished uploads and the blob store in the
+workspace.
+"""
+
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from analysis_status import ANALYSES_KEY, reported_state
+from part_results import COMPLETED_PARTS_KEY
+
+LOG = logging.getLogger("SERVER")
+
+STATS_KEY = "RETENTION_STATS"
+
+# Directory of the unfinished chunked uploads in the workspace and the
+# prefix of their keys in the database.
+UPLOADS_DIR = "uploads"
+UPLOAD_KEY_PREFIX = "UPLOAD:"
+
+# Only one controller cleans a shared workspace at a time. The lock holds
+# the token of its owner and is released only by it, even if it expired
+# and was taken by another controller meanwhile.
+LOCK_KEY = "RETENTION_LOCK"
+
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+DEFAULT_INTERVAL = 600
+DEFAULT_COMPLETED_TTL = 7 * 24 * 3600
+DEFAULT_STALE_TTL = 30 * 24 * 3600
+DEFAULT_UPLOAD_TTL = 24 * 3600
+DEFAULT_BLOB_MIN_AGE = 3600
+
+# Number of candidates fetched from the database in one eviction step.
+EVICTION_BATCH_SIZE = 100
+
+
+def disk_usage(path):
+    """
+    Returns the number of bytes used by the files under the path. Hardlinked
+    files are counted once.
+    """
+
+    inodes = set()
+    size = 0
+
+    for root, _, files in os.walk(path):
+        for file_name in files:
+            try:
+                stat = os.lstat(os.path.join(root, file_name))
+            except FileNotFoundError:
+                continue
+
+            if stat.st_ino not in inodes:
+                inodes.add(stat.st_ino)
+                size += stat.st_size
+
+    return size
+
+
+def reclaimable_size(path):
+    """
+    Returns the number of bytes freed by removing the path, which is the
+    size of its files without other hardlinks.
+    """
+
+    size = 0
+
+    for root, _, files in os.walk(path):
+        for file_name in files:
+            try:
+                stat = os.lstat(os.path.join(root, file_name))
+            except FileNotFoundError:
+                continue
+
+            if stat.st_nlink == 1:
+                size += stat.st_size
+
+    return size
+
+
+class RetentionEngine:
+    """
+    Periodically removes the analyses, the unfinished uploads and the blobs
+    which are not needed anymore.
+
+    Completed analyses are removed completed_ttl seconds after their last
+    use, analyses in any other state stale_ttl seconds after it. If the
+    workspace is larger than quota bytes, the least recently used completed
+    analyses and then the least recently used blobs are removed until it
+    fits. A blob is never removed while a part in the workspace still links
+    it or while it was used in the last blob_min_age seconds, because a
+    client may be about to send a part which refers to it.
+
+    The number of removed items and reclaimed bytes are counted in the
+    RETENTION_STATS hash of the database.
+    """
+
+    def __init__(self, database, workspace, blob_store, known_files,
+                 scheduler=None, interval=DEFAULT_INTERVAL,
+                 completed_ttl=DEFAULT_COMPLETED_TTL,
+                 stale_ttl=DEFAULT_STALE_TTL, upload_ttl=DEFAULT_UPLOAD_TTL,
+                 quota=None, blob_min_age=DEFAULT_BLOB_MIN_AGE):
+        self.database = database
+        self.workspace = workspace
+        self.blob_store = blob_store
+        self.known_files = known_files
+        self.scheduler = scheduler
+        self.interval = interval
+        self.completed_ttl = completed_ttl
+        self.stale_ttl = stale_ttl
+        self.upload_ttl = upload_ttl
+        self.quota = quota
+        self.blob_min_age = blob_min_age
+
+        self._stopped = threading.Event()
+        self._thread = None
+
+        self._release_lock = database.register_script(RELEASE_LOCK_SCRIPT)
+
+    def start(self):
+        """
+        Starts the cleanup in a daemon thread.
+        """
+
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name="retention")
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                LOG.exception("Retention failed.")
+
+    def run_once(self):
+        """
+        Runs one cleanup if no other controller is running it.
+        """
+
+        token = uuid.uuid4().hex
+
+        if not self.database.set(LOCK_KEY, token, nx=True, ex=self.interval):
+            LOG.debug("Retention is running on another controller.")
+            return
+
+        try:
+            now = time.time()
+
+            self._remove_expired_analyses(now)
+            self._remove_stale_uploads(now)
+
+            if self.quota is not None:
+                self._enforce_quota(now)
+        finally:
+            self._release_lock(keys=[LOCK_KEY], args=[token])
+
+    def _remove_expired_analyses(self, now):
+        expired = self.database.zrangebyscore(
+            ANALYSES_KEY, "-inf", now - min(self.completed_ttl,
+                                            self.stale_ttl))
+
+        for analysis_id in expired:
+            analysis_id = analysis_id.decode("utf-8")
+            last_use = self.database.zscore(ANALYSES_KEY, analysis_id)
+
+            if self._is_completed(analysis_id):
+                ttl = self.completed_ttl
+            else:
+                ttl = self.stale_ttl
+
+            if last_use is not None and last_use < now - ttl:
+                self._remove_analysis(analysis_id)
+
+    def _is_completed(self, analysis_id):
+        """
+        Returns True if the analysis is completed as reported to the
+        clients. An analysis whose announced parts are not all completed
+        yet is still running.
+        """
+
+        state, completed_parts, expected_parts = self.database.hmget(
+            analysis_id, "state", "completed_parts", "expected_parts")
+
+        return state is not None and reported_state(
+            state.decode("utf-8"), completed_parts,
+            expected_parts) == "ANALYZE_COMPLETED"
+
+    def _remove_analysis(self, analysis_id):
+        # An empty id would name the whole workspace.
+        if not analysis_id:
+            self.database.zrem(ANALYSES_KEY, analysis_id)
+            return 0
+
+        analysis_dir = os.path.join(self.workspace, analysis_id)
+        reclaimed = reclaimable_size(analysis_dir)
+
+        LOG.info("Remove analysis %s, reclaim %d bytes.", analysis_id,
+                 reclaimed)
+
+        if self.scheduler is not None:
+            self.scheduler.purge(analysis_id)
+
+        shutil.rmtree(analysis_dir, ignore_errors=True)
+        self.database.delete(analysis_id,
+                             COMPLETED_PARTS_KEY % analysis_id)
+        self.database.zrem(ANALYSES_KEY, analysis_id)
+
+        self._count("analyses", reclaimed)
+
+        return reclaimed
+
+    def _remove_stale_uploads(self, now):
+        uploads_dir = os.path.join(self.workspace, UPLOADS_DIR)
+        if not os.path.isdir(uploads_dir):
+            return
+
+        for upload_id in os.listdir(uploads_dir):
+            upload_path = os.path.join(uploads_dir, upload_id)
+
+            try:
+                stat = os.stat(upload_path)
+            except FileNotFoundError:
+                continue
+
+            if stat.st_mtime < now - self.upload_ttl:
+                LOG.info("Remove unfinished upload %s.", upload_id)
+
+                os.remove(upload_path)
+                self.database.delete(UPLOAD_KEY_PREFIX + upload_id)
+
+                self._count("uploads", stat.st_size)
+
+    def _enforce_quota(self, now):
+        excess = disk_usage(self.workspace) - self.quota
+        if excess <= 0:
+            return
+
+        LOG.info("Workspace is %d bytes over the quota.", excess)
+
+        # Least recently used completed analyses first.
+        start = 0
+        while excess > 0:
+            candidates = self.database.zrange(
+                ANALYSES_KEY, start, start + EVICTION_BATCH_SIZE - 1)
+            if not candidates:
+                break
+
+            for analysis_id in candidates:
+                analysis_id = analysis_id.decode("utf-8")
+
+                if not self._is_completed(analysis_id):
+                    start += 1
+                    continue
+
+                excess -= self._remove_analysis(analysis_id)
+                if excess <= 0:
+                    return
+
+        # Then the least recently used blobs without links from parts. When
+        # the blobs were copied to the parts, the links do not tell which
+        # ones are used, so none of them is removed.
+        if self.blob_store.has_copies():
+            LOG.warning("Blobs were copied to the parts, they are not "
+                        "removed to fit the quota.")
+            return
+
+        skipped = set()
+        while excess > 0:
+            candidates = [hash_value for hash_value in
+                          self.known_files.least_recently_used(
+                              now - self.blob_min_age,
+                              EVICTION_BATCH_SIZE + len(skipped))
+                          if hash_value not in skipped]
+            if not candidates:
+                break
+
+            for hash_value in candidates:
+                try:
+                    stat = os.stat(self.blob_store.path(hash_value))
+                except FileNotFoundError:
+                    self.known_files.remove(hash_value)
+                    continue
+
+                if stat.st_nlink > 1:
+                    skipped.add(hash_value)
+                    continue
+
+                self.known_files.remove(hash_value)
+                self.blob_store.remove(hash_value)
+
+                self._count("blobs", stat.st_size)
+
+                excess -= stat.st_size
+                if excess <= 0:
+                    return
+
+    def stats(self):
+        """
+        Returns the number of the removed analyses, uploads and blobs and
+        the reclaimed bytes since the start of the retention.
+        """
+
+        stats = self.database.hgetall(STATS_KEY)
+
+        return {kind.decode("utf-8"): int(value)
+                for kind, value in stats.items()}
+
+    def _count(self, kind, reclaimed):
+        pipeline = self.database.pipeline(transaction=False)
+        pipeline.hincrby(STATS_KEY, kind, 1)
+        pipeline.hincrby(STATS_KEY, "reclaimed_bytes", reclaimed)
+        pipeline.execute()
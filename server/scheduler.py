@@ -0,0 +1,311 @@
+"""
+Priority and fair-share scheduling of the parts of the analyses.
+"""
+
+import logging
+import threading
+import time
+
+LOG = logging.getLogger("SERVER")
+
+# Priority classes in the order they are served.
+PRIORITY_CLASSES = ["HIGH", "NORMAL", "LOW"]
+
+DEFAULT_DISPATCH_DEPTH = 4
+DEFAULT_DISPATCH_INTERVAL = 0.2
+
+# Adds a part to the queue of its flow. A flow which had no queued parts
+# starts at the virtual clock of its class, so idle flows do not save up
+# credit.
+#
+# ARGV: priority class, flow, part, score, time of enqueue, weight of the flow,
+#       size of the part
+ENQUEUE_SCRIPT = """
+local class, flow, part = ARGV[1], ARGV[2], ARGV[3]
+local flows_key = 'SCHED:FLOWS:' .. class
+
+redis.call('ZADD', 'SCHED:FLOW:' .. class .. ':' .. flow, ARGV[4], part)
+redis.call('HSET', 'SCHED:ENQUEUED', part, ARGV[5])
+redis.call('HSET', 'SCHED:WEIGHTS', flow, ARGV[6])
+redis.call('HSET', 'SCHED:SIZES', part, ARGV[7])
+redis.call('HINCRBY', 'SCHED:BYTES', flow, ARGV[7])
+
+if not redis.call('ZSCORE', flows_key, flow) then
+  local clock = redis.call('HGET', 'SCHED:CLOCK', class) or 0
+  redis.call('ZADD', flows_key, clock, flow)
+end
+"""
+
+# Moves parts to the list of the workers until it has the given depth. The
+# part is taken from the highest priority class which has queued parts, from
+# the flow of the smallest virtual time, which then grows by 1 / weight. The
+# size of the part is no longer counted as queued bytes of the flow.
+#
+# ARGV: depth of the list, current time, priority classes in order
+DISPATCH_SCRIPT = """
+local depth, now = tonumber(ARGV[1]), tonumber(ARGV[2])
+local dispatched = 0
+
+while redis.call('LLEN', 'ANALYSES_QUEUE') < depth do
+  local found = false
+
+  for index = 3, #ARGV do
+    local class = ARGV[index]
+    local flows_key = 'SCHED:FLOWS:' .. class
+    local head = redis.call('ZRANGE', flows_key, 0, 0, 'WITHSCORES')
+
+    if #head > 0 then
+      local flow, vtime = head[1], tonumber(head[2])
+      local flow_key = 'SCHED:FLOW:' .. class .. ':' .. flow
+      local part = redis.call('ZRANGE', flow_key, 0, 0)[1]
+      redis.call('ZREM', flow_key, part)
+
+      local weight = tonumber(redis.call('HGET', 'SCHED:WEIGHTS', flow) or 1)
+      redis.call('HSET', 'SCHED:CLOCK', class, vtime)
+
+      if redis.call('ZCARD', flow_key) > 0 then
+        redis.call('ZADD', flows_key, vtime + 1 / weight, flow)
+      else
+        redis.call('ZREM', flows_key, flow)
+        redis.call('HDEL', 'SCHED:WEIGHTS', flow)
+      end
+
+      local size = redis.call('HGET', 'SCHED:SIZES', part)
+      if size then
+        redis.call('HDEL', 'SCHED:SIZES', part)
+        if redis.call('HINCRBY', 'SCHED:BYTES', flow, -size) <= 0 then
+          redis.call('HDEL', 'SCHED:BYTES', flow)
+        end
+      end
+
+      local stats_key = 'SCHED:STATS:' .. class
+      local enqueued = redis.call('HGET', 'SCHED:ENQUEUED', part)
+      redis.call('HDEL', 'SCHED:ENQUEUED', part)
+      if enqueued then
+        local wait = now - tonumber(enqueued)
+        redis.call('HINCRBYFLOAT', stats_key, 'total_wait', wait)
+        local max_wait = redis.call('HGET', stats_key, 'max_wait') or 0
+        if wait > tonumber(max_wait) then
+          redis.call('HSET', stats_key, 'max_wait', wait)
+        end
+      end
+      redis.call('HINCRBY', stats_key, 'dispatched', 1)
+
+      redis.call('RPUSH', 'ANALYSES_QUEUE', part)
+      dispatched = dispatched + 1
+      found = true
+      break
+    end
+  end
+
+  if not found then
+    break
+  end
+end
+
+return dispatched
+"""
+
+
+# Removes the parts of an analysis from the queues of its flow and from the
+# list of the workers.
+#
+# ARGV: flow, prefix of the parts of the analysis, priority classes
+PURGE_SCRIPT = """
+local flow, prefix = ARGV[1], ARGV[2]
+local removed = 0
+
+local function owned(part)
+  return string.sub(part, 1, #prefix) == prefix
+end
+
+for index = 3, #ARGV do
+  local class = ARGV[index]
+  local flow_key = 'SCHED:FLOW:' .. class .. ':' .. flow
+
+  for _, part in ipairs(redis.call('ZRANGE', flow_key, 0, -1)) do
+    if owned(part) then
+      redis.call('ZREM', flow_key, part)
+      redis.call('HDEL', 'SCHED:ENQUEUED', part)
+
+      local size = redis.call('HGET', 'SCHED:SIZES', part)
+      if size then
+        redis.call('HDEL', 'SCHED:SIZES', part)
+        if redis.call('HINCRBY', 'SCHED:BYTES', flow, -size) <= 0 then
+          redis.call('HDEL', 'SCHED:BYTES', flow)
+        end
+      end
+      removed = removed + 1
+    end
+  end
+
+  if redis.call('ZCARD', flow_key) == 0 and
+      redis.call('ZSCORE', 'SCHED:FLOWS:' .. class, flow) then
+    redis.call('ZREM', 'SCHED:FLOWS:' .. class, flow)
+    redis.call('HDEL', 'SCHED:WEIGHTS', flow)
+  end
+end
+
+for _, part in ipairs(redis.call('LRANGE', 'ANALYSES_QUEUE', 0, -1)) do
+  if owned(part) then
+    removed = removed + redis.call('LREM', 'ANALYSES_QUEUE', 0, part)
+  end
+end
+
+return removed
+"""
+
+
+def flow_of(analysis_id, submitter):
+    """
+    Returns the flow of the analysis, which is its submitter if it has one.
+    """
+
+    return submitter.decode("utf-8") if submitter else analysis_id
+
+
+class Scheduler:
+    """
+    Queues the parts of the analyses by priority classes and shares the
+    workers fairly between the flows of a class, which are the submitters
+    of the analyses, or the analyses themselves if no submitter is given.
+
+    The analyzer workers still pop the parts from ANALYSES_QUEUE. The
+    scheduler keeps only dispatch_depth parts in that list, so a part of a
+    higher priority never waits behind many parts of a lower one. With
+    shortest_job_first the parts of a flow are dispatched by the size of
+    their ZIP files, otherwise in the order of their arrival.
+
+    Both operations run as Lua scripts, so any number of controllers can
+    share the queues.
+    """
+
+    def __init__(self, database, dispatch_depth=DEFAULT_DISPATCH_DEPTH,
+                 dispatch_interval=DEFAULT_DISPATCH_INTERVAL,
+                 shortest_job_first=False):
+        self.database = database
+        self.dispatch_depth = dispatch_depth
+        self.dispatch_interval = dispatch_interval
+        self.shortest_job_first = shortest_job_first
+
+        self._enqueue = database.register_script(ENQUEUE_SCRIPT)
+        self._dispatch = database.register_script(DISPATCH_SCRIPT)
+        self._purge = database.register_script(PURGE_SCRIPT)
+        self._stopped = threading.Event()
+
+    def enqueue(self, analysis_id, part, size):
+        """
+        Queues the part of the analysis and dispatches it if there is room
+        in the list of the workers.
+        """
+
+        priority, submitter, weight = self.database.hmget(
+            analysis_id, "priority", "submitter", "weight")
+
+        priority = priority.decode("utf-8") if priority else "NORMAL"
+        flow = flow_of(analysis_id, submitter)
+
+        if self.shortest_job_first:
+            score = size
+        else:
+            score = self.database.incr("SCHED:SEQUENCE")
+
+        self._enqueue(args=[priority, flow, part, score, time.time(),
+                            int(weight or 1), size])
+        self.dispatch()
+
+    def purge(self, analysis_id):
+        """
+        Removes the queued parts of the analysis, which is being deleted, so
+        the workers do not get parts whose files are gone. Returns the
+        number of the removed parts.
+        """
+
+        flow = flow_of(analysis_id,
+                       self.database.hget(analysis_id, "submitter"))
+
+        return self._purge(args=[flow, analysis_id + "_"] + PRIORITY_CLASSES)
+
+    def depth(self):
+        """
+        Returns the number of parts waiting in the priority queues and in
+        the list of the workers.
+        """
+
+        pipeline = self.database.pipeline(transaction=False)
+        pipeline.hlen("SCHED:ENQUEUED")
+        pipeline.llen("ANALYSES_QUEUE")
+
+        return sum(pipeline.execute())
+
+    def queued_bytes(self, analysis_id):
+        """
+        Returns the size of the parts of the flow of the analysis waiting in
+        the priority queues.
+        """
+
+        flow = flow_of(analysis_id,
+                       self.database.hget(analysis_id, "submitter"))
+
+        return int(self.database.hget("SCHED:BYTES", flow) or 0)
+
+    def dispatch(self):
+        """
+        Fills the list of the workers up to the dispatch depth. Returns the
+        number of dispatched parts.
+        """
+
+        args = [self.dispatch_depth, time.time()] + PRIORITY_CLASSES
+        return self._dispatch(args=args)
+
+    def stats(self):
+        """
+        Returns the number of queued and dispatched parts and the average and
+        maximum wait of the dispatched parts in seconds by priority class.
+        """
+
+        stats = {}
+
+        for priority in PRIORITY_CLASSES:
+            flows = self.database.zrange("SCHED:FLOWS:" + priority, 0, -1)
+
+            pipeline = self.database.pipeline(transaction=False)
+            for flow in flows:
+                pipeline.zcard("SCHED:FLOW:%s:%s" % (priority,
+                                                     flow.decode("utf-8")))
+            pipeline.hmget("SCHED:STATS:" + priority,
+                           "dispatched", "total_wait", "max_wait")
+            results = pipeline.execute()
+
+            dispatched, total_wait, max_wait = results[-1]
+            dispatched = int(dispatched or 0)
+
+            stats[priority] = {
+                "depth": sum(results[:-1]),
+                "dispatched": dispatched,
+                "average_wait":
+                    float(total_wait or 0) / dispatched if dispatched
+                    else 0.0,
+                "max_wait": float(max_wait or 0)}
+
+        return stats
+
+    def start(self):
+        """
+        Starts a daemon thread which refills the list of the workers as they
+        take the parts from it.
+        """
+
+        thread = threading.Thread(target=self._run, daemon=True,
+                                  name="scheduler")
+        thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.dispatch_interval):
+            try:
+                self.dispatch()
+            except Exception:
+                LOG.exception("Dispatch of the queued parts failed.")
@@ -0,0 +1,68 @@
+"""
+Load of the shards of a controller cluster.
+"""
+
+import re
+
+# Hash of the shards and the number of their uploads in progress.
+LOAD_KEY = "SHARD_LOAD"
+
+# The name of the shard is the prefix of the ids of its analyses, so it
+# must not contain the separator of the prefix or of the part numbers.
+SHARD_NAME_PATTERN = re.compile(r"^[A-Za-z0-9-]+$")
+
+SHARD_SEPARATOR = "."
+
+# Requests which carry the uploads of the clients and are counted as the
+# load of the shard.
+INGEST_METHODS = {"checkUploadedFiles", "uploadFiles", "analyze",
+                  "beginUpload", "uploadChunk", "commitUpload"}
+
+
+def shard_load(database, shard):
+    """
+    Returns the number of the ingest requests in progress of the shard.
+    """
+
+    return max(int(database.hget(LOAD_KEY, shard) or 0), 0)
+
+
+def shard_analysis_id(shard, analysis_id):
+    """
+    Returns the id of the analysis which encodes its owning shard.
+    """
+
+    if not shard:
+        return analysis_id
+
+    return shard + SHARD_SEPARATOR + analysis_id
+
+
+class LoadTrackingHandler:
+    """
+    Forwards the requests to the handler and counts the ingest requests in
+    progress of the shard in the database, so the clients can choose the
+    least loaded shard across the processes of every controller.
+    """
+
+    def __init__(self, handler, database, shard):
+        self._handler = handler
+        self._database = database
+        self._shard = shard
+
+        database.hset(LOAD_KEY, shard, 0)
+
+    def __getattr__(self, name):
+        method = getattr(self._handler, name)
+
+        if name not in INGEST_METHODS:
+            return method
+
+        def tracked(*args):
+            self._database.hincrby(LOAD_KEY, self._shard, 1)
+            try:
+                return method(*args)
+            finally:
+                self._database.hincrby(LOAD_KEY, self._shard, -1)
+
+        return tracked
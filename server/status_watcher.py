@@ -0,0 +1,203 @@
+"""
+Notification of the connections waiting for the change of the state of an
+analysis.
+"""
+
+import logging
+import os
+import threading
+import time
+
+import redis
+
+from analysis_status import analysis_state
+
+LOG = logging.getLogger("SERVER")
+
+# Keyspace notifications of the hashes, which are the analyses themselves.
+# The flags are added to the ones already enabled on the Redis server.
+NOTIFY_KEYSPACE_EVENTS = "Kh"
+
+# The A flag of the notifications includes the event classes, like h.
+ALL_EVENTS_FLAG = "A"
+
+# Keys of the analyses are UUIDs, prefixed by the name of their shard on a
+# sharded controller, so the events of the other hashes, like the buckets of
+# the known files, are not received.
+ANALYSIS_KEY_PATTERNS = ["????????-????-????-????-????????????",
+                         "*.????????-????-????-????-????????????"]
+
+# Waiting connections check the state at least this often, so changes are
+# noticed even if the keyspace notifications can not be enabled.
+DEFAULT_POLL_INTERVAL = 1.0
+
+# Seconds of the first and of the longest wait before the listener
+# subscribes again to the notifications after it lost its connection.
+INITIAL_RESUBSCRIBE_DELAY = 1.0
+MAX_RESUBSCRIBE_DELAY = 60.0
+
+
+def enable_keyspace_events(database):
+    """
+    Adds the keyspace notification flags of the hashes to the ones enabled
+    on the Redis server, and keeps the flags which other subscribers of the
+    server rely on.
+    """
+
+    current = database.config_get("notify-keyspace-events").get(
+        "notify-keyspace-events", "")
+
+    def enabled(flag):
+        if flag == "K":
+            return flag in current
+        return flag in current or ALL_EVENTS_FLAG in current
+
+    missing = [flag for flag in NOTIFY_KEYSPACE_EVENTS if not enabled(flag)]
+    if missing:
+        database.config_set("notify-keyspace-events",
+                            current + "".join(missing))
+
+
+class StatusWatcher:
+    """
+    Lets connections wait for the change of the state of an analysis.
+
+    One thread per process listens to the keyspace notifications of the
+    analyses and wakes up the connections waiting for the changed analysis,
+    so a waiting connection does not hold a database connection of its own.
+    If the listener loses its connection, the waiting connections poll the
+    database until it subscribes again.
+    """
+
+    def __init__(self, database, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.database = database
+        self.poll_interval = poll_interval
+
+        self._lock = threading.Lock()
+        self._conditions = {}
+        self._waiters = {}
+        self._versions = {}
+        self._listener_pid = None
+
+    def wait(self, analysis_id, known_state, timeout):
+        """
+        Returns the state of the analysis as soon as it differs from the
+        known state or when the timeout in seconds expires. Returns None if
+        the analysis does not exist.
+        """
+
+        self._ensure_listener()
+
+        with self._lock:
+            condition = self._conditions.setdefault(
+                analysis_id, threading.Condition(self._lock))
+            self._waiters[analysis_id] = \
+                self._waiters.get(analysis_id, 0) + 1
+            self._versions.setdefault(analysis_id, 0)
+
+        deadline = time.monotonic() + timeout
+
+        try:
+            while True:
+                with self._lock:
+                    version = self._versions[analysis_id]
+
+                state = analysis_state(self.database, analysis_id)
+                if state is None:
+                    return None
+
+                remaining = deadline - time.monotonic()
+                if state != known_state or remaining <= 0:
+                    return state
+
+                # A notification received since the state was read is not
+                # lost, because the version has been increased by then.
+                with self._lock:
+                    if self._versions[analysis_id] == version:
+                        condition.wait(min(remaining, self.poll_interval))
+        finally:
+            with self._lock:
+                self._waiters[analysis_id] -= 1
+                if not self._waiters[analysis_id]:
+                    del self._waiters[analysis_id]
+                    del self._conditions[analysis_id]
+                    del self._versions[analysis_id]
+
+    def _ensure_listener(self):
+        """
+        Starts the listener thread in the current process. Forked workers
+        start their own one.
+        """
+
+        with self._lock:
+            if self._listener_pid == os.getpid():
+                return
+            self._listener_pid = os.getpid()
+
+        try:
+            enable_keyspace_events(self.database)
+        except redis.RedisError as redis_error:
+            LOG.warning("Keyspace notifications can not be enabled, the "
+                        "waiting connections poll the database: %s",
+                        redis_error)
+            return
+
+        thread = threading.Thread(target=self._listen, daemon=True,
+                                  name="status-watcher")
+        thread.start()
+
+    def _subscribe(self):
+        enable_keyspace_events(self.database)
+
+        pubsub = self.database.pubsub(ignore_subscribe_messages=True)
+        database_index = \
+            self.database.connection_pool.connection_kwargs.get("db", 0)
+        pubsub.psubscribe(*["__keyspace@%d__:%s" % (database_index, pattern)
+                            for pattern in ANALYSIS_KEY_PATTERNS])
+
+        return pubsub
+
+    def _listen(self):
+        delay = INITIAL_RESUBSCRIBE_DELAY
+
+        while True:
+            pubsub = None
+            try:
+                pubsub = self._subscribe()
+                delay = INITIAL_RESUBSCRIBE_DELAY
+
+                # Changes while the listener was not subscribed are noticed
+                # by the waiting connections reading the state again.
+                self._notify_all()
+
+                for message in pubsub.listen():
+                    self._notify(
+                        message["channel"].decode("utf-8").split(":", 1)[1])
+            except redis.ResponseError as redis_error:
+                LOG.warning("Keyspace notifications can not be enabled, the "
+                            "waiting connections poll the database: %s",
+                            redis_error)
+                return
+            except redis.RedisError as redis_error:
+                LOG.warning("Listener of the keyspace notifications lost its "
+                            "connection, subscribe again in %.0f s: %s",
+                            delay, redis_error)
+            finally:
+                if pubsub is not None:
+                    pubsub.close()
+
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RESUBSCRIBE_DELAY)
+
+    def _notify(self, analysis_id):
+        with self._lock:
+            condition = self._conditions.get(analysis_id)
+            if condition is not None:
+                self._versions[analysis_id] += 1
+                condition.notify_all()
+
+    def _notify_all(self):
+        with self._lock:
+            for analysis_id, condition in self._conditions.items():
+                self._versions[analysis_id] += 1
+                condition.notify_all()
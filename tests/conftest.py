@@ -0,0 +1,26 @@
+"""
+Makes the modules of the client, the server and the benchmarks importable by
+their names, like the scripts themselves do.
+"""
+
+import os
+import sys
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.extend([os.path.join(ROOT_DIR, "client"),
+                 os.path.join(ROOT_DIR, "server"),
+                 os.path.join(ROOT_DIR, "benchmark"),
+                 os.path.join(ROOT_DIR, "gen-py")])
+
+
+@pytest.fixture
+def database():
+    """
+    Returns an in-memory Redis of its own for every test.
+    """
+
+    fakeredis = pytest.importorskip("fakeredis")
+
+    return fakeredis.FakeRedis(server=fakeredis.FakeServer())
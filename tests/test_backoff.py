@@ -0,0 +1,96 @@
+import pytest
+
+pytest.importorskip("remote_analyze_api")
+
+import backoff  # noqa: E402
+from backoff import JITTER, BusyRetryClient, backoff_delay  # noqa: E402
+from remote_analyze_api.ttypes import ServerBusyException  # noqa: E402
+
+
+class FakeClient:
+    """
+    Refuses the given number of requests as busy, then answers them.
+    """
+
+    def __init__(self, refusals, retry_after_ms=0):
+        self.refusals = refusals
+        self.retry_after_ms = retry_after_ms
+        self.calls = 0
+
+    def getId(self, options):
+        self.calls += 1
+        if self.calls <= self.refusals:
+            raise ServerBusyException(message="busy", reason="queue",
+                                      retryAfterMs=self.retry_after_ms)
+        return "analysis"
+
+
+class FakeConnection:
+    def __init__(self, client):
+        self.client = client
+
+
+class FakePool:
+    def __init__(self, client):
+        self.client = client
+        self.acquired = 0
+        self.broken = 0
+
+    def acquire(self):
+        self.acquired += 1
+        return FakeConnection(self.client)
+
+    def release(self, connection, broken=False):
+        self.broken += broken
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    delays = []
+    monkeypatch.setattr(backoff.time, "sleep", delays.append)
+    return delays
+
+
+@pytest.mark.parametrize("attempt, retry_after, low", [
+    (1, 0, 1.0),
+    (2, 0, 2.0),
+    (4, 0, 8.0),
+    (1, 30, 30.0),
+    (20, 0, 300.0),
+    (1, 600, 600.0),
+])
+def test_backoff_delay(attempt, retry_after, low):
+    for _ in range(100):
+        delay = backoff_delay(attempt, retry_after)
+        assert low <= delay <= low * (1 + JITTER)
+
+
+def test_refused_request_is_retried(sleeps):
+    client = FakeClient(refusals=2, retry_after_ms=5000)
+    pool = FakePool(client)
+
+    retrying = BusyRetryClient(pool, pool.acquire(), retries=3)
+
+    assert retrying.getId(None) == "analysis"
+    assert client.calls == 3
+    assert len(sleeps) == 2
+    assert all(delay >= 5.0 for delay in sleeps)
+
+    # The connection is given back during the waits.
+    assert pool.broken == 2
+    assert pool.acquired == 3
+
+
+def test_request_fails_after_the_retries(sleeps):
+    client = FakeClient(refusals=10)
+    pool = FakePool(client)
+
+    retrying = BusyRetryClient(pool, pool.acquire(), retries=2,
+                               max_backoff=4)
+
+    with pytest.raises(ServerBusyException):
+        retrying.getId(None)
+
+    assert client.calls == 3
+    assert len(sleeps) == 2
+    assert all(delay <= 4 * (1 + JITTER) for delay in sleeps)
@@ -0,0 +1,102 @@
+"""
+Runs the commands of the client against a controller on an in-memory Redis
+and the fake analyzer workers, like a user runs them.
+"""
+
+import os
+import time
+import zipfile
+
+import pytest
+
+pytest.importorskip("remote_analyze_api")
+pytest.importorskip("fakeredis")
+
+import generate  # noqa: E402
+import remote_analyze  # noqa: E402
+from analysis_status import ANALYSES_KEY  # noqa: E402
+from connection_pool import close_pools  # noqa: E402
+from fake_analyzer import FakeAnalyzer  # noqa: E402
+from remote_analyze_api.ttypes import AnalysisNotCompletedException  # noqa
+from report_index import INDEX_FILE  # noqa: E402
+from run import free_port, start_controller  # noqa: E402
+
+TUS = 4
+
+# Seconds the test waits for the analysis and for the index of its reports.
+TIMEOUT = 60
+
+
+@pytest.fixture(scope="module")
+def controller(tmp_path_factory):
+    workspace = str(tmp_path_factory.mktemp("workspace"))
+    port = free_port()
+    database = start_controller(workspace, port, 8)
+
+    analyzer = FakeAnalyzer(database, workspace, analysis_time=0.05,
+                            jitter=0.05, report_size=64)
+    analyzer.start(2)
+
+    yield port, database, workspace
+
+    analyzer.stop()
+    close_pools()
+
+
+def client_args(port, *command):
+    return remote_analyze.create_parser().parse_args(
+        ["--host", "127.0.0.1", "--port", str(port)] + list(command))
+
+
+def run_command(port, *command):
+    args = client_args(port, *command)
+    args.func(args)
+
+
+def analyses(database):
+    return {member.decode("utf-8")
+            for member in database.zrange(ANALYSES_KEY, 0, -1)}
+
+
+def test_analyze_wait_and_follow(controller, tmp_path, monkeypatch):
+    port, database, workspace = controller
+    compilation_database = generate.generate(
+        str(tmp_path / "tree"), tus=TUS, headers_per_tu=3, shared_ratio=0.5,
+        header_size=256, source_size=256)
+    monkeypatch.chdir(tmp_path)
+
+    known = analyses(database)
+    run_command(port, "analyze", "-cdb", compilation_database, "-j", "2")
+
+    started = analyses(database) - known
+    assert len(started) == 1
+    analysis_id = started.pop()
+    assert int(database.hget(analysis_id, "parts")) == TUS
+
+    run_command(port, "wait", "-id", analysis_id, "--timeout", str(TIMEOUT))
+
+    with zipfile.ZipFile(analysis_id + ".zip") as archive:
+        reports = sorted(archive.namelist())
+    assert len(reports) == TUS
+    assert all(name.startswith("tu_") and name.endswith(".plist")
+               for name in reports)
+
+    run_command(port, "results", "-id", analysis_id, "--follow",
+                "--poll-interval", "0.1")
+
+    assert sorted(os.listdir(analysis_id)) == reports
+
+    # The fake reports are not plist files, so the index is built empty.
+    args = client_args(port, "reports", "-id", analysis_id)
+    deadline = time.monotonic() + TIMEOUT
+    while True:
+        try:
+            with remote_analyze.connect(args, analysis_id) as client:
+                page = client.queryReports(analysis_id, None, "", 10)
+            break
+        except AnalysisNotCompletedException:
+            assert time.monotonic() < deadline, "reports are not indexed"
+            time.sleep(0.1)
+
+    assert page.summary.total == 0
+    assert os.path.isfile(os.path.join(workspace, analysis_id, INDEX_FILE))
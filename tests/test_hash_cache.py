@@ -0,0 +1,134 @@
+import hashlib
+import os
+import sqlite3
+import time
+
+from hash_cache import RACY_INTERVAL_NS, FileHashCache
+
+
+def write(path, content, age=None):
+    with open(path, "wb") as file:
+        file.write(content)
+
+    # The files of the tests are written right before they are hashed, so
+    # the ones which are not racy get an old modification time.
+    if age is not None:
+        mtime = time.time_ns() - age
+        os.utime(path, ns=(mtime, mtime))
+
+
+def cached_paths(database_path):
+    connection = sqlite3.connect(database_path)
+    try:
+        rows = connection.execute("SELECT path FROM file_hashes").fetchall()
+    finally:
+        connection.close()
+
+    return {row[0] for row in rows}
+
+
+def test_hash_is_reused_between_runs(tmp_path):
+    source = str(tmp_path / "source.cpp")
+    database_path = str(tmp_path / "hashes.sqlite")
+    write(source, b"int main() {}\n", age=10 * RACY_INTERVAL_NS)
+
+    cache = FileHashCache(database_path)
+    assert cache.get_hash(source) == \
+        hashlib.md5(b"int main() {}\n").hexdigest()
+    cache.close()
+
+    cache = FileHashCache(database_path)
+    assert cache.get_hash(source) == \
+        hashlib.md5(b"int main() {}\n").hexdigest()
+    assert (cache.hits, cache.misses) == (1, 0)
+    cache.close()
+
+
+def test_racy_file_is_not_stored(tmp_path):
+    racy = str(tmp_path / "racy.h")
+    settled = str(tmp_path / "settled.h")
+    database_path = str(tmp_path / "hashes.sqlite")
+    write(racy, b"#define RACY 1\n")
+    write(settled, b"#define SETTLED 1\n", age=10 * RACY_INTERVAL_NS)
+
+    cache = FileHashCache(database_path)
+    cache.get_hash(racy)
+    cache.get_hash(settled)
+    cache.close()
+
+    assert cached_paths(database_path) == {settled}
+
+
+def test_racy_file_is_cached_within_the_run(tmp_path):
+    racy = str(tmp_path / "racy.h")
+    write(racy, b"#define RACY 1\n")
+
+    cache = FileHashCache(str(tmp_path / "hashes.sqlite"))
+    cache.get_hash(racy)
+    cache.get_hash(racy)
+
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.close()
+
+
+def test_modification_within_the_timestamp_resolution_is_noticed(tmp_path):
+    header = str(tmp_path / "header.h")
+    database_path = str(tmp_path / "hashes.sqlite")
+
+    # The file is modified to the same size in the same timestamp, like on a
+    # file system of coarse timestamps. Its first hash must not be stored, or
+    # the second run would use it.
+    write(header, b"#define VALUE 1\n")
+    stat = os.stat(header)
+
+    cache = FileHashCache(database_path)
+    cache.get_hash(header)
+    cache.close()
+
+    write(header, b"#define VALUE 2\n")
+    os.utime(header, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    cache = FileHashCache(database_path)
+    assert cache.get_hash(header) == \
+        hashlib.md5(b"#define VALUE 2\n").hexdigest()
+    cache.close()
+
+
+def test_changed_file_is_hashed_again(tmp_path):
+    header = str(tmp_path / "header.h")
+    database_path = str(tmp_path / "hashes.sqlite")
+    write(header, b"#define VALUE 1\n", age=10 * RACY_INTERVAL_NS)
+
+    cache = FileHashCache(database_path)
+    cache.get_hash(header)
+    cache.close()
+
+    write(header, b"#define VALUE 22\n", age=5 * RACY_INTERVAL_NS)
+
+    cache = FileHashCache(database_path)
+    assert cache.get_hash(header) == \
+        hashlib.md5(b"#define VALUE 22\n").hexdigest()
+    assert cache.misses == 1
+    cache.close()
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    database_path = str(tmp_path / "hashes.sqlite")
+    paths = []
+    for index in range(3):
+        path = str(tmp_path / ("header_%d.h" % index))
+        write(path, b"%d\n" % index, age=10 * RACY_INTERVAL_NS)
+        paths.append(path)
+
+    cache = FileHashCache(database_path)
+    for path in paths[:2]:
+        cache.get_hash(path)
+    cache.close()
+
+    time.sleep(0.01)
+    cache = FileHashCache(database_path, max_entries=2)
+    cache.get_hash(paths[1])
+    cache.get_hash(paths[2])
+    cache.close()
+
+    assert cached_paths(database_path) == set(paths[1:])
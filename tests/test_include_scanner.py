@@ -0,0 +1,62 @@
+import pytest
+
+from include_scanner import ConditionEvaluator
+
+MACROS = {"ONE": "1", "ZERO": "0", "VERSION": "0x0203", "ALIAS": "ONE",
+          "EMPTY": "", "CALL": "f(x)", "LONG": "10L"}
+
+
+def evaluate(expression, macros=MACROS, unknown_macros=("UNKNOWN",)):
+    return ConditionEvaluator(macros, set(unknown_macros)).evaluate(
+        expression)
+
+
+@pytest.mark.parametrize("expression, expected", [
+    ("1", True),
+    ("0", False),
+    ("defined(ONE)", True),
+    ("defined ONE", True),
+    ("defined(MISSING)", False),
+    ("!defined(MISSING)", True),
+    ("ONE && ZERO", False),
+    ("ONE || ZERO", True),
+    ("VERSION >= 0x0200", True),
+    ("VERSION < 0x0200", False),
+    ("ALIAS == 1", True),
+    ("LONG == 10", True),
+    ("MISSING == 0", True),
+    ("ONE + 1 == 2", True),
+    ("-1 < 0", True),
+    ("(ONE || ZERO) && !ZERO", True),
+    ("ONE != 1", False),
+    ("1UL", True),
+])
+def test_known_conditions(expression, expected):
+    assert evaluate(expression) is expected
+
+
+@pytest.mark.parametrize("expression", [
+    "defined(UNKNOWN)",
+    "UNKNOWN",
+    "UNKNOWN + 1 > 1",
+    "CALL",
+    "EMPTY",
+    "FUNCTION(1)",
+    "__has_include(<stdio.h>)",
+    "ONE ? 1 : 0",
+    "(ONE",
+    "ONE ONE",
+    "1 * 2",
+])
+def test_unknown_conditions(expression):
+    assert evaluate(expression) is None
+
+
+@pytest.mark.parametrize("expression, expected", [
+    ("ZERO && UNKNOWN", False),
+    ("UNKNOWN && ZERO", False),
+    ("ONE || UNKNOWN", True),
+    ("UNKNOWN || ONE", True),
+])
+def test_short_circuit_of_unknown_operands(expression, expected):
+    assert evaluate(expression) is expected
@@ -0,0 +1,117 @@
+import itertools
+import threading
+import time
+
+from pipeline import Pipeline, Stage
+
+# Seconds a pipeline may run in the tests before it counts as hung.
+TIMEOUT = 10
+
+
+def run(pipeline, source):
+    """
+    Returns the result of the pipeline, or the exception it raised, and
+    fails if it does not stop in time.
+    """
+
+    outcome = {}
+
+    def target():
+        try:
+            outcome["result"] = pipeline.run(source)
+        except Exception as error:
+            outcome["error"] = error
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(TIMEOUT)
+
+    assert not thread.is_alive(), "pipeline did not stop"
+
+    return outcome
+
+
+def test_items_pass_every_stage():
+    seen = []
+    lock = threading.Lock()
+
+    def record(item):
+        with lock:
+            seen.append(item)
+        return [item]
+
+    stages = [Stage("double", lambda item: [item * 2], workers=3),
+              Stage("record", record, workers=2)]
+
+    outcome = run(Pipeline(stages, queue_size=2), range(50))
+
+    assert outcome == {"result": 50}
+    assert sorted(seen) == [item * 2 for item in range(50)]
+
+
+def test_stage_can_drop_and_multiply_items():
+    stages = [Stage("even", lambda item: [item] if item % 2 == 0 else []),
+              Stage("twice", lambda item: [item, item], workers=2)]
+
+    assert run(Pipeline(stages, queue_size=1), range(10)) == {"result": 10}
+
+
+def test_batches_are_bounded():
+    batches = []
+
+    def collect(batch):
+        batches.append(list(batch))
+        time.sleep(0.01)
+        return batch
+
+    stages = [Stage("batch", collect, batch_size=4)]
+
+    assert run(Pipeline(stages, queue_size=8), range(30)) == {"result": 30}
+    assert all(1 <= len(batch) <= 4 for batch in batches)
+    assert sorted(item for batch in batches for item in batch) == \
+        list(range(30))
+
+
+def test_failure_of_a_stage_stops_the_pipeline():
+    def fail_at_ten(item):
+        if item == 10:
+            raise ValueError("broken part")
+        return [item]
+
+    def slow(item):
+        time.sleep(0.01)
+        return [item]
+
+    stages = [Stage("check", fail_at_ten, workers=2),
+              Stage("upload", slow, workers=2)]
+
+    # The source would never end, so only the failure stops the pipeline.
+    outcome = run(Pipeline(stages, queue_size=2), itertools.count())
+
+    assert isinstance(outcome.get("error"), ValueError)
+    assert "result" not in outcome
+
+
+def test_failure_of_the_source_stops_the_pipeline():
+    def source():
+        yield 1
+        yield 2
+        raise OSError("compilation database is gone")
+
+    stages = [Stage("pass", lambda item: [item], workers=2)]
+
+    outcome = run(Pipeline(stages, queue_size=1), source())
+
+    assert isinstance(outcome.get("error"), OSError)
+
+
+def test_failure_of_the_last_stage_stops_the_pipeline():
+    def fail(item):
+        raise RuntimeError("upload failed")
+
+    stages = [Stage("zip", lambda item: [item], workers=2),
+              Stage("upload", fail, workers=3)]
+
+    outcome = run(Pipeline(stages, queue_size=1), range(100))
+
+    assert isinstance(outcome.get("error"), RuntimeError)
@@ -0,0 +1,110 @@
+import os
+import plistlib
+import zipfile
+
+from report_index import INDEX_FILE, QUEUE_KEY, ReportIndex, request_index
+
+
+def diagnostic(checker, line, severity=None):
+    result = {"location": {"file": 0, "line": line, "col": 1},
+              "check_name": checker, "description": "%s here" % checker,
+              "issue_hash_content_of_line_in_context": "%s%d" % (checker,
+                                                                 line)}
+    if severity:
+        result["severity"] = severity
+    return result
+
+
+def write_results(workspace, analysis_id, diagnostics):
+    analysis_dir = os.path.join(workspace, analysis_id)
+    os.makedirs(analysis_dir, exist_ok=True)
+    result_path = os.path.join(analysis_dir, "output.zip")
+
+    with zipfile.ZipFile(result_path, "w") as archive:
+        archive.writestr("main.cpp_1.plist", plistlib.dumps(
+            {"files": ["/src/main.cpp"], "diagnostics": diagnostics}))
+        archive.writestr("main.cpp_1.plist.err", b"not a report")
+
+    return result_path
+
+
+def test_query_reads_only_the_built_index(database, tmp_path):
+    workspace = str(tmp_path)
+    result_path = write_results(workspace, "analysis",
+                                [diagnostic("core.DivideZero", 3)])
+    index = ReportIndex(database, workspace)
+
+    assert index.query(result_path, "", 10) is None
+    assert not os.path.exists(os.path.join(workspace, "analysis",
+                                           INDEX_FILE))
+
+    index.build(result_path)
+    rows, cursor, by_severity, by_checker = index.query(result_path, "", 10)
+
+    assert [row[2] for row in rows] == ["core.DivideZero"]
+    assert cursor == ""
+    assert by_severity == {"UNSPECIFIED": 1}
+    assert by_checker == {"core.DivideZero": 1}
+
+
+def test_queued_analysis_is_indexed_once(database, tmp_path):
+    workspace = str(tmp_path)
+    result_path = write_results(workspace, "analysis",
+                                [diagnostic("core.NullDereference", 7)])
+    index = ReportIndex(database, workspace)
+
+    request_index(database, "analysis")
+    request_index(database, "analysis")
+    assert database.llen(QUEUE_KEY) == 1
+
+    assert index.run_once(1)
+    assert not index.run_once(1)
+    assert index.query(result_path, "", 10)[3] == {"core.NullDereference": 1}
+
+    # The analysis can be queued again, for example if its results change.
+    request_index(database, "analysis")
+    assert database.llen(QUEUE_KEY) == 1
+
+
+def test_rebuilt_results_are_indexed_again(database, tmp_path):
+    workspace = str(tmp_path)
+    result_path = write_results(workspace, "analysis",
+                                [diagnostic("core.DivideZero", 3)])
+    index = ReportIndex(database, workspace)
+    index.build(result_path)
+
+    write_results(workspace, "analysis", [diagnostic("core.DivideZero", 3),
+                                          diagnostic("core.DivideZero", 9)])
+    stat = os.stat(result_path)
+    os.utime(result_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+
+    assert index.query(result_path, "", 10) is None
+
+    index.build(result_path)
+    assert len(index.query(result_path, "", 10)[0]) == 2
+
+
+def test_filters_and_pages(database, tmp_path):
+    workspace = str(tmp_path)
+    severity_map = tmp_path / "severities.json"
+    severity_map.write_text('{"core.DivideZero": "HIGH"}')
+    result_path = write_results(workspace, "analysis", [
+        diagnostic("core.DivideZero", 1),
+        diagnostic("core.DivideZero", 2),
+        diagnostic("deadcode.DeadStores", 3, severity="LOW"),
+        diagnostic("core.NullDereference", 4)])
+    index = ReportIndex(database, workspace, str(severity_map))
+    index.build(result_path)
+
+    rows, cursor, by_severity, _ = index.query(result_path, "", 1,
+                                               checkers=["core.*"])
+    assert len(rows) == 1 and cursor
+    assert by_severity == {"HIGH": 2, "UNSPECIFIED": 1}
+
+    rows, _, _, _ = index.query(result_path, cursor, 10,
+                                checkers=["core.*"])
+    assert [row[5] for row in rows] == [2, 4]
+
+    rows, _, _, by_checker = index.query(result_path, "", 10,
+                                         severities=["LOW"])
+    assert by_checker == {"deadcode.DeadStores": 1}
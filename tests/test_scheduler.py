@@ -0,0 +1,172 @@
+from scheduler import Scheduler
+
+
+def add_analysis(database, analysis_id, priority=None, submitter=None,
+                 weight=None):
+    database.hset(analysis_id, "state", "QUEUED")
+    if priority:
+        database.hset(analysis_id, "priority", priority)
+    if submitter:
+        database.hset(analysis_id, "submitter", submitter)
+    if weight:
+        database.hset(analysis_id, "weight", weight)
+
+
+def dispatched(database):
+    return [part.decode("utf-8")
+            for part in database.lrange("ANALYSES_QUEUE", 0, -1)]
+
+
+def hold(database):
+    # Nothing is dispatched while the parts are queued, so the order of the
+    # dispatch does not depend on the order of the enqueues.
+    return Scheduler(database, dispatch_depth=0)
+
+
+def release(scheduler, depth=100):
+    scheduler.dispatch_depth = depth
+    return scheduler.dispatch()
+
+
+def test_flows_are_served_in_turns(database):
+    scheduler = hold(database)
+    add_analysis(database, "big", submitter="alice")
+    add_analysis(database, "small", submitter="bob")
+
+    for part_number in range(6):
+        scheduler.enqueue("big", "big_%d" % part_number, 1)
+    for part_number in range(2):
+        scheduler.enqueue("small", "small_%d" % part_number, 1)
+
+    assert release(scheduler) == 8
+    assert dispatched(database) == ["big_0", "small_0", "big_1", "small_1",
+                                    "big_2", "big_3", "big_4", "big_5"]
+
+
+def test_flow_gets_share_of_its_weight(database):
+    scheduler = hold(database)
+    add_analysis(database, "heavy", submitter="alice", weight=2)
+    add_analysis(database, "light", submitter="bob")
+
+    for part_number in range(8):
+        scheduler.enqueue("heavy", "heavy_%d" % part_number, 1)
+        scheduler.enqueue("light", "light_%d" % part_number, 1)
+
+    release(scheduler, depth=6)
+
+    parts = dispatched(database)
+    assert sum(part.startswith("heavy") for part in parts) == 4
+    assert sum(part.startswith("light") for part in parts) == 2
+
+
+def test_analyses_of_a_submitter_share_its_flow(database):
+    scheduler = hold(database)
+    add_analysis(database, "first", submitter="alice")
+    add_analysis(database, "second", submitter="alice")
+    add_analysis(database, "other", submitter="bob")
+
+    for analysis_id in ("first", "second"):
+        for part_number in range(2):
+            scheduler.enqueue(analysis_id,
+                              "%s_%d" % (analysis_id, part_number), 1)
+    scheduler.enqueue("other", "other_0", 1)
+    scheduler.enqueue("other", "other_1", 1)
+
+    release(scheduler, depth=4)
+
+    assert dispatched(database) == ["first_0", "other_0", "first_1",
+                                    "other_1"]
+
+
+def test_idle_flow_does_not_save_up_credit(database):
+    scheduler = hold(database)
+    add_analysis(database, "busy", submitter="alice")
+    add_analysis(database, "late", submitter="bob")
+
+    for part_number in range(4):
+        scheduler.enqueue("busy", "busy_%d" % part_number, 1)
+    release(scheduler, depth=2)
+
+    for part_number in range(4):
+        scheduler.enqueue("late", "late_%d" % part_number, 1)
+    database.delete("ANALYSES_QUEUE")
+    release(scheduler, depth=4)
+
+    # The late flow starts at the clock of the class, not at zero, so it
+    # takes turns with the busy one instead of getting the next parts only.
+    assert dispatched(database) == ["late_0", "busy_2", "late_1", "busy_3"]
+
+
+def test_higher_priority_class_is_served_first(database):
+    scheduler = hold(database)
+    add_analysis(database, "low", priority="LOW")
+    add_analysis(database, "normal")
+    add_analysis(database, "high", priority="HIGH")
+
+    scheduler.enqueue("low", "low_0", 1)
+    scheduler.enqueue("normal", "normal_0", 1)
+    scheduler.enqueue("high", "high_0", 1)
+
+    release(scheduler)
+
+    assert dispatched(database) == ["high_0", "normal_0", "low_0"]
+
+
+def test_dispatch_keeps_the_depth_of_the_worker_list(database):
+    scheduler = Scheduler(database, dispatch_depth=2)
+    add_analysis(database, "analysis")
+
+    for part_number in range(5):
+        scheduler.enqueue("analysis", "analysis_%d" % part_number, 1)
+
+    assert dispatched(database) == ["analysis_0", "analysis_1"]
+    assert scheduler.depth() == 5
+
+    database.lpop("ANALYSES_QUEUE")
+    assert scheduler.dispatch() == 1
+    assert dispatched(database) == ["analysis_1", "analysis_2"]
+
+
+def test_shortest_job_first_orders_parts_by_size(database):
+    scheduler = Scheduler(database, dispatch_depth=0,
+                          shortest_job_first=True)
+    add_analysis(database, "analysis")
+
+    scheduler.enqueue("analysis", "analysis_0", 300)
+    scheduler.enqueue("analysis", "analysis_1", 100)
+    scheduler.enqueue("analysis", "analysis_2", 200)
+
+    release(scheduler)
+
+    assert dispatched(database) == ["analysis_1", "analysis_2",
+                                    "analysis_0"]
+
+
+def test_queued_bytes_are_counted_until_dispatch(database):
+    scheduler = hold(database)
+    add_analysis(database, "analysis", submitter="alice")
+
+    scheduler.enqueue("analysis", "analysis_0", 100)
+    scheduler.enqueue("analysis", "analysis_1", 50)
+    assert scheduler.queued_bytes("analysis") == 150
+
+    release(scheduler, depth=1)
+    assert scheduler.queued_bytes("analysis") == 50
+
+
+def test_purge_removes_the_parts_of_the_analysis_only(database):
+    scheduler = hold(database)
+    add_analysis(database, "removed", submitter="alice")
+    add_analysis(database, "kept", submitter="alice")
+
+    for part_number in range(3):
+        scheduler.enqueue("removed", "removed_%d" % part_number, 10)
+        scheduler.enqueue("kept", "kept_%d" % part_number, 10)
+    release(scheduler, depth=2)
+
+    assert scheduler.purge("removed") == 3
+    assert scheduler.queued_bytes("kept") == 20
+    assert scheduler.depth() == 3
+
+    release(scheduler)
+    assert dispatched(database) == ["kept_0", "kept_1", "kept_2"]
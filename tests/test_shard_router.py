@@ -0,0 +1,43 @@
+import pytest
+
+pytest.importorskip("remote_analyze_api")
+
+from shard_router import HashRing, parse_controllers  # noqa: E402
+
+KEYS = ["s%d.analysis-%d" % (index % 3, index) for index in range(2000)]
+
+
+def test_empty_ring_has_no_owner():
+    assert HashRing([]).owner("analysis") is None
+
+
+def test_owner_is_stable():
+    first = HashRing(["a:9090", "b:9090", "c:9090"])
+    second = HashRing(["c:9090", "a:9090", "b:9090"])
+
+    assert [first.owner(key) for key in KEYS] == \
+        [second.owner(key) for key in KEYS]
+
+
+def test_keys_are_spread_over_the_nodes():
+    ring = HashRing(["a", "b", "c"])
+    owners = [ring.owner(key) for key in KEYS]
+
+    for node in ("a", "b", "c"):
+        assert owners.count(node) > len(KEYS) / 6
+
+
+def test_only_the_keys_of_a_leaving_node_move():
+    before = HashRing(["a", "b", "c"])
+    after = HashRing(["a", "c"])
+
+    for key in KEYS:
+        if before.owner(key) != "b":
+            assert after.owner(key) == before.owner(key)
+        else:
+            assert after.owner(key) in ("a", "c")
+
+
+def test_parse_controllers():
+    assert parse_controllers("host:9090, :9091,10.0.0.1:9092") == [
+        ("host", 9090), ("localhost", 9091), ("10.0.0.1", 9092)]
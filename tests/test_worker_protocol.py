@@ -0,0 +1,88 @@
+import os
+import zipfile
+
+from analysis_status import analysis_state
+from fake_analyzer import FakeAnalyzer
+from part_results import COMPLETED_PARTS_KEY, PartResults
+from report_index import QUEUE_KEY
+
+
+def add_analysis(database, workspace, analysis_id, parts,
+                 expected_parts=None):
+    database.hset(analysis_id, "state", "QUEUED")
+    database.hset(analysis_id, "parts", parts)
+    database.hset(analysis_id, "completed_parts", 0)
+    if expected_parts is not None:
+        database.hset(analysis_id, "expected_parts", expected_parts)
+
+    for part_number in range(1, parts + 1):
+        os.makedirs(os.path.join(workspace, analysis_id,
+                                 "source_%d" % part_number))
+        database.rpush("ANALYSES_QUEUE", "%s_%d" % (analysis_id, part_number))
+
+
+def test_part_is_completed_once(database, tmp_path):
+    part_results = PartResults(database, str(tmp_path))
+    database.hset("analysis", "completed_parts", 0)
+
+    assert part_results.complete("analysis", 1) == 1
+    assert part_results.complete("analysis", 1) == 0
+    assert part_results.complete("analysis", 2) == 2
+    assert int(database.hget("analysis", "completed_parts")) == 2
+
+
+def test_completed_parts_are_listed_from_the_cursor(database, tmp_path):
+    part_results = PartResults(database, str(tmp_path))
+    database.hset("analysis", "state", "ANALYZE_IN_PROGRESS")
+    database.hset("analysis", "parts", 3)
+
+    part_results.complete("analysis", 2)
+    part_results.complete("analysis", 1)
+
+    part_numbers, cursor = part_results.completed("analysis", "")
+    assert part_numbers == [2, 1]
+
+    part_results.complete("analysis", 3)
+    assert part_results.completed("analysis", cursor) == ([3], "3")
+    assert part_results.completed("missing", "") is None
+
+
+def test_fake_analyzer_follows_the_worker_protocol(database, tmp_path):
+    workspace = str(tmp_path)
+    add_analysis(database, workspace, "analysis", 2, expected_parts=2)
+    analyzer = FakeAnalyzer(database, workspace, analysis_time=0,
+                            report_size=16)
+
+    assert analyzer.analyze_next(timeout=1)
+    assert analysis_state(database, "analysis") == "QUEUED"
+    assert database.zrange(COMPLETED_PARTS_KEY % "analysis", 0, -1) == \
+        [b"1"]
+
+    assert analyzer.analyze_next(timeout=1)
+    assert analysis_state(database, "analysis") == "ANALYZE_COMPLETED"
+    assert database.hget("analysis", "results_built") == b"1"
+    assert database.lrange(QUEUE_KEY, 0, -1) == [b"analysis"]
+
+    with zipfile.ZipFile(os.path.join(workspace, "analysis",
+                                      "output.zip")) as archive:
+        assert sorted(archive.namelist()) == ["part_1_1.plist",
+                                              "part_2_2.plist"]
+
+    assert analyzer.analyzed_parts == 2
+    assert analyzer.completed_analyses == 1
+
+
+def test_analysis_waits_for_the_expected_parts(database, tmp_path):
+    workspace = str(tmp_path)
+    add_analysis(database, workspace, "analysis", 1, expected_parts=2)
+    analyzer = FakeAnalyzer(database, workspace, analysis_time=0)
+
+    assert analyzer.analyze_next(timeout=1)
+
+    # The parts received so far are done, but the client announced more, so
+    # the analysis waits for them in the queue.
+    assert analysis_state(database, "analysis") == "QUEUED"
+    assert database.hget("analysis", "results_built") is None
+    assert not os.path.exists(os.path.join(workspace, "analysis",
+                                           "output.zip"))
+    assert not analyzer.analyze_next(timeout=1)